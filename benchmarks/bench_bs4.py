@@ -0,0 +1,60 @@
+"""Benchmarks for pypes.bs4.Soup on large pages, requires beautifulsoup4.
+
+Compares full parses against parse_only and split string output. Packets are
+matched fragments, peak memory shows how much of each page stays alive.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_bs4 --output results.json
+"""
+
+from pypes import Pipeline
+from pypes.bs4 import Soup
+from pypes.elements import NullSink, SampleSrc
+
+from .common import main
+
+ROW = (
+    '<div class="result"><h2><a class="large" href="/item/{0}">Item {0}</a></h2>'
+    '<p class="snippet">Some text about item {0}, with <b>bold</b> words.</p>'
+    "</div>\n"
+)
+
+
+def page(rows):
+    head = "<html><head><title>Results</title><style>p {}</style></head><body>"
+    nav = "<nav>" + "".join(f'<a href="/p/{i}">{i}</a>' for i in range(50)) + "</nav>"
+    body = "".join(ROW.format(idx) for idx in range(rows))
+    return f'{head}{nav}<div class="results">{body}</div></body></html>'
+
+
+def soup(selector="div.result a.large", pages=20, rows=5000, **kwargs):
+    def bench(scale):
+        n = max(1, int(pages * scale))
+        html = page(max(1, int(rows * scale)))
+
+        def build():
+            return Pipeline().connect_many(
+                SampleSrc(sample=[html] * n),
+                Soup(selector=selector, **kwargs),
+                NullSink(),
+            )
+
+        return build, n * max(1, int(rows * scale))
+
+    return bench
+
+
+BENCHMARKS = {
+    "soup_html_parser": soup(parser="html.parser"),
+    "soup": soup(),
+    "soup_parse_only": soup("a.large", parse_only="a"),
+    "soup_split_html": soup(split=True, output="html"),
+    "soup_parse_only_split_text": soup(
+        "a.large", parse_only="a", split=True, output="text"
+    ),
+}
+
+
+if __name__ == "__main__":
+    main(BENCHMARKS)
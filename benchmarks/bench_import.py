@@ -0,0 +1,125 @@
+"""Import time benchmark for the pypes modules.
+
+Each module is imported in a fresh interpreter run with ``python -X importtime``
+and its cumulative import time is reported, best of --repeat runs. Modules
+listed in LAZY must not be imported as a side effect, they are flagged and
+the script exits with status 1 if they are, or if --compare finds a module
+more than --max-regression times slower than in the baseline.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_import --output import.json
+    python -m benchmarks.bench_import --compare import.json
+"""
+
+import os
+import subprocess
+import sys
+
+from .common import load, make_doc, make_parser, ratios, save
+
+# Module -> heavy modules it must only import when an element needs them
+LAZY = {
+    "pypes": ("sqlite3", "concurrent.futures", "pypes.cache", "pypes.profiler"),
+    "pypes.elements": ("urllib.request", "ldotcommons.utils"),
+    "pypes.mediaocd": ("guessit", "concurrent.futures.process"),
+    "pypes.bs4": ("bs4", "lxml", "soupsieve"),
+}
+
+MODULES = list(LAZY) + ["pypes.core", "pypes.file", "pypes.net"]
+
+
+def importtime(module):
+    """Imports module in a new interpreter and returns a (cumulative_us,
+    imported) tuple, imported being the set of every module loaded
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [root, env.get("PYTHONPATH")]))
+
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        env=env,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+
+    # Lines look like "import time:  self [us] | cumulative | imported package"
+    cumulative, imported = None, set()
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+
+        fields = line[len("import time:") :].split("|")
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+
+        name = fields[2].strip()
+        imported.add(name)
+        if name == module:
+            cumulative = int(fields[1])
+
+    if cumulative is None:
+        raise RuntimeError(f"No import time reported for '{module}'")
+
+    return cumulative, imported
+
+
+def measure(module, repeat=5):
+    best, imported = None, set()
+    for _ in range(repeat):
+        cumulative, imported = importtime(module)
+        best = cumulative if best is None else min(best, cumulative)
+
+    return {
+        "import_us": best,
+        "modules": len(imported),
+        "eager": sorted(m for m in LAZY.get(module, ()) if m in imported),
+    }
+
+
+def main(modules, argv=None):
+    parser = make_parser("Measure pypes import times", repeat=5)
+    parser.add_argument(
+        "--max-regression",
+        type=float,
+        default=1.5,
+        help="fail if a module is this many times slower than in --compare",
+    )
+    args = parser.parse_args(argv)
+
+    results = {}
+    for module in modules:
+        if args.filter not in module:
+            continue
+
+        results[module] = measure(module, repeat=args.repeat)
+        line = "%-36s %10d us %6d modules" % (
+            module,
+            results[module]["import_us"],
+            results[module]["modules"],
+        )
+        if results[module]["eager"]:
+            line += "  eager: " + ", ".join(results[module]["eager"])
+        print(line, flush=True)
+
+    doc = make_doc(results, args)
+    doc["failed"] = [m for m, r in results.items() if r["eager"]]
+
+    if args.compare:
+        print()
+        times = ratios(results, load(args.compare), key="import_us")
+        for module, ratio in times.items():
+            print("%-36s %6.2fx" % (module, ratio))
+            if ratio > args.max_regression:
+                doc["failed"].append(module)
+
+    if args.output:
+        save(doc, args.output)
+
+    return doc
+
+
+if __name__ == "__main__":
+    sys.exit(1 if main(MODULES)["failed"] else 0)
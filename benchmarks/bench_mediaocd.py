@@ -0,0 +1,80 @@
+"""Benchmarks for the pypes.mediaocd elements, requires guessit.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_mediaocd --output results.json
+"""
+
+import itertools
+
+from pypes import Pipeline
+from pypes.elements import CustomTransformer, GeneratorSrc, NullSink
+from pypes.mediaocd import Normalizer, normalize
+
+from .common import main
+
+REGEXES = (
+    (r"(HDTV|VTV|720px?|mkvpro|x264|HQ edition)", ""),
+    (r"\[Espa.+?ol castellano\]", ""),
+    (r"\[www\..+?\]", ""),
+    (r"(?:Cap\.)?(?P<season>\d+)(?P<episode>\d{2})", r" s\g<season>e\g<episode> "),
+)
+
+SHOWS = ("El Mentalista", "American Horror Story", "Anatomia de grey", "Fringe")
+TAGS = ("HDTV", "720p", "x264", "[www.newpct.com]", "[Español castellano]", "")
+
+
+def filenames(n):
+    names = itertools.cycle(
+        f"series/{show}/{show} {tag}{season}{episode:02d}.avi"
+        for show in SHOWS
+        for tag in TAGS
+        for season in range(1, 4)
+        for episode in range(1, 25)
+    )
+    return itertools.islice(names, n)
+
+
+def normalizer(n=1_000_000, **kwargs):
+    def bench(scale):
+        packets = int(n * scale)
+
+        def build():
+            return Pipeline().connect_many(
+                GeneratorSrc(generator=filenames(packets)),
+                Normalizer(regexes=REGEXES, **kwargs),
+                NullSink(),
+            )
+
+        return build, packets
+
+    return bench
+
+
+def normalizer_uncompiled(n=1_000_000):
+    def bench(scale):
+        packets = int(n * scale)
+
+        def build():
+            return Pipeline().connect_many(
+                GeneratorSrc(generator=filenames(packets)),
+                CustomTransformer(func=lambda x: normalize(x, REGEXES)),
+                NullSink(),
+            )
+
+        return build, packets
+
+    return bench
+
+
+BENCHMARKS = {
+    "normalizer_1m_uncompiled": normalizer_uncompiled(),
+    "normalizer_1m": normalizer(),
+    "normalizer_1m_combined": normalizer(combine=True),
+    "normalizer_1m_batch_1024": normalizer(batch_size=1024),
+    "normalizer_1m_combined_batch_1024": normalizer(combine=True, batch_size=1024),
+}
+
+
+if __name__ == "__main__":
+    main(BENCHMARKS)
@@ -0,0 +1,182 @@
+"""Benchmarks for the Pipeline engine and the built-in elements.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_pipeline --output results.json
+    python -m benchmarks.bench_pipeline --compare results.json
+"""
+
+from pypes import Filter, Pipeline, Transformer
+from pypes.elements import (
+    Adder,
+    DictFilter,
+    DictFixer,
+    GeneratorSrc,
+    Merge,
+    NullSink,
+    SampleSrc,
+    StoreSink,
+    Tee,
+    Zip,
+)
+from pypes.shm import ProcessPipeline
+
+from .common import main
+
+
+class EvenFilter(Filter):
+    def filter(self, x):
+        return x % 2 == 0
+
+
+class Spin(Transformer):
+    # Stands for a CPU-bound stage
+    mutates_input = False
+
+    def transform(self, x):
+        for _ in range(500):
+            x = (x * 31 + 7) % 1_000_003
+        return x
+
+
+def linear_chain(depth, n=100_000, **kwargs):
+    def bench(scale):
+        packets = int(n * scale)
+
+        def build():
+            adders = [Adder(amount=1, **kwargs) for _ in range(depth)]
+            return Pipeline().connect_many(
+                GeneratorSrc(generator=iter(range(packets))), *adders, NullSink()
+            )
+
+        return build, packets
+
+    return bench
+
+
+def tee_fanout(width, n=50_000):
+    def bench(scale):
+        packets = int(n * scale)
+
+        def build():
+            pipe = Pipeline()
+            tee = Tee(n_outputs=width)
+            pipe.connect(GeneratorSrc(generator=iter(range(packets))), tee)
+            for idx in range(width):
+                pipe.connect(tee, NullSink(), "tee_%02d" % idx)
+
+            return pipe
+
+        return build, packets
+
+    return bench
+
+
+def zip_fanin(width, n=50_000, merge=False):
+    def bench(scale):
+        per_input = int(n * scale) // width
+
+        def build():
+            pipe = Pipeline()
+            zip = Merge() if merge else Zip(n_inputs=width)
+            for idx in range(width):
+                src = GeneratorSrc(generator=iter(range(per_input)))
+                pipe.connect(src, zip, "default", "zip_%02d" % idx)
+            pipe.connect(zip, NullSink())
+
+            return pipe
+
+        return build, per_input * width
+
+    return bench
+
+
+def large_count(n=1_000_000, maxsize=0):
+    def bench(scale):
+        packets = int(n * scale)
+
+        def build():
+            return Pipeline(maxsize=maxsize).connect_many(
+                GeneratorSrc(generator=iter(range(packets))),
+                Adder(amount=1),
+                EvenFilter(),
+                NullSink(),
+            )
+
+        return build, packets
+
+    return bench
+
+
+def dicts(n=100_000):
+    def bench(scale):
+        packets = int(n * scale)
+
+        def build():
+            sample = [{"id": i, "name": str(i), "junk": None} for i in range(packets)]
+            return Pipeline().connect_many(
+                SampleSrc(sample=sample),
+                DictFixer(values={"kind": "test"}),
+                DictFilter(keys=("id", "kind")),
+                StoreSink(),
+            )
+
+        return build, packets
+
+    return bench
+
+
+def cpu_chain(partitions, n=20_000):
+    def bench(scale):
+        packets = int(n * scale)
+
+        def build():
+            pipe = ProcessPipeline(maxsize=1024, partitions=partitions)
+            return pipe.connect_many(
+                GeneratorSrc(generator=iter(range(packets))),
+                *[Spin() for _ in range(3)],
+                NullSink(),
+            )
+
+        return build, packets
+
+    return bench
+
+
+def large_payloads(size, zero_copy, n=200):
+    def bench(scale):
+        packets = max(1, int(n * scale))
+        payload = bytes(size)
+
+        def build():
+            src = SampleSrc(sample=[payload] * packets)
+            pipe = ProcessPipeline(maxsize=8, zero_copy=zero_copy)
+            return pipe.connect(src, NullSink()).boundary(src)
+
+        return build, packets
+
+    return bench
+
+
+BENCHMARKS = {
+    **{f"linear_chain_{d}": linear_chain(d) for d in (1, 4, 16, 64)},
+    # Mostly graph setup and teardown
+    "linear_chain_1024": linear_chain(1024, n=1_000),
+    "linear_chain_16_batch_256": linear_chain(16, batch_size=256),
+    **{f"tee_fanout_{w}": tee_fanout(w) for w in (2, 8, 32)},
+    **{f"zip_fanin_{w}": zip_fanin(w) for w in (2, 8, 32)},
+    **{f"merge_fanin_{w}": zip_fanin(w, merge=True) for w in (2, 8, 32)},
+    "large_count": large_count(),
+    "large_count_bounded": large_count(maxsize=1024),
+    "dicts": dicts(),
+    **{f"cpu_chain_3_partitions_{p}": cpu_chain(p) for p in (1, 3)},
+    **{
+        f"large_payloads_{mib}mib_{mode}": large_payloads(mib << 20, mode == "shared")
+        for mib in (1, 16)
+        for mode in ("copy", "shared")
+    },
+}
+
+
+if __name__ == "__main__":
+    main(BENCHMARKS)
@@ -0,0 +1,149 @@
+"""Helpers shared by the benchmark scripts.
+
+Each script defines a dict of benchmarks, name -> callable(scale) returning a
+(build, packets) tuple where build() returns a ready to execute pipeline and
+packets is the number of packets it moves. Results are printed and can be
+stored as JSON and compared against a previous run.
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+
+def measure(build, packets, repeat=3, memory=True):
+    """Executes fresh pipelines from build and returns a dict with the best
+    wall time of repeat runs, throughput, mean time per packet and, if
+    memory is True, the peak memory allocated while executing
+    """
+    wall = None
+    for _ in range(repeat):
+        pipe = build()
+
+        start = time.perf_counter()
+        pipe.execute()
+        elapsed = time.perf_counter() - start
+
+        wall = elapsed if wall is None else min(wall, elapsed)
+
+    result = {
+        "packets": packets,
+        "wall": wall,
+        "packets_per_sec": packets / wall if wall else float("inf"),
+        "us_per_packet": wall / packets * 1e6 if packets else 0.0,
+    }
+
+    if memory:
+        pipe = build()
+
+        tracemalloc.start()
+        try:
+            pipe.execute()
+            _, result["peak_memory"] = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+    return result
+
+
+def format_result(name, result):
+    line = "%-36s %10d pkts %12.0f pkts/s %10.3f us/pkt" % (
+        name,
+        result["packets"],
+        result["packets_per_sec"],
+        result["us_per_packet"],
+    )
+    if "peak_memory" in result:
+        line += " %10.1f KiB peak" % (result["peak_memory"] / 1024)
+
+    return line
+
+
+def ratios(results, baseline, key="packets_per_sec"):
+    """Returns a dict with the ratio of key between each result and the
+    same one in baseline, results missing from baseline are left out
+    """
+    old_results = baseline.get("results", {})
+    return {
+        name: result[key] / old_results[name][key]
+        for name, result in results.items()
+        if name in old_results
+    }
+
+
+def compare(results, baseline, key="packets_per_sec"):
+    """Returns text lines with the ratio of key, throughput by default,
+    against a baseline
+    """
+    return [
+        "%-36s %6.2fx" % (name, ratio)
+        for name, ratio in ratios(results, baseline, key).items()
+    ]
+
+
+def make_parser(description, repeat=3):
+    """Returns an ArgumentParser with the options every script takes"""
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--repeat", type=int, default=repeat, help="runs per benchmark")
+    parser.add_argument("--filter", default="", help="only run matching benchmarks")
+    parser.add_argument("--output", help="store results as JSON")
+    parser.add_argument("--compare", help="JSON results to compare with")
+    return parser
+
+
+def make_doc(results, args, **meta):
+    """Returns the JSON document for results, meta is stored along the
+    interpreter, platform and settings
+    """
+    return {
+        "meta": {
+            "python": sys.version,
+            "platform": platform.platform(),
+            "time": time.time(),
+            "repeat": args.repeat,
+            **meta,
+        },
+        "results": results,
+    }
+
+
+def load(path):
+    with open(path) as fh:
+        return json.load(fh)
+
+
+def save(doc, path):
+    with open(path, "w") as fh:
+        json.dump(doc, fh, indent=2)
+
+
+def main(benchmarks, argv=None):
+    parser = make_parser("Run pypes benchmarks")
+    parser.add_argument("--scale", type=float, default=1.0, help="size multiplier")
+    parser.add_argument("--no-memory", action="store_true", help="skip peak memory")
+    args = parser.parse_args(argv)
+
+    results = {}
+    for name, bench in benchmarks.items():
+        if args.filter not in name:
+            continue
+
+        build, packets = bench(args.scale)
+        results[name] = measure(
+            build, packets, repeat=args.repeat, memory=not args.no_memory
+        )
+        print(format_result(name, results[name]), flush=True)
+
+    doc = make_doc(results, args, scale=args.scale)
+
+    if args.output:
+        save(doc, args.output)
+
+    if args.compare:
+        print()
+        print("\n".join(compare(results, load(args.compare))))
+
+    return doc
@@ -0,0 +1,330 @@
+import asyncio
+import inspect
+import threading
+import urllib.error
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+from .core import EOF, Finish, Pipeline, Transformer, _logger
+from .elements import FetcherProcessor, HttpSrc
+
+
+async def http_get(url, timeout=None):
+    """Minimal non-blocking HTTP/1.1 GET returning the body as bytes.
+    Redirects are not followed, 4xx and 5xx responses raise HTTPError like
+    urlopen does.
+    """
+    if timeout is not None:
+        return await asyncio.wait_for(http_get(url), timeout)
+
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme not in ("http", "https"):
+        raise ValueError(f"Unsupported url '{url}'")
+
+    https = parts.scheme == "https"
+    path = parts.path or "/"
+    if parts.query:
+        path += "?" + parts.query
+
+    reader, writer = await asyncio.open_connection(
+        parts.hostname, parts.port or (443 if https else 80), ssl=https or None
+    )
+
+    try:
+        writer.write(
+            (
+                f"GET {path} HTTP/1.1\r\n"
+                f"Host: {parts.netloc}\r\n"
+                "Accept-Encoding: identity\r\n"
+                "Connection: close\r\n\r\n"
+            ).encode("latin-1")
+        )
+        await writer.drain()
+
+        _, status, reason = (
+            (await reader.readline()).decode("latin-1").strip().split(" ", 2) + [""]
+        )[:3]
+        status = int(status)
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+
+            key, _, value = line.decode("latin-1").partition(":")
+            headers[key.strip().lower()] = value.strip()
+
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            body = bytearray()
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    break
+
+                body += await reader.readexactly(size)
+                await reader.readline()
+
+        elif "content-length" in headers:
+            body = await reader.readexactly(int(headers["content-length"]))
+
+        else:
+            body = await reader.read()
+
+    finally:
+        writer.close()
+
+    if status >= 400:
+        raise urllib.error.HTTPError(url, status, reason, headers, None)
+
+    return bytes(body)
+
+
+class _Waker:
+    """Stands for the ready set of Pipeline: channel events wake the asyncio
+    task driving the element. Safe to call from executor threads.
+    """
+
+    def __init__(self):
+        self.events = {}
+        self.waiting = set()
+        self.loop = None
+        self.thread = None
+
+    def add(self, element):
+        self.waiting.discard(element)
+
+        ev = self.events.get(element)
+        if ev is None:
+            return
+
+        if threading.get_ident() == self.thread:
+            ev.set()
+        else:
+            self.loop.call_soon_threadsafe(ev.set)
+
+    def discard(self, element):
+        pass
+
+
+class AsyncPipeline(Pipeline):
+    """
+    Pipeline running on an asyncio event loop, one task per element.
+    Elements can define 'async def run', using aget and aput to move packets,
+    or be Transformers with an 'async def transform', which run up to the
+    'concurrency' kwarg transforms at once keeping input order. Regular
+    elements run unchanged in a thread pool executor.
+    """
+
+    def __init__(self, maxsize=0, workers=None, profile=False):
+        super().__init__(maxsize=maxsize, workers=workers, profile=profile)
+        self._ready = _Waker()
+
+        # Number of running element tasks and waiters per idle element
+        self._alive = 0
+        self._idle = {}
+        self._stalled = False
+        self._tasks = []
+
+    def run(self):
+        raise TypeError("AsyncPipeline can't be run step by step, use execute")
+
+    def execute(self):
+        asyncio.run(self.aexecute())
+
+        if self.profiler is not None:
+            _logger.info("Pipeline profile:\n" + self.profiler.report())
+
+    async def aexecute(self):
+        waker = self._ready
+        waker.loop = asyncio.get_running_loop()
+        waker.thread = threading.get_ident()
+        waker.events = {e: asyncio.Event() for e in self._elements}
+
+        self._prepare()
+        self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        self._alive = len(self._order)
+        self._tasks = [asyncio.create_task(self._drive(e)) for e in self._order]
+
+        try:
+            await asyncio.gather(*self._tasks)
+
+        except asyncio.CancelledError:
+            if not self._stalled:
+                raise
+
+        finally:
+            for task in self._tasks:
+                task.cancel()
+
+            waker.events = {}
+            self._abort()
+
+    async def idle(self, element):
+        """Waits until element gets woken by a channel or deferred future"""
+        idle = self._idle
+        idle[element] = idle.get(element, 0) + 1
+        if len(idle) == self._alive:
+            asyncio.get_running_loop().call_soon(self._check_stall)
+
+        ev = self._ready.events[element]
+        try:
+            await ev.wait()
+        finally:
+            idle[element] -= 1
+            if not idle[element]:
+                del idle[element]
+
+        ev.clear()
+        if element in self._cancelled:
+            raise Finish()
+
+    def _check_stall(self):
+        if 0 < self._alive == len(self._idle) and not self._deferred:
+            _logger.warning(
+                "Pipeline stalled with unfinished elements: "
+                + ", ".join(str(e) for e in self._elements)
+            )
+            self._stalled = True
+            for task in self._tasks:
+                task.cancel()
+
+    def defer(self, element, future):
+        self._deferred.add(future)
+
+        def done(f):
+            self._deferred.discard(f)
+            self._ready.add(element)
+
+        future.add_done_callback(done)
+
+    def wait(self, element):
+        self._ready.waiting.add(element)
+
+    def cancel(self, element):
+        # Tasks disconnect their elements themselves, wake it up to do so
+        self._cancelled.add(element)
+        self._ready.add(element)
+
+    def _runnable(self, element):
+        if element in self._ready.waiting:
+            return False
+
+        for q in self._outputs[element]:
+            if q.full():
+                q.blocked = True
+                if q.full():
+                    q.full_count += 1
+                    return False
+
+        inputs = self._inputs[element]
+        return (
+            not inputs
+            or any(q.pending() for q in inputs)
+            or self._drained(element, inputs)
+        )
+
+    async def _drive(self, element):
+        try:
+            if inspect.iscoroutinefunction(element.run):
+                while element not in self._cancelled:
+                    await element.run()
+                    # Let other tasks run if element didn't need to wait
+                    await asyncio.sleep(0)
+
+            elif isinstance(element, Transformer) and inspect.iscoroutinefunction(
+                element.transform
+            ):
+                await self._drive_transformer(element)
+
+            else:
+                await self._drive_sync(element)
+
+        except Finish:
+            pass
+
+        self._alive -= 1
+        self.disconnect(element)
+        if len(self._idle) == self._alive:
+            asyncio.get_running_loop().call_soon(self._check_stall)
+
+    async def _drive_sync(self, element):
+        loop = asyncio.get_running_loop()
+        if self.profiler is None:
+            run = element.run
+        else:
+            # Only sync elements are profiled
+            def run():
+                return self.profiler.run(element)
+
+        # Every element runs at least once, like in Pipeline
+        await loop.run_in_executor(self._executor, run)
+        while element not in self._cancelled:
+            if self._runnable(element):
+                await loop.run_in_executor(self._executor, run)
+            else:
+                await self.idle(element)
+
+    async def _drive_transformer(self, element):
+        slots = asyncio.Semaphore(element.kwargs.get("concurrency", 1))
+        tasks = asyncio.Queue()
+
+        async def feed():
+            while True:
+                await slots.acquire()
+                try:
+                    packet = await element.aget()
+                except (EOF, Finish):
+                    await tasks.put(None)
+                    return
+
+                await tasks.put(asyncio.ensure_future(element.transform(packet)))
+
+        feeder = asyncio.ensure_future(feed())
+        try:
+            while element not in self._cancelled:
+                task = await tasks.get()
+                if task is None:
+                    break
+
+                packet = await task
+                slots.release()
+                await element.aput(packet)
+
+        finally:
+            feeder.cancel()
+            while not tasks.empty():
+                task = tasks.get_nowait()
+                if task is not None:
+                    task.cancel()
+
+
+class AsyncHttpSrc(HttpSrc):
+    """HttpSrc fetching its url without blocking the event loop"""
+
+    async def run(self):
+        buff = await http_get(self.kwargs.get("url"), self.kwargs.get("timeout"))
+        await self.aput(buff)
+        self.finish()
+
+
+class AsyncFetcherProcessor(FetcherProcessor):
+    """
+    Fetches urls on the event loop, use the concurrency kwarg to keep many
+    requests in flight
+    Parameters:
+    - fetcher: optional object with a fetch(url) method, async or not.
+      Defaults to http_get
+    - timeout: timeout in seconds for http_get
+    """
+
+    async def transform(self, url):
+        fetcher = self.kwargs.get("fetcher")
+        if fetcher is None:
+            return await http_get(url, self.kwargs.get("timeout"))
+
+        if inspect.iscoroutinefunction(fetcher.fetch):
+            return await fetcher.fetch(url)
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, fetcher.fetch, url)
@@ -1,13 +1,96 @@
-from bs4 import BeautifulSoup
+import importlib.util
 
-from .core import Transformer
+from .core import EOF, Empty, Transformer
+
+# Looked up without importing, bs4 and lxml are imported by the first Soup
+if importlib.util.find_spec("lxml") is not None:
+    DEFAULT_PARSER = "lxml"
+else:
+    DEFAULT_PARSER = "html.parser"
+
+
+def _compile_selector(selector):
+    try:
+        import soupsieve
+    except ImportError:
+        return lambda soup: soup.select(selector)
+
+    return soupsieve.compile(selector).select
 
 
 class Soup(Transformer):
-    def transform(self, buffer):
-        soup = BeautifulSoup(buffer)
+    """
+    Parses HTML buffers with BeautifulSoup
+    Parameters:
+    - selector: CSS selector, compiled once. Emits the list of matching tags
+      instead of the whole soup
+    - parser: BeautifulSoup parser, lxml if installed, html.parser otherwise
+    - parse_only: tag name, list of names or SoupStrainer. Only matching tags
+      and their contents are built, which saves time and memory when the
+      selector only looks inside them
+    - split: emit each match as its own packet
+    - output: 'tag' emits Tag objects, which keep their tree alive, 'html' or
+      'text' emit strings and free the tree right away
+    """
+
+    mutates_input = False
+    outputs = ("tag", "html", "text")
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        from bs4 import BeautifulSoup, SoupStrainer
+
+        self._soup = BeautifulSoup
+
         selector = self.kwargs.get("selector")
-        if selector:
-            return soup.select(selector)
-        else:
+        self._select = _compile_selector(selector) if selector else None
+
+        parse_only = self.kwargs.get("parse_only")
+        if parse_only is not None and not isinstance(parse_only, SoupStrainer):
+            parse_only = SoupStrainer(parse_only)
+        self._parse_only = parse_only
+
+        self.output = self.kwargs.get("output", "tag")
+        if self.output not in Soup.outputs:
+            raise ValueError(f"output must be one of {Soup.outputs}")
+
+        if self.kwargs.get("split") and self._select is None:
+            raise ValueError("split requires a selector")
+
+    def run(self):
+        if not self.kwargs.get("split"):
+            return super().run()
+
+        buffer = self.try_get()
+        if buffer is Empty:
+            return False
+        if buffer is EOF:
+            self.finish()
+
+        put = self.write_queue().put
+        for fragment in self.transform(buffer):
+            put(fragment)
+
+        return True
+
+    def transform(self, buffer):
+        soup = self._soup(
+            buffer,
+            self.kwargs.get("parser", DEFAULT_PARSER),
+            parse_only=self._parse_only,
+        )
+        if self._select is None:
             return soup
+
+        matches = self._select(soup)
+        if self.output == "tag":
+            return matches
+
+        if self.output == "html":
+            fragments = [str(m) for m in matches]
+        else:
+            fragments = [m.get_text() for m in matches]
+
+        soup.decompose()
+        return fragments
@@ -0,0 +1,393 @@
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+# Returned by Cache.lookup for keys not in the cache
+MISSING = object()
+
+
+class Cache:
+    """
+    Base class for the caches used by Transformer's cache kwarg.
+    Subclasses implement _get, _set, _clear and __len__, locking and stats
+    are handled here. Caches are thread safe and picklable, unpickled
+    copies start with their own lock.
+    """
+
+    def __init__(self, max_size=0):
+        if max_size < 0:
+            raise ValueError("max_size must be 0 or greater")
+
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def lookup(self, key):
+        """Returns the value cached for key or MISSING"""
+        with self._lock:
+            value = self._get(key)
+            if value is MISSING:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        return value
+
+    def store(self, key, value):
+        with self._lock:
+            self._set(key, value)
+
+    def clear(self):
+        with self._lock:
+            self._clear()
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size": len(self),
+        }
+
+    def _get(self, key):
+        raise NotImplementedError()
+
+    def _set(self, key, value):
+        raise NotImplementedError()
+
+    def _clear(self):
+        raise NotImplementedError()
+
+    def __len__(self):
+        raise NotImplementedError()
+
+
+class LRUCache(Cache):
+    """Evicts the least recently used entry past max_size entries"""
+
+    def __init__(self, max_size=1024):
+        super().__init__(max_size)
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def _get(self, key):
+        value = self._data.get(key, MISSING)
+        if value is not MISSING:
+            self._data.move_to_end(key)
+
+        return value
+
+    def _set(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+
+        if self.max_size and len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def _clear(self):
+        self._data.clear()
+
+
+class LFUCache(Cache):
+    """Evicts the least frequently used entry past max_size entries, the least
+    recently used one among equally used entries. All operations are O(1)
+    """
+
+    def __init__(self, max_size=1024):
+        super().__init__(max_size)
+        self._clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def _touch(self, key):
+        count = self._counts[key]
+        bucket = self._buckets[count]
+        del bucket[key]
+        if not bucket:
+            del self._buckets[count]
+            if self._min == count:
+                self._min = count + 1
+
+        self._counts[key] = count + 1
+        self._buckets.setdefault(count + 1, OrderedDict())[key] = None
+
+    def _get(self, key):
+        value = self._data.get(key, MISSING)
+        if value is not MISSING:
+            self._touch(key)
+
+        return value
+
+    def _set(self, key, value):
+        if key in self._data:
+            self._data[key] = value
+            self._touch(key)
+            return
+
+        if self.max_size and len(self._data) >= self.max_size:
+            bucket = self._buckets[self._min]
+            evicted, _ = bucket.popitem(last=False)
+            if not bucket:
+                del self._buckets[self._min]
+
+            del self._data[evicted]
+            del self._counts[evicted]
+            self.evictions += 1
+
+        self._data[key] = value
+        self._counts[key] = 1
+        self._buckets.setdefault(1, OrderedDict())[key] = None
+        self._min = 1
+
+    def _clear(self):
+        self._data = {}
+        self._counts = {}
+        # Keys by use count, each bucket in least recently used order
+        self._buckets = {}
+        self._min = 0
+
+
+class TTLCache(Cache):
+    """Entries expire ttl seconds after being stored. With max_size the oldest
+    entries are evicted first
+    """
+
+    def __init__(self, ttl, max_size=0, clock=time.monotonic):
+        if ttl <= 0:
+            raise ValueError("ttl must be greater than 0")
+
+        super().__init__(max_size)
+        self.ttl = ttl
+        self.clock = clock
+
+        # Values as (expiration, value), oldest first
+        self._data = OrderedDict()
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        # Monotonic clocks don't survive a process change
+        state["_data"] = OrderedDict()
+        return state
+
+    def __len__(self):
+        return len(self._data)
+
+    def _get(self, key):
+        item = self._data.get(key)
+        if item is None:
+            return MISSING
+
+        if item[0] <= self.clock():
+            del self._data[key]
+            self.evictions += 1
+            return MISSING
+
+        return item[1]
+
+    def _set(self, key, value):
+        now = self.clock()
+        self._data.pop(key, None)
+        self._data[key] = (now + self.ttl, value)
+
+        data = self._data
+        while data and (
+            next(iter(data.values()))[0] <= now
+            or (self.max_size and len(data) > self.max_size)
+        ):
+            data.popitem(last=False)
+            self.evictions += 1
+
+    def _clear(self):
+        self._data.clear()
+
+
+class DiskCache(Cache):
+    """
+    Persistent cache on a sqlite database, entries survive restarts and can
+    be shared by several processes. Keys and values are pickled, so keys
+    should have a stable pickle like strings, numbers or tuples of them
+    Parameters:
+    - path: database file, created if needed
+    - max_size: evict least recently used entries past max_size, 0 means no
+      limit
+    - ttl: entries expire ttl seconds after being stored
+    """
+
+    def __init__(self, path, max_size=0, ttl=None):
+        super().__init__(max_size)
+        self.path = path
+        self.ttl = ttl
+        self._connect()
+
+    def _connect(self):
+        import sqlite3
+
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache "
+            "(key BLOB PRIMARY KEY, value BLOB, stored REAL, used REAL)"
+        )
+        self._conn.commit()
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        del state["_conn"]
+        return state
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self._connect()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def _get(self, key):
+        key = pickle.dumps(key, protocol=pickle.HIGHEST_PROTOCOL)
+        row = self._conn.execute(
+            "SELECT value, stored FROM cache WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return MISSING
+
+        now = time.time()
+        if self.ttl is not None and row[1] + self.ttl <= now:
+            self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+            self._conn.commit()
+            self.evictions += 1
+            return MISSING
+
+        if self.max_size:
+            self._conn.execute("UPDATE cache SET used = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+
+        return pickle.loads(row[0])
+
+    def _set(self, key, value):
+        now = time.time()
+        self._conn.execute(
+            "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)",
+            (
+                pickle.dumps(key, protocol=pickle.HIGHEST_PROTOCOL),
+                pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL),
+                now,
+                now,
+            ),
+        )
+
+        if self.max_size:
+            cursor = self._conn.execute(
+                "DELETE FROM cache WHERE key IN "
+                "(SELECT key FROM cache ORDER BY used DESC LIMIT -1 OFFSET ?)",
+                (self.max_size,),
+            )
+            self.evictions += cursor.rowcount
+
+        self._conn.commit()
+
+    def _clear(self):
+        self._conn.execute("DELETE FROM cache")
+        self._conn.commit()
+
+    def close(self):
+        self._conn.close()
+
+
+cache_policies = {"lru": LRUCache, "lfu": LFUCache}
+
+
+def make_cache(spec):
+    """Returns a Cache for spec: None, a Cache or one of the cache_policies
+    names, which get their default size
+    """
+    if spec is None or isinstance(spec, Cache):
+        return spec
+
+    try:
+        return cache_policies[spec]()
+    except (KeyError, TypeError):
+        pass
+
+    raise ValueError(f"cache must be a Cache or one of {tuple(cache_policies)}")
+
+
+def memoize(cache, func, key=None, copy=None):
+    """Wraps func, a function of one argument, to go through cache. key maps
+    arguments to cache keys, by default they are their own key. copy, if
+    given, is applied to every value returned so callers never get the
+    cached objects themselves
+    """
+    import inspect
+
+    if inspect.iscoroutinefunction(func):
+
+        async def amemoized(x):
+            k = x if key is None else key(x)
+            value = cache.lookup(k)
+            if value is MISSING:
+                value = await func(x)
+                cache.store(k, value)
+
+            return value if copy is None else copy(value)
+
+        return amemoized
+
+    def memoized(x):
+        k = x if key is None else key(x)
+        value = cache.lookup(k)
+        if value is MISSING:
+            value = func(x)
+            cache.store(k, value)
+
+        return value if copy is None else copy(value)
+
+    return memoized
+
+
+def memoize_batch(cache, func, key=None, copy=None):
+    """Like memoize for functions taking and returning a list, func is only
+    called once with the items missing from cache, repeated ones included
+    once
+    """
+
+    def memoized(xs):
+        keys = xs if key is None else [key(x) for x in xs]
+        values = [cache.lookup(k) for k in keys]
+
+        # First index of each missing key
+        missing = {}
+        for idx, value in enumerate(values):
+            if value is MISSING:
+                missing.setdefault(keys[idx], idx)
+
+        if missing:
+            computed = dict(zip(missing, func([xs[idx] for idx in missing.values()])))
+            for k, value in computed.items():
+                cache.store(k, value)
+
+            values = [
+                computed[k] if v is MISSING else v for (k, v) in zip(keys, values)
+            ]
+
+        if copy is not None:
+            values = [copy(v) for v in values]
+
+        return values
+
+    return memoized
@@ -1,7 +1,18 @@
+import queue
+import time
+from collections import deque
+from functools import partial
+
 from ldotcommons.logging import get_logger
 
 _logger = get_logger()
 
+# Packets of these types can be shared freely, nobody can modify them
+_IMMUTABLE_TYPES = (bytes, str, int, float, complex, bool, type(None), frozenset)
+
+# Longest a partial batch waits for more packets before its reader runs
+_BATCH_LATENCY = 0.01
+
 
 class WriteError(Exception):
     pass
@@ -27,12 +38,182 @@ class EOF(Exception):
     pass
 
 
+class Channel:
+    """FIFO queue between an element output and an element input.
+
+    Backed by a deque so put and get are O(1). maxsize works as a high-water
+    mark: put never fails, but the pipeline stops running the producer while
+    the channel is full. A maxsize of 0 means unbounded.
+
+    Once attached to a pipeline the channel also drives scheduling: putting a
+    packet wakes the reader and making room on a blocked channel wakes the
+    writer. Readers in batch mode set wake to their batch size so they are
+    only woken once a whole batch is queued, or by the pipeline once the
+    packets have waited long enough.
+
+    A channel has a single writer and a single reader which may run in
+    different threads, deque append and popleft are atomic so no lock is
+    needed.
+    """
+
+    def __init__(self, maxsize=0):
+        self.maxsize = maxsize
+        self.closed = False
+        self.dropped = False
+
+        # Set when the reader has been told about EOF
+        self.eof = False
+
+        # Set when the writer has been held back because of a full channel
+        self.blocked = False
+
+        # Packets queued before the reader is woken, EOF always wakes it
+        self.wake = 1
+
+        # Monitoring counters
+        self.full_count = 0
+        self.empty_count = 0
+
+        self.writer = None
+        self.reader = None
+        self._ready = set()
+
+        self._queue = deque()
+
+    def __len__(self):
+        return len(self._queue)
+
+    def __iter__(self):
+        return iter(self._queue)
+
+    def attach(self, writer, reader, ready):
+        self.writer = writer
+        self.reader = reader
+        self._ready = ready
+
+    def put(self, packet):
+        if self.dropped:
+            return
+
+        queue = self._queue
+        queue.append(packet)
+        if len(queue) >= self.wake:
+            self._ready.add(self.reader)
+
+    def try_get(self):
+        """Pops the oldest packet without raising
+        Returns the Empty class if there is no data to read
+        Returns the EOF class if there is no data and the writer is gone
+        """
+        queue = self._queue
+        if not queue:
+            if not self.closed:
+                self.empty_count += 1
+                return Empty
+
+            # The writer may have put its last packets right before closing
+            # from another thread, check again now that closed is visible
+            if not queue:
+                self.eof = True
+                return EOF
+
+        packet = queue.popleft()
+        if self.blocked and len(queue) < self.maxsize:
+            self.blocked = False
+            self._ready.add(self.writer)
+
+        return packet
+
+    def try_get_batch(self, n):
+        """Pops up to n packets as a list without raising
+        Returns the Empty or EOF classes like try_get
+        """
+        queue = self._queue
+        if not queue:
+            return self.try_get()
+
+        if n >= len(queue):
+            packets = list(queue)
+            queue.clear()
+        else:
+            packets = [queue.popleft() for _ in range(n)]
+
+        if self.blocked and len(queue) < self.maxsize:
+            self.blocked = False
+            self._ready.add(self.writer)
+
+        return packets
+
+    def get(self):
+        """Pops the oldest packet
+        Raises Empty if there is no data to read
+        Raises EOF if there is no data and the writer is gone
+        """
+        packet = self.try_get()
+        if packet is Empty:
+            raise Empty()
+        if packet is EOF:
+            raise EOF()
+
+        return packet
+
+    def full(self):
+        return 0 < self.maxsize <= len(self._queue)
+
+    def empty(self):
+        return not self._queue
+
+    def pending(self):
+        """Returns True if the reader has something to do: read data, a batch
+        of it in batch mode, or EOF
+        """
+        return len(self._queue) >= self.wake or (self.closed and not self.eof)
+
+    def close(self):
+        """Marks the channel as having no writer"""
+        self.closed = True
+        if not self.dropped:
+            self._ready.add(self.reader)
+
+    def drop(self):
+        """Marks the channel as having no reader, packets are discarded"""
+        self.dropped = True
+        self._queue.clear()
+
+        if self.blocked and not self.closed:
+            self.blocked = False
+            self._ready.add(self.writer)
+
+    def stats(self):
+        return {
+            "size": len(self._queue),
+            "maxsize": self.maxsize,
+            "full": self.full_count,
+            "empty": self.empty_count,
+            "closed": self.closed,
+        }
+
+
 class Element:
+    # Run in the pipeline thread pool instead of the scheduler thread, meant
+    # for elements blocking on I/O. Can be overriden with the threaded kwarg.
+    threaded = False
+
+    # Whether the element may modify the packets it reads and whether it
+    # passes them on unchanged to its outputs. Used by Tee to skip copies,
+    # mutates_input can be overriden with a kwarg.
+    mutates_input = True
+    forwards_input = False
+
     def __init__(self, *args, **kwargs):
         self.args = args
         self.kwargs = kwargs
         self._name = self.kwargs.get("name", self.__class__.__name__)
 
+        for attr in ("threaded", "mutates_input"):
+            if attr in kwargs:
+                setattr(self, attr, kwargs[attr])
+
     def __str__(self):
         return f"{self.__class__.__name__}-{id(self)}"
 
@@ -44,15 +225,154 @@ class Element:
     def name(self, v):
         raise TypeError("name property is read-only")
 
+    def __getstate__(self):
+        # The pipeline the element is attached to stays behind, elements are
+        # attached again when connected on the unpickling side
+        state = self.__dict__.copy()
+        for attr in ("_container", "_read_queues", "_write_queues", "_closed_inputs"):
+            state.pop(attr, None)
+
+        return state
+
     def attach(self, container):
         self._container = container
 
+        # Channels resolved by read_queue and write_queue. Attach only runs
+        # when the element first joins a pipeline, connect drops the entries
+        # of the ports it connects again
+        self._read_queues = {}
+        self._write_queues = {}
+
+        # Inputs input_closed has been called for
+        self._closed_inputs = set()
+
+    def read_queue(self, input="default"):
+        """Returns the channel for input, resolved once and cached
+        Raises ReadError if element has no such input
+        """
+        try:
+            return self._read_queues[input]
+        except KeyError:
+            pass
+
+        q = self._read_queues[input] = self._container.get_read_queue(self, input)
+        return q
+
+    def write_queue(self, output="default"):
+        """Returns the channel for output, resolved once and cached
+        Raises WriteError if element has no such output
+        """
+        try:
+            return self._write_queues[output]
+        except KeyError:
+            pass
+
+        q = self._write_queues[output] = self._container.get_write_queue(self, output)
+        return q
+
     def get(self, input="default"):
-        packet = self._container.get_packet(self, input)
+        """Gets a packet from input
+        Raises Empty if there is not data to read
+        Raises EOF if there is no more data
+        """
+        packet = self.try_get(input)
+        if packet is Empty:
+            raise Empty()
+        if packet is EOF:
+            raise EOF()
+
+        return packet
+
+    def try_get(self, input="default"):
+        """Gets a packet from input without raising
+        Returns the Empty or EOF classes instead of raising them
+        """
+        try:
+            q = self._read_queues[input]
+        except KeyError:
+            q = self.read_queue(input)
+
+        packet = q.try_get()
+        if packet is EOF and input not in self._closed_inputs:
+            self._closed_inputs.add(input)
+            self.input_closed(input)
+
         return packet
 
+    def try_get_batch(self, n, input="default"):
+        """Gets up to n packets from input as a list without raising
+        Returns the Empty or EOF classes instead of raising them
+        """
+        packets = self.read_queue(input).try_get_batch(n)
+        if packets is EOF and input not in self._closed_inputs:
+            self._closed_inputs.add(input)
+            self.input_closed(input)
+
+        return packets
+
+    def inputs(self):
+        """Returns the names of the connected inputs"""
+        return self._container.inputs_of(self)
+
+    def input_closed(self, input):
+        """Called the first time a read from input finds EOF. Elements with
+        several inputs can override it to stop reading from that input
+        """
+
     def put(self, packet, output="default"):
-        self._container.put_packet(self, packet, output)
+        try:
+            q = self._write_queues[output]
+        except KeyError:
+            q = self.write_queue(output)
+
+        q.put(packet)
+
+    async def aget(self, input="default"):
+        """Awaits a packet from input, only available under AsyncPipeline
+        Raises EOF if there is no more data
+        """
+        while True:
+            packet = self.try_get(input)
+            if packet is EOF:
+                raise EOF()
+            if packet is not Empty:
+                return packet
+
+            await self._container.idle(self)
+
+    async def aput(self, packet, output="default"):
+        """Puts a packet into output awaiting for room if the channel is full,
+        only available under AsyncPipeline
+        """
+        q = self.write_queue(output)
+        while q.full():
+            q.blocked = True
+            if not q.full():
+                break
+
+            q.full_count += 1
+            await self._container.idle(self)
+
+        q.put(packet)
+
+    def defer(self, future):
+        """Tells the pipeline to keep going while future is pending and to run
+        this element again once it completes. Can be called from any thread.
+        """
+        self._container.defer(self, future)
+
+    def wait(self):
+        """Don't run this element again until a new packet or a deferred future
+        arrives, even if its inputs still have data
+        """
+        self._container.wait(self)
+
+    def close(self):
+        """Releases the resources held by the element, like open files or
+        connections. Called by the pipeline once the element is done, either
+        because it finished or because it got cancelled, so it may be called
+        after the element closed them itself.
+        """
 
     def finish(self):
         # _logger.debug("FINISH {}".format(self))
@@ -60,10 +380,71 @@ class Element:
 
 
 class Pipeline:
-    def __init__(self):
-        self._elements = set()
+    def __init__(self, maxsize=0, workers=None, threaded=False, profile=False):
+        # Default maxsize for channels created by connect
+        self.maxsize = maxsize
+
+        # Per element and channel metrics, see pypes.profiler
+        self.profiler = None
+        if profile:
+            from .profiler import Profiler
+
+            self.profiler = Profiler(self)
+
+        # Thread pool settings, threaded=True runs every element in the pool,
+        # otherwise only elements marked as threaded do
+        self.workers = workers
+        self.threaded = threaded
+        self._executor = None
+
+        # Elements running in the thread pool and futures deferred by
+        # elements. Completions from other threads arrive through _events as
+        # (element, future) tuples
+        self._inflight = set()
+        self._deferred = set()
+        self._events = queue.SimpleQueue()
+
+        # Elements that asked not to be run until woken and elements woken
+        # by a deferred future while running in the thread pool
+        self._waiting = set()
+        self._woken = set()
+
+        # Elements given their last run after reading EOF from every input,
+        # see _drained
+        self._last_runs = set()
+
+        # Elements running in the thread pool when they got cancelled,
+        # disconnected once their run completes
+        self._cancelled = set()
+
+        # Elements waiting to be disconnected by the disconnect call in
+        # progress, None outside of it
+        self._disconnecting = None
+
+        # Used as an ordered set, insertion order breaks ties in the
+        # scheduling order
+        self._elements = {}
         self._table = {}
 
+        # Reverse of _table, each element is registered under a single name.
+        # Next suffix to try for each duplicated name
+        self._names = {}
+        self._name_suffixes = {}
+
+        # Elements with something to do, fed by channel events
+        self._ready = set()
+
+        # Scheduling plan, rebuilt by _prepare after any connect
+        self._order = None
+        self._inputs = {}
+        self._outputs = {}
+
+        # Input channels of batch mode elements, when each one was first
+        # seen holding a partial batch and when to look at them again
+        self._batched = []
+        self._partial = {}
+        self._next_expiry = 0
+
         # Dict of queues using src element has key
         self._queues = {}
 
@@ -76,22 +457,36 @@ class Pipeline:
         # Relations between sinks and srcs
         self._rev_rels = {}
 
+        # Connected outputs and inputs of each element, used as ordered sets,
+        # so the dicts above can be updated without scanning them
+        self._src_ports = {}
+        self._sink_ports = {}
+
+        # All channels ever created as (src, output, sink, input, channel),
+        # kept after execution for monitoring
+        self._channels = []
+
     def _insert(self, element):
-        self._elements.add(element)
+        self._elements[element] = None
+        self._ready.add(element)
+        if element in self._names:
+            return
+
         element.attach(self)
 
-        i = 0
-        while True:
-            key = element.name
-            if i > 0:
-                key += f"-{i}"
-            if key not in self._table:
-                break
+        key = base = element.name
+        i = self._name_suffixes.get(base, 0)
+        while key in self._table:
             i += 1
+            key = f"{base}-{i}"
 
+        self._name_suffixes[base] = i
         self._table[key] = element
+        self._names[element] = key
 
-    def connect(self, src, sink, src_output="default", sink_input="default"):
+    def connect(
+        self, src, sink, src_output="default", sink_input="default", maxsize=None
+    ):
         for e, etype in [(src, "src"), (sink, "sink")]:
             if not isinstance(e, Element):
                 raise Exception(f"{etype} '{e}' is not a pypes element")
@@ -100,12 +495,20 @@ class Pipeline:
         self._insert(src)
         self._insert(sink)
 
-        q = []
+        q = Channel(self.maxsize if maxsize is None else maxsize)
+        q.attach(src, sink, self._ready)
+        src._write_queues.pop(src_output, None)
+        sink._read_queues.pop(sink_input, None)
         self._queues[(src, src_output)] = q
         self._rev_queues[(sink, sink_input)] = q
 
         self._rels[(src, src_output)] = (sink, sink_input)
         self._rev_rels[(sink, sink_input)] = (src, src_output)
+        self._src_ports.setdefault(src, {})[src_output] = None
+        self._sink_ports.setdefault(sink, {})[sink_input] = None
+
+        self._channels.append((src, src_output, sink, sink_input, q))
+        self._order = None
 
         # _logger.debug("CONNECT [{}::{}] -> [{}::{}]".format(src, src_output, sink, sink_input))
 
@@ -120,6 +523,114 @@ class Pipeline:
     def get(self, *args, **kwargs):
         return self._table.get(*args, **kwargs)
 
+    def inputs_of(self, element):
+        """Returns the names of element's connected inputs"""
+        return list(self._sink_ports.get(element, ()))
+
+    def name_of(self, element):
+        """Returns the name element is registered with, which differs from
+        element.name when several elements share it
+        """
+        return self._names.get(element)
+
+    def _fusible(self, element, n_inputs, n_outputs):
+        # inspect pulls ast and tokenize, it's only needed when compiling
+        import inspect
+
+        return (
+            isinstance(element, (Transformer, Filter))
+            and type(element).run in (Transformer.run, Filter.run)
+            and not inspect.iscoroutinefunction(getattr(element, "transform", None))
+            and not element.threaded
+            and n_inputs.get(element) == 1
+            and n_outputs.get(element) == 1
+            and (element, "default") in self._rev_rels
+            and (element, "default") in self._rels
+        )
+
+    def compile(self):
+        """Fuses runs of single input, single output Transformers and Filters
+        into FusedStage elements, removing the channels between them.
+        Original elements are still available from get() and reported by
+        the profiler. Must be called before execution, chains with pending
+        packets between their elements are left alone.
+        """
+        n_inputs, n_outputs = {}, {}
+        for sink, _ in self._rev_rels:
+            n_inputs[sink] = n_inputs.get(sink, 0) + 1
+        for src, _ in self._rels:
+            n_outputs[src] = n_outputs.get(src, 0) + 1
+
+        fusible = {e for e in self._elements if self._fusible(e, n_inputs, n_outputs)}
+
+        def next_stage(element):
+            sink, input = self._rels[(element, "default")]
+            if (
+                sink in fusible
+                and input == "default"
+                and self._queues[(element, "default")].empty()
+            ):
+                return sink
+
+        # Chain heads are fusible elements not fed by another chain member
+        tails = {next_stage(e) for e in fusible} - {None}
+        for head in [e for e in self._elements if e in fusible and e not in tails]:
+            chain = [head]
+            while (n := next_stage(chain[-1])) is not None:
+                chain.append(n)
+
+            if len(chain) > 1:
+                self._fuse(chain)
+
+        return self
+
+    def _fuse(self, chain):
+        first, last = chain[0], chain[-1]
+        fused = FusedStage(chain, name="+".join(self.name_of(e) for e in chain))
+
+        src, output = self._rev_rels[(first, "default")]
+        sink, input = self._rels[(last, "default")]
+        q_in = self._rev_queues[(first, "default")]
+        q_out = self._queues[(last, "default")]
+
+        inner = {id(self._queues[(e, "default")]) for e in chain[:-1]}
+        for e in chain:
+            self._queues.pop((e, "default"))
+            self._rev_queues.pop((e, "default"))
+            self._rels.pop((e, "default"))
+            self._rev_rels.pop((e, "default"))
+            del self._src_ports[e]
+            del self._sink_ports[e]
+            del self._elements[e]
+            self._ready.discard(e)
+
+        self._insert(fused)
+        self._src_ports[fused] = {"default": None}
+        self._sink_ports[fused] = {"default": None}
+
+        q_in.attach(src, fused, self._ready)
+        q_out.attach(fused, sink, self._ready)
+
+        self._queues[(fused, "default")] = q_out
+        self._rev_queues[(fused, "default")] = q_in
+        self._rels[(src, output)] = (fused, "default")
+        self._rels[(fused, "default")] = (sink, input)
+        self._rev_rels[(fused, "default")] = (src, output)
+        self._rev_rels[(sink, input)] = (fused, "default")
+
+        channels = []
+        for c in self._channels:
+            if id(c[4]) in inner:
+                continue
+            if c[4] is q_in:
+                c = (src, output, fused, "default", q_in)
+            elif c[4] is q_out:
+                c = (fused, "default", sink, input, q_out)
+            channels.append(c)
+
+        self._channels = channels
+        self._order = None
+
     def get_write_queue(self, element, name="default"):
         try:
             return self._queues[(element, name)]
@@ -164,7 +675,7 @@ class Pipeline:
                 f"Combination of '{src}' and queue '{output}' has no matching"
             )
 
-        self.get_write_queue(src, output).append(packet)
+        self.get_write_queue(src, output).put(packet)
 
     def get_packet(self, sink, input="default"):
         """Gets a packet for the sink:input pair from the pipeline flow
@@ -180,95 +691,713 @@ class Pipeline:
         if not self.is_sink(sink, input):
             raise ReadError()
 
-        try:
-            packet = self.get_read_queue(sink, input).pop(0)
-            # _logger.debug("GET [{}] <- {}::{}".format(sink, input, packet))
-            return packet
+        return self.get_read_queue(sink, input).get()
 
-        except IndexError:
-            pass
+    def may_mutate(self, element, _seen=None):
+        """Returns True if element, or any element it forwards its input packets
+        to, may modify them
+        """
+        if element.mutates_input:
+            return True
 
-        # Check if queue has reached EOF
-        (src, output) = self.src_for(sink, input)
-        if (src, output) not in self._queues:
-            raise EOF()
-        else:
-            raise Empty()
+        if not element.forwards_input:
+            return False
 
-    def disconnect(self, element):
-        self._queues = {k: v for (k, v) in self._queues.items() if k[0] != element}
-        self._rev_queues = {
-            k: v for (k, v) in self._rev_queues.items() if k[0] != element
-        }
+        seen = set() if _seen is None else _seen
+        if element in seen:
+            return False
+        seen.add(element)
 
-        self._rels = {k: v for (k, v) in self._rels.items() if k[0] != element}
-        self._rev_rels = {k: v for (k, v) in self._rev_rels.items() if k[0] != element}
+        return any(
+            self.may_mutate(self._rels[(element, output)][0], seen)
+            for output in self._src_ports.get(element, ())
+        )
+
+    def queue_stats(self):
+        """Returns a list of dicts describing the state of each channel"""
+        return [
+            dict(
+                src=self.name_of(src),
+                output=output,
+                sink=self.name_of(sink),
+                input=input,
+                **q.stats(),
+            )
+            for (src, output, sink, input, q) in self._channels
+        ]
+
+    def disconnect(self, element):
+        # Disconnects caused by this one, like cancellations, are queued and
+        # run by the outermost call so long chains don't hit the recursion
+        # limit
+        if self._disconnecting is not None:
+            self._disconnecting.append(element)
+            return
+
+        self._disconnecting = [element]
+        try:
+            while self._disconnecting:
+                element = self._disconnecting.pop()
+                if element in self._elements:
+                    self._disconnect(element)
+
+        finally:
+            self._disconnecting = None
+
+    def _disconnect(self, element):
+        # Readers of element's outputs will get EOF once they drain them and
+        # writers to element's inputs have their packets discarded
+        for output in self._src_ports.pop(element, ()):
+            self._queues.pop((element, output)).close()
+            del self._rels[(element, output)]
+
+        dropped = []
+        for input in self._sink_ports.pop(element, ()):
+            q = self._rev_queues.pop((element, input))
+            q.drop()
+            dropped.append(q)
+            del self._rev_rels[(element, input)]
 
         # Elements are removed from _elements list but not from _table because they must be available even after execution
-        self._elements.remove(element)
-        # self._table = {k: v for (k, v) in self._table.items() if v != element}
+        del self._elements[element]
+        self._ready.discard(element)
+        self._waiting.discard(element)
+        self._woken.discard(element)
+        self._cancelled.discard(element)
+        self._last_runs.discard(element)
+
+        element.close()
+
+        # Cancellation travels upstream: producers whose packets nobody
+        # reads anymore are finished too
+        for q in dropped:
+            if q.writer in self._elements and not self._has_readers(q.writer):
+                self.cancel(q.writer)
+
+    def _has_readers(self, element):
+        return any(
+            not self._queues[(element, output)].dropped
+            for output in self._src_ports.get(element, ())
+        )
 
-    def run(self):
-        finished = []
+    def cancel(self, element):
+        """Finishes element from outside, like when its outputs lost their
+        readers. Elements running in the thread pool are disconnected once
+        their current run completes.
+        """
+        if element in self._inflight:
+            self._cancelled.add(element)
+        else:
+            self.disconnect(element)
 
+    def _prepare(self):
+        """Computes per element channel lists and a topological order of the graph.
+        Elements inside cycles are appended in insertion order.
+        """
+        self._inputs = {e: [] for e in self._elements}
+        self._outputs = {e: [] for e in self._elements}
+        for src, _, sink, _, q in self._channels:
+            if src in self._elements and sink in self._elements:
+                self._outputs[src].append(q)
+                self._inputs[sink].append(q)
+
+        sinks = {e: [] for e in self._elements}
+        degree = {e: 0 for e in self._elements}
+        for (src, _), (sink, _) in self._rels.items():
+            sinks[src].append(sink)
+            degree[sink] += 1
+
+        # Transformers may hand the same result to several packets, like
+        # cached ones, which is only safe while nothing downstream modifies
+        # them
         for element in self._elements:
+            if isinstance(element, FusedStage):
+                stages = element.stages
+            else:
+                stages = [element]
+
+            mutated = any(self.may_mutate(sink) for sink in sinks[element])
+            for stage in reversed(stages):
+                if isinstance(stage, Transformer):
+                    stage._share_results = not mutated
+                mutated = mutated or stage.mutates_input
+
+        order = []
+        pending = deque(e for e in self._elements if degree[e] == 0)
+        while pending:
+            element = pending.popleft()
+            order.append(element)
+            for sink in sinks[element]:
+                degree[sink] -= 1
+                if degree[sink] == 0:
+                    pending.append(sink)
+
+        if len(order) < len(self._elements):
+            seen = set(order)
+            order.extend(e for e in self._elements if e not in seen)
+
+        self._order = order
+
+        # What run checks for each element in order, resolved once: the
+        # output channels that may hold it back, only bounded ones can, its
+        # input channels and whether it runs in the thread pool
+        self._plan = [
+            (
+                e,
+                e.run if self.profiler is None else partial(self.profiler.run, e),
+                [q for q in self._outputs[e] if q.maxsize > 0],
+                self._inputs[e],
+                self.threaded or e.threaded,
+            )
+            for e in order
+        ]
+
+    def _batch_wakeups(self):
+        """Makes the input channels of elements in batch mode wake them once
+        a batch worth of packets is queued instead of on every packet
+        """
+        self._batched = []
+        for element, inputs in self._inputs.items():
+            if not isinstance(element, (Transformer, Filter, FusedStage)):
+                continue
+
+            for q in inputs:
+                q.wake = max(1, element.batch_size)
+                if q.wake > 1:
+                    self._batched.append(q)
+
+            # Not even the first run takes a partial batch
+            if inputs and not any(q.pending() for q in inputs):
+                self._ready.discard(element)
+
+    def _expire_batches(self, now):
+        """Wakes the readers of partial batches waiting for longer than
+        _BATCH_LATENCY, returns the seconds until the next one expires or
+        None if there are none left. Partial batches are timed from the
+        first call seeing them, run calls it every half _BATCH_LATENCY
+        """
+        self._next_expiry = now + _BATCH_LATENCY / 2
+        timeout = None
+        for q in self._batched:
+            if not 0 < len(q) < q.wake:
+                self._partial.pop(q, None)
+                continue
+
+            left = self._partial.setdefault(q, now) + _BATCH_LATENCY - now
+            if left <= 0:
+                del self._partial[q]
+                self._ready.add(q.reader)
+            elif timeout is None or left < timeout:
+                timeout = left
+
+        return timeout
+
+    def _flush_batches(self):
+        """Wakes the readers of partial batches, returns True if any"""
+        flushed = False
+        for element, inputs in self._inputs.items():
+            if element in self._elements and any(0 < len(q) < q.wake for q in inputs):
+                self._ready.add(element)
+                flushed = True
+
+        return flushed
+
+    def defer(self, element, future):
+        self._deferred.add(future)
+        future.add_done_callback(lambda f: self._events.put((element, f)))
+
+    def wait(self, element):
+        self._waiting.add(element)
+
+    def _reschedule(self, element):
+        if element in self._woken:
+            self._woken.discard(element)
+            self._waiting.discard(element)
+            self._ready.add(element)
+            return
+
+        if element in self._waiting:
+            self._waiting.discard(element)
+            return
+
+        # Sources are always willing to run, other elements only while
+        # their inputs have data or an unseen EOF
+        inputs = self._inputs[element]
+        if not inputs:
+            self._ready.add(element)
+            return
+
+        for q in inputs:
+            if q.pending():
+                self._ready.add(element)
+                return
+
+        if self._drained(element, inputs):
+            self._ready.add(element)
+
+    def _drained(self, element, inputs):
+        """Returns True the first time element goes idle after reading EOF
+        from every input without finishing. Nothing would wake it again, it
+        gets one last run to finish like the round-robin loop allowed
+        """
+        if element in self._last_runs or not all(q.eof for q in inputs):
+            return False
+
+        self._last_runs.add(element)
+        return True
+
+    def _held_back(self, outputs):
+        """Returns True if some of outputs is full, flagging it as blocked so
+        its reader wakes the writer once it makes room. The channel is checked
+        again after flagging it because the reader may be running in another
+        thread. Readers waiting for a batch larger than the channel are woken
+        to take what there is.
+        """
+        blocked = False
+        for q in outputs:
+            if q.full():
+                q.blocked = True
+                if q.full():
+                    q.full_count += 1
+                    blocked = True
+                    self._ready.add(q.reader)
+                else:
+                    q.blocked = False
+
+        return blocked
+
+    def _submit(self, element):
+        if self._executor is None:
+            # Slow to import, only paid for by pipelines using the pool
+            from concurrent.futures import ThreadPoolExecutor
+
+            self._executor = ThreadPoolExecutor(max_workers=self.workers)
+
+        self._inflight.add(element)
+        if self.profiler is None:
+            future = self._executor.submit(element.run)
+        else:
+            future = self._executor.submit(self.profiler.run, element)
+        future.add_done_callback(lambda f: self._events.put((element, f)))
+
+    def _process_events(self, finished, block=False, timeout=None):
+        events = self._events
+        while block or not events.empty():
             try:
-                element.run()
-            except Finish:
+                element, future = events.get(timeout=timeout)
+            except queue.Empty:
+                return
+
+            block = False
+
+            if future in self._deferred:
+                self._deferred.discard(future)
+                if element in self._inflight:
+                    self._woken.add(element)
+                elif element in self._elements:
+                    self._waiting.discard(element)
+                    self._ready.add(element)
+                continue
+
+            self._inflight.discard(element)
+            exc = future.exception()
+            if isinstance(exc, Finish) or (exc is None and element in self._cancelled):
                 finished.append(element)
+            elif exc is not None:
+                raise exc
+            else:
+                self._reschedule(element)
+
+    def _abort(self):
+        """Waits for the runs in the thread pool and disconnects, closing
+        them, the elements left
+        """
+        self._shutdown()
+        for element in list(self._elements):
+            self.disconnect(element)
 
+    def _shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def run(self):
+        """Runs one scheduling pass over ready elements in topological order.
+        Returns False once all elements have finished or nothing can progress.
+        """
+        if self._order is None:
+            self._prepare()
+            self._batch_wakeups()
+
+        ready = self._ready
+        inflight = self._inflight
+        waiting = self._waiting
+        woken = self._woken
+        finished = []
+
+        self._process_events(finished)
         for element in finished:
             self.disconnect(element)
 
-        return len(self._elements) > 0
+        for element, run, outputs, inputs, threaded in self._plan:
+            if element not in ready:
+                continue
+
+            ready.discard(element)
+
+            # Rescheduled once its current run completes
+            if threaded and element in inflight:
+                continue
+
+            # Producers with some full output channel are held back until
+            # their readers make room
+            if outputs and self._held_back(outputs):
+                continue
+
+            if threaded:
+                self._submit(element)
+                continue
+
+            try:
+                run()
+            except Finish:
+                # Readers later in the order see EOF during this same pass,
+                # so a chain is torn down in one pass
+                self.disconnect(element)
+                continue
+
+            # Same as _reschedule, with Channel.pending inlined, for the
+            # common case of no waiting or woken elements
+            if waiting or woken:
+                self._reschedule(element)
+            elif not inputs:
+                ready.add(element)
+            else:
+                for q in inputs:
+                    if len(q._queue) >= q.wake or (q.closed and not q.eof):
+                        ready.add(element)
+                        break
+                else:
+                    # Cheap test first, inputs are usually still open
+                    if q.eof and self._drained(element, inputs):
+                        ready.add(element)
+
+        # Nothing else to do, wait for some thread to complete
+        block = not ready and not finished and (inflight or self._deferred)
+
+        # Readers of partial batches that waited too long, like behind an
+        # idle source, run on the next pass. Blocking waits for them too
+        timeout = None
+        if self._batched:
+            now = time.monotonic()
+            if block or now >= self._next_expiry:
+                timeout = self._expire_batches(now)
+                block = block and not ready
+
+        if block:
+            self._process_events(finished, block=True, timeout=timeout)
+            for element in finished:
+                self.disconnect(element)
+
+        if not self._elements:
+            self._shutdown()
+            return False
+
+        # Disconnected elements are skipped, they are only dropped from the
+        # plan once they are most of it
+        if len(self._plan) > 2 * len(self._elements):
+            self._order = [e for e in self._order if e in self._elements]
+            self._plan = [p for p in self._plan if p[0] in self._elements]
+
+        if not ready and not inflight and not self._deferred:
+            # Writers went idle without closing their outputs, like inside
+            # cycles, batch mode readers take the partial batches left
+            if self._flush_batches():
+                return True
+
+            self._shutdown()
+            _logger.warning(
+                "Pipeline stalled with unfinished elements: "
+                + ", ".join(str(e) for e in self._elements)
+            )
+            return False
+
+        return True
 
     def execute(self):
-        while self.run():
-            pass
+        try:
+            while self.run():
+                pass
+
+        finally:
+            # Elements left by an error or a stall still hold resources like
+            # files or sockets
+            self._abort()
+
+        if self.profiler is not None:
+            _logger.info("Pipeline profile:\n" + self.profiler.report())
 
 
 class Transformer(Element):
     """Transformer implements common functionality for elements with one input and one output
     Derived classes must implement the 'transform' method instead of the 'run' one.
+
+    Passing batch_size=N (N > 1) makes the transformer drain up to N packets
+    per run and hand them to 'transform_batch'. Derived classes can override
+    it with a vectorized version, the default one calls 'transform' on each
+    packet. Pipeline only runs it once N packets are queued, its input is
+    closed, the upstream element is held back by a full channel or the
+    queued packets have been waiting for about 10 ms.
+
+    Passing cache=C memoizes 'transform' (and 'transform_batch' when
+    overriden) with C, a pypes.cache.Cache or one of 'lru' and 'lfu'.
+    Packets are their own keys unless cache_key=func maps them to hashable
+    ones. Each packet gets a shallow copy of the cached result, unless the
+    pipeline finds that no element downstream modifies packets.
     """
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.batch_size = self.kwargs.get("batch_size", 1)
+        self.cache = self.kwargs.get("cache")
+        if self.cache is not None:
+            from .cache import make_cache
+
+            self.cache = make_cache(self.cache)
+
+        # Set by the pipeline when no element downstream modifies packets
+        self._share_results = False
+
+        self._memoize()
+
+    def _memoize(self):
+        if self.cache is None:
+            return
+
+        from .cache import memoize, memoize_batch
+
+        key = self.kwargs.get("cache_key")
+        self.transform = memoize(self.cache, self.transform, key, self._copy_shared)
+
+        # The default transform_batch already goes through transform
+        if type(self).transform_batch is not Transformer.transform_batch:
+            self.transform_batch = memoize_batch(
+                self.cache, self.transform_batch, key, self._copy_shared
+            )
+
+    def _copy_shared(self, value):
+        """Returns a shallow copy of value, a result handed to several
+        packets, unless no element downstream modifies packets
+        """
+        if self._share_results or isinstance(value, _IMMUTABLE_TYPES):
+            return value
+
+        from copy import copy
+
+        return copy(value)
+
+    def __getstate__(self):
+        # Memoized methods are closures, rebuilt on unpickling
+        state = super().__getstate__()
+        state.pop("transform", None)
+        state.pop("transform_batch", None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._memoize()
+
     def run(self):
-        try:
-            packet = self.get()
-            self.put(self.transform(packet))
+        if self.batch_size > 1:
+            return self.run_batch(self.batch_size)
 
-        except Empty:
+        packet = self.try_get()
+        if packet is Empty:
             return False
+        if packet is EOF:
+            self.finish()
+
+        self.put(self.transform(packet))
+        return True
 
-        except EOF:
+    def run_batch(self, n):
+        packets = self.try_get_batch(n)
+        if packets is Empty:
+            return False
+        if packets is EOF:
             self.finish()
 
+        put = self.write_queue().put
+        for packet in self.transform_batch(packets):
+            put(packet)
+
+        return True
+
     def transform(self, input):
         """Apply whatever is needed and return the transformed value"""
         raise Exception("Not implemented")
 
+    def transform_batch(self, inputs):
+        """Returns an iterable with the transformed values of inputs"""
+        return [self.transform(x) for x in inputs]
+
 
 class Filter(Element):
     """
     Filter allows to write elements with similar functionality to the builtins.filter method
     Derived classes must implement the 'filter' function with similar behaviour to  builtins.filter
+
+    Like Transformer, batch_size=N enables batch mode using 'filter_batch'.
     """
 
+    mutates_input = False
+    forwards_input = True
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.batch_size = self.kwargs.get("batch_size", 1)
+
     def run(self):
-        try:
-            packet = self.get()
-            if self.filter(packet):
-                self.put(packet)
-                return True
-            else:
-                return False
+        if self.batch_size > 1:
+            return self.run_batch(self.batch_size)
 
-        except Empty:
+        packet = self.try_get()
+        if packet is Empty:
             return False
+        if packet is EOF:
+            self.finish()
+
+        if self.filter(packet):
+            self.put(packet)
+            return True
+        else:
+            return False
+
+    def run_batch(self, n):
+        packets = self.try_get_batch(n)
+        if packets is Empty:
+            return False
+        if packets is EOF:
+            self.finish()
+
+        put = self.write_queue().put
+        for packet in self.filter_batch(packets):
+            put(packet)
 
-        except EOF:
-            raise self.finish()
+        return True
 
     def filter(self, x):
         """Returns True if x must pass, False elsewhere"""
         raise Exception("Not implemented")
+
+    def filter_batch(self, xs):
+        """Returns an iterable with the items from xs that must pass"""
+        return [x for x in xs if self.filter(x)]
+
+
+class FusedStage(Element):
+    """
+    Runs a chain of Transformers and Filters as a single element, built by
+    Pipeline.compile. Packets go through the stages' transform and filter
+    methods (or their batch versions if some stage has batch_size > 1)
+    without touching any channel in between. When profiling, each stage is
+    accounted on its own and the fused element isn't reported.
+    """
+
+    def __init__(self, stages, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.stages = stages
+        self.batch_size = max(s.batch_size for s in stages)
+        self.mutates_input = any(s.mutates_input for s in stages)
+        self.forwards_input = any(s.forwards_input for s in stages)
+
+        self._funcs = [
+            (True, s.filter) if isinstance(s, Filter) else (False, s.transform)
+            for s in stages
+        ]
+        self._batch_funcs = [
+            s.filter_batch if isinstance(s, Filter) else s.transform_batch
+            for s in stages
+        ]
+
+    def close(self):
+        for stage in self.stages:
+            stage.close()
+
+    def run(self):
+        if self.batch_size > 1:
+            return self.run_batch(self.batch_size)
+
+        packet = self.try_get()
+        if packet is Empty:
+            return False
+        if packet is EOF:
+            self.finish()
+
+        if self._container.profiler is not None:
+            return self._run_profiled(packet, self._container.profiler)
+
+        for is_filter, func in self._funcs:
+            if is_filter:
+                if not func(packet):
+                    return True
+            else:
+                packet = func(packet)
+
+        self.put(packet)
+        return True
+
+    def _run_profiled(self, packet, profiler):
+        # Accounts each stage as if it was running on its own
+        for stage, (is_filter, func) in zip(self.stages, self._funcs):
+            wall, cpu = time.perf_counter(), time.thread_time()
+            if is_filter:
+                passed = func(packet)
+            else:
+                packet, passed = func(packet), True
+
+            profiler.record(
+                stage,
+                time.perf_counter() - wall,
+                time.thread_time() - cpu,
+                1,
+                int(passed),
+            )
+            if not passed:
+                return True
+
+        self.put(packet)
+        return True
+
+    def run_batch(self, n):
+        packets = self.try_get_batch(n)
+        if packets is Empty:
+            return False
+        if packets is EOF:
+            self.finish()
+
+        profiler = self._container.profiler
+        for stage, func in zip(self.stages, self._batch_funcs):
+            if profiler is None:
+                packets = list(func(packets))
+            else:
+                n_in = len(packets)
+                wall, cpu = time.perf_counter(), time.thread_time()
+                packets = list(func(packets))
+                profiler.record(
+                    stage,
+                    time.perf_counter() - wall,
+                    time.thread_time() - cpu,
+                    n_in,
+                    len(packets),
+                )
+
+            if not packets:
+                return True
+
+        put = self.write_queue().put
+        for packet in packets:
+            put(packet)
+
+        return True
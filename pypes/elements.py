@@ -1,28 +1,52 @@
+import copy
 import pickle
-from urllib.request import urlopen
+from collections import deque
 
-from ldotcommons.utils import get_debugger
-
-from .core import EOF, Element, Empty, Filter, Transformer
+from .core import EOF, Element, Empty, Filter, Transformer, _IMMUTABLE_TYPES
+from .spill import SpillBuffer, dump_packets, load_packets
 
 
 class Adder(Transformer):
+    mutates_input = False
+
     def transform(self, x):
         return x + self.kwargs.get("amount", 0)
 
+    def transform_batch(self, xs):
+        amount = self.kwargs.get("amount", 0)
+        return [x + amount for x in xs]
+
 
 class CustomTransformer(Transformer):
-    def __init__(self, func=None, *args, **kwargs):
+    """
+    Applies func to each packet
+    Parameters:
+    - func: callable for single packets
+    - batch_func: optional callable taking and returning a list of packets,
+      used in batch mode instead of calling func on each packet
+    """
+
+    def __init__(self, func=None, *args, batch_func=None, **kwargs):
         super().__init__(*args, **kwargs)
 
         if not callable(func):
             raise ValueError("func is not a callable")
 
+        if batch_func is not None and not callable(batch_func):
+            raise ValueError("batch_func is not a callable")
+
         self.func = func
+        self.batch_func = batch_func
 
     def transform(self, input):
         return self.func(input)
 
+    def transform_batch(self, inputs):
+        if self.batch_func is not None:
+            return self.batch_func(inputs)
+
+        return list(map(self.func, inputs))
+
 
 class CustomFilter(Filter):
     def __init__(self, func=None, *args, **kwargs):
@@ -39,18 +63,19 @@ class CustomFilter(Filter):
 
 class Debugger(Element):
     def run(self):
-        get_debugger().set_trace()
+        from ldotcommons.utils import get_debugger
 
-        try:
-            self.put(self.get())
-            return True
+        get_debugger().set_trace()
 
-        except Empty:
+        packet = self.try_get()
+        if packet is Empty:
             return False
-
-        except EOF:
+        if packet is EOF:
             self.finish()
 
+        self.put(packet)
+        return True
+
 
 class DictFixer(Transformer):
     """
@@ -75,8 +100,32 @@ class DictFixer(Transformer):
         packet.update(values)
         return packet
 
+    def transform_batch(self, packets):
+        override = self.kwargs.get("override", False)
+        values = self.kwargs.get("values", {})
+
+        for packet in packets:
+            if not isinstance(packet, dict):
+                raise ValueError("Packet is not a dict object")
+
+            if override:
+                packet.update(values)
+            else:
+                for key, value in values.items():
+                    packet.setdefault(key, value)
+
+        return packets
+
 
 class DictFilter(Transformer):
+    mutates_input = False
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # Without keys packets are passed on as they are
+        self.forwards_input = self.kwargs.get("keys") is None
+
     def transform(self, packet):
         if not isinstance(packet, dict):
             raise ValueError("Packet is not a dict object")
@@ -87,8 +136,78 @@ class DictFilter(Transformer):
 
         return {key: value for (key, value) in packet.items() if key in keys}
 
+    def transform_batch(self, packets):
+        for packet in packets:
+            if not isinstance(packet, dict):
+                raise ValueError("Packet is not a dict object")
+
+        keys = self.kwargs.get("keys", None)
+        if keys is None:
+            return packets
+
+        keys = set(keys)
+        return [
+            {key: value for (key, value) in packet.items() if key in keys}
+            for packet in packets
+        ]
+
 
 class FetcherProcessor(Transformer):
+    """
+    Fetches urls with a fetcher object
+    Parameters:
+    - fetcher: object with a fetch(url) method
+    - concurrency: number of urls in flight at once, results keep input order
+    """
+
+    threaded = True
+    mutates_input = False
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._executor = None
+        self._pending = deque()
+        self._eof = False
+
+    def run(self):
+        concurrency = self.kwargs.get("concurrency", 1)
+        if concurrency <= 1:
+            return super().run()
+
+        if self._executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+
+            self._executor = ThreadPoolExecutor(max_workers=concurrency)
+
+        while not self._eof and len(self._pending) < concurrency:
+            url = self.try_get()
+            if url is Empty:
+                break
+            if url is EOF:
+                self._eof = True
+                break
+
+            future = self._executor.submit(self.transform, url)
+            self._pending.append(future)
+            self.defer(future)
+
+        while self._pending and self._pending[0].done():
+            self.put(self._pending.popleft().result())
+
+        if self._pending:
+            # Completions will wake us up
+            self.wait()
+
+        elif self._eof:
+            self._executor.shutdown()
+            self.finish()
+
+        return True
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
     def transform(self, url):
         return self.kwargs.get("fetcher").fetch(url)
 
@@ -113,25 +232,134 @@ class GeneratorSrc(Element):
         except StopIteration:
             self.finish()
 
+    def close(self):
+        # Runs the generator's cleanup code if it didn't finish
+        close = getattr(self.g, "close", None)
+        if close is not None:
+            close()
+
 
 class Head(Filter):
+    """
+    Passes the first n packets, all of them if n is -1. Finishes as soon as
+    n packets went through, which cancels the elements feeding it
+    """
+
     def __init__(self, n=-1, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.n = n
         self.i = 0
 
+    def run(self):
+        if self.n != -1 and self.i >= self.n:
+            self.finish()
+
+        r = super().run()
+        if self.n != -1 and self.i >= self.n:
+            self.finish()
+
+        return r
+
     def filter(self, packet):
         r = self.n == -1 or self.i < self.n
         self.i += 1
 
         return r
 
+    def filter_batch(self, packets):
+        if self.n == -1:
+            return packets
+
+        remaining = max(self.n - self.i, 0)
+        self.i += len(packets)
+
+        return packets[:remaining]
+
 
 class HttpSrc(Element):
+    """
+    Fetches url
+    Parameters:
+    - url: url to fetch
+    - chunk_size: emit the body in chunks of up to chunk_size bytes as it
+      arrives instead of a single packet
+    See pypes.net.HttpFetcher to fetch many urls
+    """
+
+    threaded = True
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._response = None
+
+    def close(self):
+        if self._response is not None:
+            self._response.close()
+
     def run(self):
-        buff = urlopen(self.kwargs.get("url")).read()
+        # urllib.request pulls http.client, email and ssl, import on use
+        from urllib.request import urlopen
+
+        chunk_size = self.kwargs.get("chunk_size", -1)
+        if chunk_size == -1:
+            with urlopen(self.kwargs.get("url")) as fh:
+                buff = fh.read()
+
+            self.put(buff)
+            self.finish()
+
+        if self._response is None:
+            self._response = urlopen(self.kwargs.get("url"))
+
+        buff = self._response.read(chunk_size)
+        if not buff:
+            self.close()
+            self.finish()
+
         self.put(buff)
-        self.finish()
+        return True
+
+
+class Merge(Element):
+    """
+    Forwards packets from all its inputs, whatever their names, taking them
+    from whichever inputs have data. Order is kept within each input but not
+    across them. Finishes once every input is exhausted
+    """
+
+    mutates_input = False
+    forwards_input = True
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._open = None
+
+    def attach(self, container):
+        super().attach(container)
+        self._open = None
+
+    def input_closed(self, input):
+        self._open.remove(input)
+
+    def run(self):
+        if self._open is None:
+            self._open = self.inputs()
+
+        put = self.write_queue().put
+        progress = False
+
+        # One packet per input and run, so a busy input can't starve the
+        # others and full outputs still hold us back
+        for input in list(self._open):
+            packet = self.try_get(input)
+            if packet is not Empty and packet is not EOF:
+                put(packet)
+                progress = True
+
+        if not self._open:
+            self.finish()
+
+        return progress
 
 
 class NullSrc(Element):
@@ -140,74 +368,172 @@ class NullSrc(Element):
 
 
 class NullSink(Element):
-    def run(self):
-        try:
-            self.get()
-            return True
+    mutates_input = False
 
-        except Empty:
+    def run(self):
+        packet = self.try_get()
+        if packet is Empty:
             return False
-
-        except EOF:
+        if packet is EOF:
             self.finish()
 
+        return True
+
 
 class Packer(Element):
+    """
+    Puts all its input packets as a single packet at EOF
+    Parameters:
+    - max_packets: keep at most max_packets packets in memory and spill the
+      rest to a temporary file. The packet is then a SpillBuffer, an iterable
+      reading them back lazily, instead of a list
+    - spill_dir: directory for the temporary file
+    """
+
+    mutates_input = False
+    forwards_input = True
+
     def __init__(self, *args, **kwargs):
-        super().__init__(self, *args, **kwargs)
-        self._packets = []
+        super().__init__(*args, **kwargs)
 
-    def run(self):
-        try:
-            self._packets.append(self.get())
-            return True
+        max_packets = self.kwargs.get("max_packets", 0)
+        if max_packets:
+            self._packets = SpillBuffer(max_packets, self.kwargs.get("spill_dir"))
+        else:
+            self._packets = []
 
-        except Empty:
+    def run(self):
+        packet = self.try_get()
+        if packet is Empty:
             return False
-
-        except EOF:
+        if packet is EOF:
             self.put(self._packets)
             self.finish()
 
+        self._packets.append(packet)
+        return True
+
 
 class PickleSrc(Element):
-    def __init__(self, filename=None):
-        fh = open(filename)
-        self.packets = pickle.load(fh)
-        fh.close()
+    """
+    Reads packets from a pickle file
+    Parameters:
+    - filename: file to read
+    - stream: read a stream of pickles, as written by PickleSink with
+      stream=True, one packet at a time instead of loading a pickled list
+    - offset: byte offset to start reading the stream from, usually a
+      previous value of the offset attribute
+    - read_ahead: size in bytes of the read buffer, defaults to io's
+    """
+
+    def __init__(self, filename=None, stream=False, offset=0, read_ahead=-1, **kwargs):
+        if offset and not stream:
+            raise ValueError("offset requires stream=True")
+
+        super().__init__(**kwargs)
+        self.stream = stream
+
+        if not stream:
+            with open(filename, "rb") as fh:
+                self.packets = deque(pickle.load(fh))
+            return
+
+        self._fh = open(filename, "rb", buffering=read_ahead)
+        self._fh.seek(offset)
+        self._packets = load_packets(self._fh)
+
+        # Offset reported once the file is closed
+        self._offset = offset
+
+    @property
+    def offset(self):
+        """Byte offset of the next packet in the stream, None if the source
+        doesn't read a stream
+        """
+        if not self.stream:
+            return None
+
+        if self._fh.closed:
+            return self._offset
+
+        return self._fh.tell()
+
+    def close(self):
+        if self.stream and not self._fh.closed:
+            self._offset = self._fh.tell()
+            self._fh.close()
 
     def run(self):
-        try:
-            packet = self.packets.pop()
-            self.put(packet)
+        if not self.stream:
+            if not self.packets:
+                self.finish()
 
-        except IndexError:
+            self.put(self.packets.popleft())
+            return True
+
+        try:
+            packet = next(self._packets)
+        except StopIteration:
+            self.close()
             self.finish()
 
+        self.put(packet)
+        return True
+
 
 class PickleSink(Element):
+    """
+    Pickles packets into a file
+    Parameters:
+    - filename: file to write
+    - stream: write each packet as it arrives, as a stream of pickles (see
+      pypes.spill.load_packets), instead of a single pickled list at EOF
+    """
+
+    mutates_input = False
+
     def __init__(self, **kwargs):
         filename = kwargs.pop("filename", None)
+        stream = kwargs.pop("stream", False)
 
         super().__init__(**kwargs)
         self.filename = filename
+        self.stream = stream
         self.packets = []
+        self._fh = open(filename, "wb+") if stream else None
 
     def run(self):
-        try:
-            self.packets.append(self.get())
-            return True
+        if self.stream:
+            return self._run_stream()
 
-        except Empty:
+        packet = self.try_get()
+        if packet is Empty:
             return False
-
-        except EOF:
+        if packet is EOF:
             fh = open(self.filename, "wb+")
             pickle.dump(self.packets, fh)
             fh.close()
 
             self.finish()
 
+        self.packets.append(packet)
+        return True
+
+    def _run_stream(self):
+        packets = self.try_get_batch(1024)
+        if packets is Empty:
+            return False
+        if packets is EOF:
+            self._fh.close()
+            self.finish()
+
+        dump_packets(self._fh, packets)
+        return True
+
+    def close(self):
+        if self._fh is not None:
+            self._fh.close()
+
 
 class SampleSrc(Element):
     def run(self):
@@ -221,67 +547,149 @@ class SampleSrc(Element):
 
 
 class StoreSink(Element):
+    """
+    Stores its input packets in the packets attribute
+    Parameters:
+    - max_packets: keep at most max_packets packets in memory and spill the
+      rest to a temporary file. packets is then a SpillBuffer, an iterable
+      reading them back lazily, instead of a list
+    - spill_dir: directory for the temporary file
+    """
+
+    mutates_input = False
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.packets = []
 
-    def run(self):
-        try:
-            self.packets.append(self.get())
-            return True
+        max_packets = self.kwargs.get("max_packets", 0)
+        if max_packets:
+            self.packets = SpillBuffer(max_packets, self.kwargs.get("spill_dir"))
+        else:
+            self.packets = []
 
-        except Empty:
+    def run(self):
+        packet = self.try_get()
+        if packet is Empty:
             return False
-
-        except EOF:
+        if packet is EOF:
             self.finish()
 
+        self.packets.append(packet)
+        return True
+
+
+def _pickle_copy(x):
+    return pickle.loads(pickle.dumps(x, protocol=pickle.HIGHEST_PROTOCOL))
+
 
 class Tee(Element):
-    def __init__(self, *args, n_outputs=1, output_pattern="tee_%02d", **kwargs):
+    """
+    Copies each packet to n_outputs outputs
+    Parameters:
+    - n_outputs: number of outputs, named after output_pattern
+    - copy: how to copy packets for the extra outputs, one of 'share',
+      'copy', 'deepcopy', 'pickle' or a callable
+
+    Outputs whose readers don't mutate packets (see Element.mutates_input)
+    share the original packet. Immutable packets are always shared and
+    memoryviews are shared as read-only views.
+    """
+
+    copy_strategies = {
+        "share": lambda x: x,
+        "copy": copy.copy,
+        "deepcopy": copy.deepcopy,
+        "pickle": _pickle_copy,
+    }
+
+    mutates_input = False
+    forwards_input = True
+
+    def __init__(
+        self, *args, n_outputs=1, output_pattern="tee_%02d", copy="pickle", **kwargs
+    ):
         super().__init__(args, **kwargs)
         self.n_outputs = n_outputs
         self.output_pattern = output_pattern
 
+        if callable(copy):
+            self.copy = copy
+        elif copy in Tee.copy_strategies:
+            self.copy = Tee.copy_strategies[copy]
+        else:
+            raise ValueError(
+                f"copy must be a callable or one of {tuple(Tee.copy_strategies)}"
+            )
+
+    def attach(self, container):
+        super().attach(container)
+        self._plan = None
+
+    def _make_plan(self):
+        """Returns a list of (channel, share) tuples. The original packet is
+        shared with non-mutating readers, mutating ones get copies except when
+        every reader mutates, then the first one gets the original.
+        """
+        queues = [
+            self.write_queue(self.output_pattern % n) for n in range(self.n_outputs)
+        ]
+        share = [not self._container.may_mutate(q.reader) for q in queues]
+        if not any(share):
+            share[0] = True
+
+        return list(zip(queues, share))
+
     def run(self):
-        try:
-            packet = self.get()
-            self.put(packet, self.output_pattern % 0)
+        packet = self.try_get()
+        if packet is Empty:
+            return False
+        if packet is EOF:
+            self.finish()
 
-            for n in range(1, self.n_outputs):
-                copy = pickle.loads(pickle.dumps(packet))
-                self.put(copy, self.output_pattern % n)
+        if self._plan is None:
+            self._plan = self._make_plan()
 
-            return True
+        if isinstance(packet, _IMMUTABLE_TYPES):
+            for q, _ in self._plan:
+                q.put(packet)
 
-        except Empty:
-            return False
+        elif isinstance(packet, memoryview):
+            view = packet if packet.readonly else packet.toreadonly()
+            for q, _ in self._plan:
+                q.put(view)
 
-        except EOF:
-            self.finish()
+        else:
+            for q, share in self._plan:
+                q.put(packet if share else self.copy(packet))
+
+        return True
 
 
 class Zip(Element):
+    mutates_input = False
+    forwards_input = True
+
     def __init__(self, n_inputs=1, input_pattern="zip_%02d"):
         super().__init__(n_inputs=n_inputs, input_pattern=input_pattern)
 
-        self.inputs = [input_pattern % x for x in range(n_inputs)]
+        self._open = deque(input_pattern % x for x in range(n_inputs))
+
+    def input_closed(self, input):
+        self._open.remove(input)
 
     def run(self):
-        if not self.inputs:
+        # Exhausted inputs leave the rotation, finish with the last one
+        if not self._open:
             self.finish()
 
-        input = self.inputs.pop(0)
-
-        try:
-            x = self.get(input)
-            self.put(x)
-            self.inputs.append(input)
-            return True
-
-        except Empty:
-            self.inputs.append(input)
+        input = self._open[0]
+        x = self.try_get(input)
+        if x is EOF:
             return False
 
-        except EOF:
+        self._open.rotate(-1)
+        if x is Empty:
             return False
+
+        self.put(x)
+        return True
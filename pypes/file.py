@@ -1,10 +1,28 @@
+import mmap
+import os
+
 from . import EOF, Element, Empty
 
 
 class FileSrc(Element):
+    """
+    Reads a file
+    Parameters:
+    - path: file to read
+    - mode: 'r' or 'rb'
+    - bytes: size of each packet, -1 means the whole file in one packet. With
+      a separator it is the amount of data read (or scanned) per run and
+      defaults to chunk_size
+    - mmap: map the file and emit memoryview slices of it, no data is copied.
+      Binary mode only
+    - separator: emit one packet per record, each ending with separator (like
+      lines from file iteration), instead of fixed size packets
+    """
+
     allowed_modes = ("r", "rb")
+    chunk_size = 64 * 1024
 
-    def __init__(self, path=None, mode="rb", bytes=-1):
+    def __init__(self, path=None, mode="rb", bytes=-1, mmap=False, separator=None):
         if not path:
             raise ValueError("path not specified")
 
@@ -14,43 +32,232 @@ class FileSrc(Element):
         if bytes <= 0 and bytes != -1:
             raise ValueError("bytes must be greater than 0 or -1")
 
+        if mmap and mode != "rb":
+            raise ValueError("mmap requires mode 'rb'")
+
+        if separator is not None and not separator:
+            raise ValueError("separator can't be empty")
+
         super().__init__()
 
         self.fh = open(path, mode)
         self.bytes = bytes
+        self.separator = separator
+
+        self._pos = 0
+        self._mm = None
+        self._view = None
+        self._buff = None
+
+        if mmap:
+            self._map()
+        elif separator is not None:
+            self._buff = separator[:0]
+
+    def _map(self):
+        if os.fstat(self.fh.fileno()).st_size:
+            self._mm = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+            self._view = memoryview(self._mm)
+        else:
+            # Empty files can't be mapped
+            self._view = memoryview(b"")
+
+    def close(self):
+        self.fh.close()
+
+        if self._mm is not None:
+            self._view.release()
+            try:
+                self._mm.close()
+            except BufferError:
+                # Emitted slices are still alive, the map is released with
+                # the last one
+                pass
+
+    def _close(self):
+        self.close()
+        self.finish()
 
     def run(self):
+        if self._view is not None:
+            return self._run_mmap()
+
+        if self.separator is not None:
+            return self._run_records()
+
         buff = self.fh.read(self.bytes)
         if buff:
             self.put(buff)
         else:
-            self.fh.close()
-            self.finish()
+            self._close()
+
+    def _run_mmap(self):
+        view, pos = self._view, self._pos
+        size = len(view)
+        if pos >= size:
+            self._close()
+
+        if self.separator is None:
+            end = size if self.bytes == -1 else min(pos + self.bytes, size)
+            self.put(view[pos:end])
+            self._pos = end
+            return True
+
+        # Emit the records found in the next chunk of the map
+        find, sep = self._mm.find, self.separator
+        limit = pos + (self.chunk_size if self.bytes == -1 else self.bytes)
+        put = self.write_queue().put
+        while pos < size and pos < limit:
+            idx = find(sep, pos)
+            end = size if idx == -1 else idx + len(sep)
+            put(view[pos:end])
+            pos = end
+
+        self._pos = pos
+        return True
+
+    def _run_records(self):
+        # Emit every complete record in the buffer, only the incomplete tail
+        # is carried over when the next chunk is read
+        buff, pos, sep = self._buff, self._pos, self.separator
+        put = self.write_queue().put
+
+        while True:
+            idx = buff.find(sep, pos)
+            if idx == -1:
+                break
+
+            end = idx + len(sep)
+            put(buff[pos:end])
+            pos = end
+
+        chunk = self.fh.read(self.chunk_size if self.bytes == -1 else self.bytes)
+        if not chunk:
+            if pos < len(buff):
+                put(buff[pos:])
+            self._close()
+
+        self._buff = buff[pos:] + chunk
+        self._pos = 0
+        return True
 
 
 class FileSink(Element):
+    """
+    Writes packets into a file
+    Parameters:
+    - path: file to write
+    - mode: one of 'w', 'wb', 'a' or 'ab'
+    - buffer_size: coalesce packets until they add up to buffer_size bytes
+      and write them at once (with os.writev in binary mode). 0 writes each
+      packet as it arrives
+    - fsync: None, 'close' to fsync the file when closing it or 'flush' to
+      fsync it after every coalesced write
+    """
+
     allowed_modes = ("w", "wb", "a", "ab")
+    fsync_policies = (None, "close", "flush")
+    threaded = True
+    mutates_input = False
 
-    def __init__(self, path=None, mode="wb"):
+    def __init__(self, path=None, mode="wb", buffer_size=0, fsync=None):
         if not path:
             raise ValueError("path not specified")
 
         if mode not in FileSink.allowed_modes:
             raise ValueError(f"mode must in one of {FileSink.allowed_modes}")
 
+        if buffer_size < 0:
+            raise ValueError("buffer_size must be 0 or greater")
+
+        if fsync not in FileSink.fsync_policies:
+            raise ValueError(f"fsync must be one of {FileSink.fsync_policies}")
+
         super().__init__()
 
-        self.fh = open(path, mode)
+        self.binary = "b" in mode
+        self.buffer_size = buffer_size
+        self.fsync = fsync
+
+        # Binary coalesced writes go straight to the OS
+        self.fh = open(path, mode, buffering=0 if buffer_size and self.binary else -1)
+
+        self._pending = []
+        self._pending_size = 0
+
+    def _flush(self):
+        if not self._pending:
+            return
+
+        if not self.binary:
+            self.fh.write("".join(self._pending))
+
+        elif hasattr(os, "writev"):
+            _writev(self.fh.fileno(), self._pending)
+
+        else:
+            self.fh.write(b"".join(self._pending))
+
+        self._pending = []
+        self._pending_size = 0
+
+        if self.fsync == "flush":
+            self.fh.flush()
+            os.fsync(self.fh.fileno())
+
+    def close(self):
+        if self.fh.closed:
+            return
+
+        self._flush()
+
+        if self.fsync is not None:
+            self.fh.flush()
+            os.fsync(self.fh.fileno())
+
+        self.fh.close()
+
+    def _close(self):
+        self.close()
+        self.finish()
 
     def run(self):
-        try:
-            buff = self.get()
+        buff = self.try_get()
+        if buff is Empty:
+            return False
+        if buff is EOF:
+            self._close()
+
+        if not self.buffer_size:
             self.fh.write(buff)
             return True
 
-        except Empty:
-            return False
+        self._pending.append(buff)
+        self._pending_size += buff.nbytes if isinstance(buff, memoryview) else len(buff)
+        if self._pending_size >= self.buffer_size:
+            self._flush()
+
+        return True
+
+
+def _writev(fd, buffers):
+    """Writes all buffers using as few os.writev calls as possible"""
+    try:
+        iov_max = os.sysconf("SC_IOV_MAX")
+    except (AttributeError, ValueError, OSError):
+        iov_max = 1024
+
+    buffers = [memoryview(b).cast("B") for b in buffers]
+    while buffers:
+        batch = buffers[:iov_max]
+        written = os.writev(fd, batch)
+
+        # Skip fully written buffers and trim a partially written one
+        idx = 0
+        while idx < len(batch) and written >= len(batch[idx]):
+            written -= len(batch[idx])
+            idx += 1
 
-        except EOF:
-            self.fh.close()
-            self.finish()
+        buffers = buffers[idx:]
+        if written:
+            buffers[0] = buffers[0][written:]
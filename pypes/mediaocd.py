@@ -1,16 +1,11 @@
 import difflib
+import heapq
+import itertools
 import os
 import re
+from collections import Counter
 
-import guessit
-
-from . import EOF, Element, Empty, Transformer
-
-
-def _regex_chain_process(s, regexes, *args, **kwargs):
-    for regex, repl in regexes:
-        s = re.subn(regex, repl, s, *args, **kwargs)[0]
-    return s
+from . import Transformer
 
 
 def _apply_on_fields(func, d, fields):
@@ -18,41 +13,325 @@ def _apply_on_fields(func, d, fields):
         d[field] = func(d[field])
 
 
+# Patterns using backreferences, conditional groups or global inline flags
+# can't be merged into an alternation
+_UNCOMBINABLE_RE = re.compile(r"\\[1-9]|\(\?P=|\(\?\(|^\(\?[aiLmsux]+\)")
+
+
+def _combinable(pattern, repl):
+    return (
+        isinstance(pattern, str)
+        and isinstance(repl, str)
+        and "\\" not in repl
+        and not re.compile(pattern).groupindex
+        and not _UNCOMBINABLE_RE.search(pattern)
+    )
+
+
+def _combine(regexes):
+    # Each pattern gets an outer group, lastindex tells which one matched
+    parts, repls, group = [], {}, 1
+    for pattern, repl in regexes:
+        parts.append(f"({pattern})")
+        repls[group] = repl
+        group += re.compile(pattern).groups + 1
+
+    return re.compile("|".join(parts)), lambda m: repls[m.lastindex]
+
+
+def compile_chain(regexes, combine=False):
+    """Returns regexes, a sequence of (pattern, repl) tuples, as a list of
+    (compiled pattern, repl) tuples to be applied in order. With combine
+    consecutive patterns with literal replacements and no groups references
+    are merged into a single alternation, which takes a single pass over the
+    string but applies them to the original string instead of to the result
+    of the previous one, and the leftmost match wins
+    """
+    if not combine:
+        return [(re.compile(pattern), repl) for (pattern, repl) in regexes]
+
+    chain, run = [], []
+    for pattern, repl in list(regexes) + [(None, None)]:
+        if pattern is not None and _combinable(pattern, repl):
+            run.append((pattern, repl))
+            continue
+
+        if len(run) > 1:
+            chain.append(_combine(run))
+        elif run:
+            chain.append((re.compile(run[0][0]), run[0][1]))
+        run = []
+
+        if pattern is not None:
+            chain.append((re.compile(pattern), repl))
+
+    return chain
+
+
+def _split(s):
+    head, tail = os.path.split(s)
+    base, ext = os.path.splitext(tail)
+    return head, base, ext
+
+
 def normalize(s, regexes):
-    dirname = os.path.dirname(s)
-    basename, ext = os.path.splitext(s)
-    return os.path.join(dirname, _regex_chain_process(basename, regexes).strip() + ext)
+    """Applies regexes to the filename of s, without its extension. regexes
+    can be a compile_chain result
+    """
+    head, base, ext = _split(s)
+    for regex, repl in regexes:
+        base = re.sub(regex, repl, base)
+
+    return os.path.join(head, base.strip() + ext)
+
+
+def normalize_batch(values, chain):
+    """Normalizes a list of filenames with a compile_chain result"""
+    parts = [_split(s) for s in values]
+    bases = [base for (_, base, _) in parts]
+    for regex, repl in chain:
+        sub = regex.sub
+        bases = [sub(repl, base) for base in bases]
+
+    join = os.path.join
+    return [
+        join(head, base.strip() + ext) for ((head, _, ext), base) in zip(parts, bases)
+    ]
 
 
 def nearest_match(value, match_list, cutoff=0.6):
-    candidate = difflib.get_close_matches(value, match_list, cutoff=0.6)
+    candidate = difflib.get_close_matches(value, match_list, cutoff=cutoff)
     return candidate[0] if candidate else value
 
 
-class GuessItParser(Element):
+def _ngrams(s, n):
+    # Padding gives short strings some n-grams and weights their edges
+    s = " " * (n - 1) + s + " "
+    return {s[i : i + n] for i in range(len(s) - n + 1)}
+
+
+class MatchIndex:
+    """
+    N-gram inverted index over a list of choices for fuzzy matching.
+    Candidates sharing n-grams with the value and with compatible lengths are
+    scored with difflib's ratio, like difflib.get_close_matches, so very
+    dissimilar choices are never compared. Choices sharing no n-gram with
+    the value are missed even if their score passes the cutoff, smaller n
+    trades speed for recall
+    Parameters:
+    - choices: iterable of strings
+    - n: n-gram size
+    - max_candidates: score only the choices sharing most n-grams with the
+      value, None scores every candidate
+    """
+
+    def __init__(self, choices=(), n=3, max_candidates=None):
+        self.n = n
+        self.max_candidates = max_candidates
+        self._postings = {}
+        self._choices = set()
+        self.update(choices)
+
+    def __len__(self):
+        return len(self._choices)
+
+    def __contains__(self, choice):
+        return choice in self._choices
+
+    def add(self, choice):
+        if choice in self._choices:
+            return
+
+        self._choices.add(choice)
+        for gram in _ngrams(choice, self.n):
+            self._postings.setdefault(gram, set()).add(choice)
+
+    def remove(self, choice):
+        self._choices.remove(choice)
+        for gram in _ngrams(choice, self.n):
+            postings = self._postings[gram]
+            postings.discard(choice)
+            if not postings:
+                del self._postings[gram]
+
+    def update(self, choices):
+        """Makes choices the indexed choices, only the differences with the
+        current ones are indexed or removed
+        """
+        choices = set(choices)
+        for choice in self._choices - choices:
+            self.remove(choice)
+        for choice in choices - self._choices:
+            self.add(choice)
+
+    def matches(self, value, k=1, cutoff=0.6):
+        """Returns up to k (choice, score) tuples with score >= cutoff, best
+        first
+        """
+        # Nothing beats an exact match
+        if k == 1 and value in self._choices:
+            return [(value, 1.0)]
+
+        # ratio is 2 * matches / total length, bounded by the shorter string
+        size = len(value)
+        lo = size * cutoff / (2 - cutoff)
+        hi = size * (2 - cutoff) / cutoff if cutoff > 0 else float("inf")
+
+        shared = Counter()
+        for gram in _ngrams(value, self.n):
+            shared.update(self._postings.get(gram, ()))
+
+        candidates = (c for c in shared if lo <= len(c) <= hi)
+        if self.max_candidates is not None:
+            candidates = heapq.nlargest(
+                self.max_candidates, candidates, key=shared.__getitem__
+            )
+
+        s = difflib.SequenceMatcher()
+        s.set_seq2(value)
+        results = []
+        for choice in candidates:
+            s.set_seq1(choice)
+            if (
+                s.real_quick_ratio() >= cutoff
+                and s.quick_ratio() >= cutoff
+                and s.ratio() >= cutoff
+            ):
+                results.append((s.ratio(), choice))
+
+        return [(c, score) for (score, c) in heapq.nlargest(k, results)]
+
+
+def _guess_file_info(filename, filetype):
+    # guessit is slow to import, only pay for it when parsing
+    import guessit
+
+    return guessit.guess_file_info(filename, filetype)
+
+
+class GuessItParser(Transformer):
+    """
+    Parses filenames with guessit
+    Parameters:
+    - filetype: guessit filetype, 'autodetect' by default
+    - batch_size: parse up to batch_size packets per run, 0 parses every
+      available packet. Repeated filenames in a batch are parsed once
+    - workers: parse batches in a process pool with this many processes
+    - cache: see Transformer, keyed by (filename, filetype) by default.
+      Repeated filenames get copies of the cached results
+    """
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault("cache_key", self._cache_key)
+
+        super().__init__(*args, **kwargs)
+        self._executor = None
+
+    def _cache_key(self, filename):
+        return (filename, self.kwargs.get("filetype", "autodetect"))
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
     def run(self):
+        # Takes what is queued on each run instead of waiting for more
+        if self.batch_size == 0:
+            return self.run_batch(max(1, len(self.read_queue())))
+
+        return super().run()
+
+    def transform(self, x):
+        return _guess_file_info(x, self.kwargs.get("filetype", "autodetect"))
+
+    def transform_batch(self, xs):
         filetype = self.kwargs.get("filetype", "autodetect")
+        unique = list(dict.fromkeys(xs))
+
+        workers = self.kwargs.get("workers")
+        if workers and len(unique) > 1:
+            if self._executor is None:
+                from concurrent.futures import ProcessPoolExecutor
 
-        try:
-            x = self.get()
-            info = guessit.guess_file_info(x, filetype)
-            self.put(info)
+                self._executor = ProcessPoolExecutor(max_workers=workers)
 
-        except Empty:
-            return False
+            results = self._executor.map(
+                _guess_file_info,
+                unique,
+                itertools.repeat(filetype),
+                chunksize=max(1, len(unique) // (4 * workers)),
+            )
+        else:
+            results = (_guess_file_info(x, filetype) for x in unique)
 
-        except EOF:
-            self.finish()
+        # Repeated filenames get copies if downstream elements may modify
+        # them, like cached results do
+        parsed = dict(zip(unique, results))
+        seen = set()
+        output = []
+        for x in xs:
+            output.append(self._copy_shared(parsed[x]) if x in seen else parsed[x])
+            seen.add(x)
+
+        return output
 
 
 class Normalizer(Transformer):
+    """
+    Applies a chain of regex substitutions to filenames, leaving their
+    directory and extension alone
+    Parameters:
+    - regexes: sequence of (pattern, repl) tuples, compiled once
+    - combine: merge compatible patterns into single passes, see
+      compile_chain
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.chain = compile_chain(
+            self.kwargs.get("regexes", ()), self.kwargs.get("combine", False)
+        )
+
     def transform(self, value):
-        regexes = self.kwargs.get("regexes", ())
-        return normalize(value, regexes)
+        head, base, ext = _split(value)
+        for regex, repl in self.chain:
+            base = regex.sub(repl, base)
+
+        return os.path.join(head, base.strip() + ext)
+
+    def transform_batch(self, values):
+        return normalize_batch(values, self.chain)
 
 
 class NearestMatch(Transformer):
+    """
+    Replaces values with their closest match from a list, values without one
+    are passed unchanged
+    Parameters:
+    - match_list: list of choices, indexed once by a MatchIndex
+    - cutoff: minimum similarity score, between 0 and 1
+    - top_k: emit a list with up to top_k (choice, score) tuples instead
+    - max_candidates: see MatchIndex
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.index = MatchIndex(
+            self.kwargs.get("match_list", ()),
+            max_candidates=self.kwargs.get("max_candidates"),
+        )
+
+    def set_match_list(self, match_list):
+        """Replaces the match list, reindexing only the changed choices"""
+        self.kwargs["match_list"] = match_list
+        self.index.update(match_list)
+
     def transform(self, value):
-        match_list = self.kwargs.get("match_list", ())
-        cutoff = self.kwargs.get("match_list", 0.6)
-        return nearest_match(value, match_list=match_list, cutoff=cutoff)
+        cutoff = self.kwargs.get("cutoff", 0.6)
+        top_k = self.kwargs.get("top_k")
+        if top_k is not None:
+            return self.index.matches(value, k=top_k, cutoff=cutoff)
+
+        matches = self.index.matches(value, cutoff=cutoff)
+        return matches[0][0] if matches else value
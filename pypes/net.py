@@ -0,0 +1,309 @@
+import http.client
+import threading
+import urllib.error
+import urllib.parse
+from collections import deque
+
+from .core import EOF, Element, Empty
+
+# Errors of a kept alive connection closed by the server while idle
+_STALE_ERRORS = (
+    http.client.RemoteDisconnected,
+    http.client.BadStatusLine,
+    BrokenPipeError,
+    ConnectionResetError,
+)
+
+_DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def _host_key(parts):
+    """Returns the (scheme, hostname, port) key connections and per host
+    limits are kept by for a urlsplit result, with the default port filled
+    in so equivalent urls share it
+    """
+    port = parts.port or _DEFAULT_PORTS.get(parts.scheme)
+    return (parts.scheme, parts.hostname, port)
+
+
+class ConnectionPool:
+    """
+    Pool of kept alive HTTP/HTTPS connections per host, also limiting the
+    number of concurrent requests per host. Thread safe. Can be used as
+    FetcherProcessor's fetcher.
+    Parameters:
+    - max_per_host: concurrent requests per host, further ones block until
+      a previous one is released
+    - timeout: socket timeout in seconds
+    """
+
+    def __init__(self, max_per_host=2, timeout=None):
+        if max_per_host < 1:
+            raise ValueError("max_per_host must be greater than 0")
+
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._slots = {}
+        self._owners = {}
+
+        # Monitoring counters
+        self.connections = 0
+        self.requests = 0
+
+    def _connect(self, key):
+        scheme, host, port = key
+        if scheme == "https":
+            cls = http.client.HTTPSConnection
+        else:
+            cls = http.client.HTTPConnection
+
+        with self._lock:
+            self.connections += 1
+
+        return cls(host, port, timeout=self.timeout)
+
+    def open(self, url):
+        """Sends a GET request for url and returns the response once its
+        headers arrive, blocks while its host has max_per_host requests open.
+        The response must be given back to release once read.
+        Raises HTTPError for 4xx and 5xx responses, like urlopen
+        """
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ("http", "https"):
+            raise ValueError(f"Unsupported url '{url}'")
+
+        key = _host_key(parts)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+
+        with self._lock:
+            slots = self._slots.get(key)
+            if slots is None:
+                slots = threading.BoundedSemaphore(self.max_per_host)
+                self._slots[key] = slots
+
+        slots.acquire()
+        try:
+            while True:
+                with self._lock:
+                    idle = self._idle.get(key)
+                    conn = idle.pop() if idle else None
+
+                reused = conn is not None
+                if not reused:
+                    conn = self._connect(key)
+
+                try:
+                    conn.request("GET", path)
+                    response = conn.getresponse()
+                    break
+
+                except _STALE_ERRORS:
+                    conn.close()
+                    if not reused:
+                        raise
+
+                except BaseException:
+                    conn.close()
+                    raise
+
+            with self._lock:
+                self.requests += 1
+                self._owners[response] = (key, conn)
+
+        except BaseException:
+            slots.release()
+            raise
+
+        if response.status >= 400:
+            response.read()
+            self.release(response)
+            raise urllib.error.HTTPError(
+                url, response.status, response.reason, response.headers, None
+            )
+
+        return response
+
+    def release(self, response):
+        """Gives the connection of response back to the pool, it is kept
+        alive if the body was read completely
+        """
+        with self._lock:
+            key, conn = self._owners.pop(response)
+            if response.isclosed() and not response.will_close:
+                self._idle.setdefault(key, []).append(conn)
+            else:
+                response.close()
+                conn.close()
+
+        self._slots[key].release()
+
+    def fetch(self, url):
+        """Returns the body of url"""
+        response = self.open(url)
+        try:
+            return response.read()
+        finally:
+            self.release(response)
+
+    def close(self):
+        """Closes idle connections"""
+        with self._lock:
+            for conns in self._idle.values():
+                for conn in conns:
+                    conn.close()
+
+            self._idle = {}
+
+
+class HttpFetcher(Element):
+    """
+    Fetches the urls it gets as packets and emits their bodies in input
+    order. Bodies are read as the output makes room, so at most concurrency
+    responses are open at once and memory stays bounded.
+    Parameters:
+    - chunk_size: emit bodies in chunks of up to chunk_size bytes, -1 emits
+      each body as a single packet
+    - concurrency: requests in flight at once
+    - max_per_host: concurrent requests per host of the default pool
+    - timeout: socket timeout of the default pool
+    - pool: ConnectionPool to use instead of a new one, sharing it keeps
+      connections and per host limits across elements
+    - with_url: emit (url, chunk) tuples instead of chunks
+    """
+
+    threaded = True
+    mutates_input = False
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.chunk_size = self.kwargs.get("chunk_size", -1)
+        self.concurrency = self.kwargs.get("concurrency", 1)
+        if not self.chunk_size or self.chunk_size < -1:
+            raise ValueError("chunk_size must be greater than 0 or -1")
+        if self.concurrency < 1:
+            raise ValueError("concurrency must be greater than 0")
+
+        self.pool = self.kwargs.get("pool")
+        self._own_pool = self.pool is None
+        if self._own_pool:
+            self.pool = ConnectionPool(
+                max_per_host=self.kwargs.get("max_per_host", 2),
+                timeout=self.kwargs.get("timeout"),
+            )
+
+        self._executor = None
+        self._active = deque()
+        self._eof = False
+
+        # Next url, held back while its host is at its limit, and number of
+        # active requests per host
+        self._next = None
+        self._hosts = {}
+
+    def _start(self):
+        # Requests are started in input order and never beyond the pool's
+        # per host limit, otherwise a later request could take the slot the
+        # first one waits for while we wait for the first one
+        while len(self._active) < self.concurrency:
+            if self._next is None:
+                if self._eof:
+                    return
+
+                url = self.try_get()
+                if url is Empty:
+                    return
+                if url is EOF:
+                    self._eof = True
+                    return
+
+                self._next = url
+
+            host = _host_key(urllib.parse.urlsplit(self._next))
+            if self._hosts.get(host, 0) >= self.pool.max_per_host:
+                return
+
+            url, self._next = self._next, None
+            self._hosts[host] = self._hosts.get(host, 0) + 1
+
+            future = self._executor.submit(self.pool.open, url)
+            self._active.append((url, future))
+            self.defer(future)
+
+    def _stream(self, url, response, q):
+        """Puts chunks of response until it is exhausted or q gets full.
+        Returns True if response was exhausted
+        """
+        with_url = self.kwargs.get("with_url", False)
+        while True:
+            if q.full():
+                q.blocked = True
+                if q.full():
+                    return False
+                q.blocked = False
+
+            if self.chunk_size == -1:
+                body = response.read()
+                q.put((url, body) if with_url else body)
+                return True
+
+            chunk = response.read(self.chunk_size)
+            if not chunk:
+                return True
+
+            q.put((url, chunk) if with_url else chunk)
+
+    def run(self):
+        if self._executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+
+            self._executor = ThreadPoolExecutor(max_workers=self.concurrency)
+
+        q = self.write_queue()
+        while True:
+            self._start()
+            if not self._active:
+                if self._eof and self._next is None:
+                    self.close()
+                    self.finish()
+                return False
+
+            url, future = self._active[0]
+            if not future.done():
+                # Its completion wakes us up
+                self.wait()
+                return True
+
+            response = future.result()
+            if not self._stream(url, response, q):
+                # Room in q wakes us up
+                return True
+
+            self.pool.release(response)
+            self._active.popleft()
+            self._hosts[_host_key(urllib.parse.urlsplit(url))] -= 1
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+        # Requests being sent release their connections once done
+        while self._active:
+            _, future = self._active.popleft()
+            future.add_done_callback(self._discard)
+
+        if self._own_pool:
+            self.pool.close()
+
+    def _discard(self, future):
+        if future.cancelled() or future.exception() is not None:
+            return
+
+        response = future.result()
+        response.close()
+        self.pool.release(response)
@@ -0,0 +1,139 @@
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from .core import EOF, Empty, Transformer
+
+
+class WorkerError(Exception):
+    pass
+
+
+# Transformer used by the pool worker processes, set once per process by
+# _init_worker so it isn't pickled along with every chunk
+_worker_transformer = None
+
+
+def _init_worker(transformer):
+    global _worker_transformer
+    _worker_transformer = transformer
+
+
+def _transform_chunk(chunk):
+    return _worker_transformer.transform_batch(chunk)
+
+
+class ParallelTransformer(Transformer):
+    """
+    Runs another transformer in a process pool, for CPU-bound stages
+    Packets are sent to workers in chunks and results are put back in input
+    order.
+    Parameters:
+    - transformer: Transformer to run, must be picklable
+    - workers: number of worker processes, defaults to the number of CPUs
+    - chunksize: number of packets sent to a worker at once
+    - max_chunks: number of chunks in flight, defaults to twice the workers
+    - mp_context: multiprocessing context for the pool
+    """
+
+    # Workers get pickled copies
+    mutates_input = False
+
+    def __init__(
+        self,
+        transformer=None,
+        *args,
+        workers=None,
+        chunksize=16,
+        max_chunks=None,
+        mp_context=None,
+        **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+
+        if not isinstance(transformer, Transformer):
+            raise ValueError("transformer is not a Transformer")
+
+        if chunksize < 1:
+            raise ValueError("chunksize must be greater than 0")
+
+        self.transformer = transformer
+        self.workers = workers
+        self.chunksize = chunksize
+        self.max_chunks = max_chunks
+        self.mp_context = mp_context
+
+        self._executor = None
+        self._pending = deque()
+        self._eof = False
+
+    def _start(self):
+        if self.workers is None:
+            self.workers = os.cpu_count() or 1
+
+        if self.max_chunks is None:
+            self.max_chunks = 2 * self.workers
+
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=self.mp_context,
+            initializer=_init_worker,
+            initargs=(self.transformer,),
+        )
+
+    def _result(self, future):
+        try:
+            return future.result()
+
+        except BrokenProcessPool as e:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            raise WorkerError(
+                f"{self}: worker process died while running {self.transformer}"
+            ) from e
+
+    def run(self):
+        if self._executor is None:
+            self._start()
+
+        q = self.read_queue()
+        while not self._eof and len(self._pending) < self.max_chunks:
+            # Wait for a full chunk while workers are busy to keep IPC down
+            if self._pending and len(q) < self.chunksize and not q.closed:
+                break
+
+            chunk = self.try_get_batch(self.chunksize)
+            if chunk is Empty:
+                break
+            if chunk is EOF:
+                self._eof = True
+                break
+
+            future = self._executor.submit(_transform_chunk, chunk)
+            self._pending.append(future)
+            self.defer(future)
+
+        put = self.write_queue().put
+        while self._pending and self._pending[0].done():
+            for packet in self._result(self._pending.popleft()):
+                put(packet)
+
+        if self._pending:
+            # Completions will wake us up
+            self.wait()
+
+        elif self._eof:
+            self._executor.shutdown()
+            self.finish()
+
+        return True
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def transform(self, input):
+        return self.transformer.transform(input)
+
+    def transform_batch(self, inputs):
+        return self.transformer.transform_batch(inputs)
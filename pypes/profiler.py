@@ -0,0 +1,166 @@
+import json
+import time
+
+
+class ElementStats:
+    __slots__ = (
+        "name",
+        "runs",
+        "idle_runs",
+        "wall",
+        "cpu",
+        "packets_in",
+        "packets_out",
+    )
+
+    def __init__(self, name):
+        self.name = name
+        self.runs = 0
+        self.idle_runs = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.packets_in = 0
+        self.packets_out = 0
+
+    def to_dict(self):
+        return {k: getattr(self, k) for k in self.__slots__}
+
+
+class Profiler:
+    """
+    Collects per element and per channel metrics while a pipeline runs.
+    Enabled with Pipeline(profile=True), when disabled the scheduler doesn't
+    touch it at all.
+
+    Packets in and out are computed from channel lengths around each run, so
+    channels don't need to count them. In threaded pipelines concurrent runs
+    of neighbour elements make them approximate.
+    """
+
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+        self.elements = {}
+        self.high_water = {}
+
+    def _stats(self, element):
+        try:
+            return self.elements[element]
+        except KeyError:
+            pass
+
+        name = self.pipeline.name_of(element) or str(element)
+        stats = self.elements[element] = ElementStats(name)
+        return stats
+
+    def run(self, element):
+        # Fused elements record their stages themselves, timing them too
+        # would count the same work twice
+        if getattr(element, "stages", None) is not None:
+            return self._run_fused(element)
+
+        stats = self._stats(element)
+        inputs = self.pipeline._inputs.get(element, ())
+        outputs = self.pipeline._outputs.get(element, ())
+        before_in = [len(q) for q in inputs]
+        before_out = [len(q) for q in outputs]
+
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            return element.run()
+
+        finally:
+            stats.wall += time.perf_counter() - wall
+            stats.cpu += time.thread_time() - cpu
+            stats.runs += 1
+
+            n_in = sum(b - len(q) for (b, q) in zip(before_in, inputs))
+            n_out = 0
+            for b, q in zip(before_out, outputs):
+                size = len(q)
+                n_out += size - b
+                if size > self.high_water.get(q, 0):
+                    self.high_water[q] = size
+
+            if n_in <= 0 and n_out <= 0:
+                stats.idle_runs += 1
+
+            stats.packets_in += max(n_in, 0)
+            stats.packets_out += max(n_out, 0)
+
+    def _run_fused(self, element):
+        try:
+            return element.run()
+
+        finally:
+            for q in self.pipeline._outputs.get(element, ()):
+                size = len(q)
+                if size > self.high_water.get(q, 0):
+                    self.high_water[q] = size
+
+    def record(self, element, wall, cpu, packets_in, packets_out):
+        """Accounts a run of element measured by someone else, like the stages
+        of a FusedStage
+        """
+        stats = self._stats(element)
+        stats.runs += 1
+        stats.wall += wall
+        stats.cpu += cpu
+        stats.packets_in += packets_in
+        stats.packets_out += packets_out
+        if not packets_in and not packets_out:
+            stats.idle_runs += 1
+
+    def to_dict(self):
+        name_of = self.pipeline.name_of
+        return {
+            "elements": [s.to_dict() for s in self.elements.values()],
+            "channels": [
+                {
+                    "src": name_of(src),
+                    "output": output,
+                    "sink": name_of(sink),
+                    "input": input,
+                    "high_water": self.high_water.get(q, 0),
+                    "maxsize": q.maxsize,
+                    "full": q.full_count,
+                    "empty": q.empty_count,
+                }
+                for (src, output, sink, input, q) in self.pipeline._channels
+            ],
+        }
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.to_dict(), **kwargs)
+
+    def report(self):
+        """Returns a text table with the collected metrics"""
+        lines = [
+            "%-24s %8s %8s %10s %10s %10s %10s"
+            % ("element", "runs", "idle", "wall(s)", "cpu(s)", "in", "out")
+        ]
+        for s in sorted(self.elements.values(), key=lambda s: -s.wall):
+            lines.append(
+                "%-24s %8d %8d %10.4f %10.4f %10d %10d"
+                % (
+                    s.name,
+                    s.runs,
+                    s.idle_runs,
+                    s.wall,
+                    s.cpu,
+                    s.packets_in,
+                    s.packets_out,
+                )
+            )
+
+        lines.append("")
+        lines.append(
+            "%-40s %10s %8s %8s %8s" % ("channel", "high", "max", "full", "empty")
+        )
+        for c in self.to_dict()["channels"]:
+            edge = "%s:%s -> %s:%s" % (c["src"], c["output"], c["sink"], c["input"])
+            lines.append(
+                "%-40s %10d %8d %8d %8d"
+                % (edge, c["high_water"], c["maxsize"], c["full"], c["empty"])
+            )
+
+        return "\n".join(lines)
@@ -0,0 +1,304 @@
+import os
+import pickle
+import select
+import socket
+import struct
+import time
+
+from .core import EOF, Element, Empty
+
+# Frames are a payload size and a kind followed by the payload
+_HEADER = struct.Struct("!IB")
+
+# Pickled list of packets
+_DATA = 1
+# No more data follows
+_EOF = 2
+# Receiver grants the sender more packets, payload is their number
+_CREDIT = 3
+# Receiver is gone, the sender must stop
+_CANCEL = 4
+
+_COUNT = struct.Struct("!I")
+
+# Longest a run waits on the socket before giving the pipeline a chance to
+# schedule or cancel the element
+_POLL = 0.05
+
+
+def _family(address):
+    if isinstance(address, str):
+        return socket.AF_UNIX
+    if ":" in address[0]:
+        return socket.AF_INET6
+    return socket.AF_INET
+
+
+def _frame(kind, payload=b""):
+    return _HEADER.pack(len(payload), kind) + payload
+
+
+class _Link:
+    """Buffered end of a connection, splits received data into frames"""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buf = bytearray()
+        self.eof = False
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def send(self, kind, payload=b""):
+        self.sock.sendall(_frame(kind, payload))
+
+    def receive(self):
+        """Reads what is available and returns the complete (kind, payload)
+        frames. Raises ConnectionError if the peer closed the connection
+        """
+        data = self.sock.recv(1 << 16)
+        if not data:
+            raise ConnectionError("Connection closed by peer")
+
+        self.buf += data
+        frames = []
+        while len(self.buf) >= _HEADER.size:
+            size, kind = _HEADER.unpack_from(self.buf)
+            end = _HEADER.size + size
+            if len(self.buf) < end:
+                break
+
+            frames.append((kind, bytes(self.buf[_HEADER.size : end])))
+            del self.buf[:end]
+
+        return frames
+
+    def close(self):
+        self.sock.close()
+
+
+class RemoteSrc(Element):
+    """
+    Emits the packets sent by RemoteSinks in other processes or hosts.
+    Listens on address from its creation and finishes once every sender sent
+    EOF. Packets are pickled, only accept trusted senders.
+    Flow control is credit based: each sender may have up to window packets
+    not yet emitted by this element, so a full output channel holds the
+    senders back.
+    Parameters:
+    - address: (host, port) tuple for TCP or a path for a Unix socket. Port 0
+      picks a free one, see the address attribute
+    - senders: number of RemoteSinks to wait for, their packets are merged
+    - window: credit of each sender, in packets
+    """
+
+    threaded = True
+
+    def __init__(self, address=None, *args, senders=1, window=1024, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        if address is None:
+            raise ValueError("address not specified")
+
+        if senders < 1:
+            raise ValueError("senders must be greater than 0")
+
+        if window < 1:
+            raise ValueError("window must be greater than 0")
+
+        self.senders = senders
+        self.window = window
+
+        self._listener = socket.socket(_family(address), socket.SOCK_STREAM)
+        if not isinstance(address, str):
+            self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind(address)
+        self._listener.listen(senders)
+        self.address = self._listener.getsockname()
+
+        self._links = []
+        self._accepted = 0
+
+        # Packets emitted per link but not granted back yet
+        self._pending = {}
+
+        # Monitoring counters
+        self.received = 0
+
+    def _accept(self):
+        sock, _ = self._listener.accept()
+        if sock.family != socket.AF_UNIX:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        link = _Link(sock)
+        link.send(_CREDIT, _COUNT.pack(self.window))
+        self._links.append(link)
+        self._pending[link] = 0
+        self._accepted += 1
+
+    def run(self):
+        waiting = [link for link in self._links if not link.eof]
+        if self._accepted < self.senders:
+            waiting.append(self._listener)
+        elif not waiting:
+            self.finish()
+
+        readable, _, _ = select.select(waiting, [], [], _POLL)
+        if not readable:
+            return False
+
+        put = self.write_queue().put
+        for link in readable:
+            if link is self._listener:
+                self._accept()
+                continue
+
+            for kind, payload in link.receive():
+                if kind == _DATA:
+                    packets = pickle.loads(payload)
+                    for packet in packets:
+                        put(packet)
+
+                    self.received += len(packets)
+                    self._pending[link] += len(packets)
+
+                elif kind == _EOF:
+                    link.eof = True
+                    link.close()
+
+        # Emitted packets are out of the link, grant them back in batches
+        for link, n in self._pending.items():
+            if n >= (self.window + 1) // 2 and not link.eof:
+                link.send(_CREDIT, _COUNT.pack(n))
+                self._pending[link] = 0
+
+        return True
+
+    def close(self):
+        for link in self._links:
+            if not link.eof:
+                # Cancelled, tell the sender to stop
+                try:
+                    link.send(_CANCEL)
+                except OSError:
+                    pass
+
+                link.eof = True
+                link.close()
+
+        if self._listener.fileno() != -1:
+            self._listener.close()
+            if isinstance(self.address, str):
+                try:
+                    os.unlink(self.address)
+                except FileNotFoundError:
+                    pass
+
+
+class RemoteSink(Element):
+    """
+    Sends its input packets to a RemoteSrc in another process or host, in
+    batches of up to batch_size packets per frame and never more than the
+    credit granted by the receiver. Sends EOF once its input is done and
+    finishes, cancelling its producers, if the receiver cancels or the
+    connection is lost.
+    Parameters:
+    - address: address of the RemoteSrc, (host, port) tuple or Unix socket path
+    - batch_size: most packets per frame
+    - timeout: seconds to keep retrying the connection while the receiver
+      isn't listening yet
+    """
+
+    threaded = True
+    mutates_input = False
+
+    def __init__(self, address=None, *args, batch_size=256, timeout=30, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        if address is None:
+            raise ValueError("address not specified")
+
+        if batch_size < 1:
+            raise ValueError("batch_size must be greater than 0")
+
+        self.address = address
+        self.batch_size = batch_size
+        self.timeout = timeout
+
+        self._link = None
+        self._credit = 0
+        self._cancelled = False
+
+        # Monitoring counters
+        self.sent = 0
+
+    def _connect(self):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            sock = socket.socket(_family(self.address), socket.SOCK_STREAM)
+            try:
+                sock.connect(self.address)
+                break
+
+            except (ConnectionRefusedError, FileNotFoundError):
+                sock.close()
+                if time.monotonic() > deadline:
+                    raise
+
+                time.sleep(_POLL)
+
+        if sock.family != socket.AF_UNIX:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        self._link = _Link(sock)
+
+    def _poll(self, timeout):
+        """Reads credit and cancel frames, waiting up to timeout for them"""
+        readable, _, _ = select.select([self._link], [], [], timeout)
+        if not readable:
+            return
+
+        try:
+            frames = self._link.receive()
+        except ConnectionError:
+            # The receiver is gone, same as a cancel
+            self._cancelled = True
+            return
+
+        for kind, payload in frames:
+            if kind == _CREDIT:
+                self._credit += _COUNT.unpack(payload)[0]
+            elif kind == _CANCEL:
+                self._cancelled = True
+
+    def _send(self, kind, payload=b""):
+        try:
+            self._link.send(kind, payload)
+        except ConnectionError:
+            self.finish()
+
+    def run(self):
+        if self._link is None:
+            self._connect()
+
+        self._poll(0 if self._credit else _POLL)
+        if self._cancelled:
+            self.finish()
+        if not self._credit:
+            return False
+
+        packets = self.try_get_batch(min(self._credit, self.batch_size))
+        if packets is Empty:
+            return False
+        if packets is EOF:
+            self._send(_EOF)
+            self.finish()
+
+        self._send(_DATA, pickle.dumps(packets, pickle.HIGHEST_PROTOCOL))
+        self._credit -= len(packets)
+        self.sent += len(packets)
+        return True
+
+    def close(self):
+        if self._link is not None:
+            self._link.close()
@@ -0,0 +1,664 @@
+import multiprocessing
+import multiprocessing.connection
+import os
+import pickle
+import struct
+import sys
+import time
+import traceback
+from multiprocessing.shared_memory import SharedMemory
+
+from .core import EOF, Element, Empty, Pipeline, WriteError
+from .parallel import WorkerError
+
+# Ring layout: write and read counters on their own cache lines, the closed
+# and dropped flags, then the data area
+_HEAD = 0
+_TAIL = 64
+_CLOSED = 128
+_DROPPED = 129
+_DATA = 192
+
+_COUNTER = struct.Struct("=Q")
+
+# Records are a payload size and a kind followed by the payload, padded to 8
+_RECORD = struct.Struct("=IB3x")
+
+_BYTES = 1
+_PICKLE = 2
+_SHARED = 3
+_WRAP = 0xFF
+
+# Flag for _BYTES and _PICKLE records too large for the ring, their payload
+# lives in a segment of its own like a SharedBuffer
+_SEGMENT = 0x80
+
+# Payload of segment records: size, then the segment name
+_SEGMENT_REF = struct.Struct("=Q")
+
+# Packets moved per run by ShmSink and ShmSrc
+_BATCH = 1024
+
+# Longest ShmSrc waits for data before giving the pipeline a chance to
+# cancel it
+_POLL = 0.05
+
+
+class SharedBuffer:
+    """
+    Packet of bytes stored in its own shared memory segment. Crossing a
+    ProcessPipeline boundary only sends the segment name, the receiving
+    process maps the same memory so the payload isn't copied. Producers can
+    create one and fill buf directly to skip the copy into shared memory.
+    It isn't bytes-like itself, consumers read it through buf or bytes().
+    The segment is freed by release or once the buffer is garbage collected
+    in the process holding it last. Keep the buffer alive while using views
+    of buf.
+    """
+
+    def __init__(self, size, _name=None):
+        if _name is None:
+            self._shm = SharedMemory(create=True, size=max(1, size))
+        else:
+            self._shm = SharedMemory(name=_name)
+
+        self.size = size
+        self._owned = True
+
+        # Forked children inherit the buffer, only its creator frees it
+        self._pid = os.getpid()
+
+    @classmethod
+    def copy_of(cls, data):
+        """Returns a SharedBuffer with a copy of bytes-like data"""
+        view = memoryview(data).cast("B")
+        buffer = cls(view.nbytes)
+        buffer._shm.buf[: view.nbytes] = view
+        return buffer
+
+    @property
+    def buf(self):
+        """memoryview of the payload"""
+        return self._shm.buf[: self.size]
+
+    def __len__(self):
+        return self.size
+
+    def __bytes__(self):
+        return bytes(self._shm.buf[: self.size])
+
+    def tobytes(self):
+        return bytes(self)
+
+    def release(self):
+        """Frees the segment"""
+        if self._owned:
+            self._owned = False
+            self._shm.unlink()
+
+        self._close()
+
+    def _close(self):
+        try:
+            self._shm.close()
+        except BufferError:
+            # Views of buf are still around, the memory stays mapped
+            # until they are gone
+            pass
+
+    def _send(self):
+        """Returns the record payload naming the segment and hands the
+        segment over to the receiving side
+        """
+        payload = _SEGMENT_REF.pack(self.size) + self._shm.name.encode()
+        self._owned = False
+        self._close()
+        return payload
+
+    @classmethod
+    def _receive(cls, payload):
+        size = _SEGMENT_REF.unpack_from(payload)[0]
+        return cls(size, _name=bytes(payload[_SEGMENT_REF.size :]).decode())
+
+    def __del__(self):
+        if getattr(self, "_owned", False) and os.getpid() == self._pid:
+            self._shm.unlink()
+
+
+def _encode(packet, zero_copy, threshold, max_record):
+    """Returns the (kind, payload) record for packet"""
+    if isinstance(packet, SharedBuffer):
+        return _SHARED, packet._send()
+
+    if isinstance(packet, (bytes, bytearray, memoryview)):
+        if zero_copy and memoryview(packet).nbytes > threshold:
+            return _SHARED, SharedBuffer.copy_of(packet)._send()
+
+        if isinstance(packet, bytearray):
+            kind, data = _PICKLE, pickle.dumps(packet, pickle.HIGHEST_PROTOCOL)
+        else:
+            # Small memoryviews arrive as bytes
+            kind, data = _BYTES, bytes(packet)
+
+    else:
+        kind, data = _PICKLE, pickle.dumps(packet, pickle.HIGHEST_PROTOCOL)
+
+    if memoryview(data).nbytes > max_record:
+        return kind | _SEGMENT, SharedBuffer.copy_of(data)._send()
+
+    return kind, data
+
+
+def _decode(kind, view):
+    if kind == _BYTES:
+        return bytes(view)
+    if kind == _PICKLE:
+        return pickle.loads(view)
+
+    buffer = SharedBuffer._receive(view)
+    if kind == _SHARED:
+        return buffer
+
+    data = buffer.buf
+    try:
+        if kind == _BYTES | _SEGMENT:
+            return bytes(data)
+        return pickle.loads(data)
+
+    finally:
+        data.release()
+        buffer.release()
+
+
+def _discard(kind, payload):
+    """Frees the segment of a record that won't be read"""
+    if kind == _SHARED or kind & _SEGMENT:
+        SharedBuffer._receive(payload).release()
+
+
+def _pause(delay, monitor):
+    """Sleeps with exponential backoff up to 1ms, returns the next delay"""
+    if monitor is not None:
+        monitor()
+
+    time.sleep(delay)
+    return min(max(2 * delay, 1e-5), 1e-3)
+
+
+class ShmRing:
+    """
+    Single writer, single reader ring buffer of records in shared memory,
+    the cross process counterpart of Channel. Records written are published
+    to the reader by flush and the room of records read is given back to the
+    writer by commit, so each side touches the other's counter once per
+    batch. Counters are 8 byte aligned stores, atomic on the platforms
+    multiprocessing.shared_memory supports.
+    Parameters:
+    - capacity: bytes of the data area, records up to a quarter of it are
+      stored inline
+    """
+
+    def __init__(self, capacity=1 << 22, _name=None):
+        capacity = (capacity + 7) & ~7
+        if capacity < 1024:
+            raise ValueError("capacity must be at least 1024 bytes")
+
+        if _name is None:
+            self._shm = SharedMemory(create=True, size=_DATA + capacity)
+        else:
+            self._shm = SharedMemory(name=_name)
+
+        self.capacity = capacity
+        self.max_record = capacity // 4
+        self._buf = self._shm.buf
+
+        # Local counters and last seen values of the other side's one
+        self._head = self._tail = 0
+        self._seen_head = self._seen_tail = 0
+
+    def __reduce__(self):
+        return (ShmRing, (self.capacity, self._shm.name))
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    @property
+    def closed(self):
+        return self._buf[_CLOSED] == 1
+
+    @property
+    def dropped(self):
+        return self._buf[_DROPPED] == 1
+
+    def try_write(self, kind, data):
+        """Appends a record, returns False if there is no room for it"""
+        size = memoryview(data).nbytes
+        need = _RECORD.size + ((size + 7) & ~7)
+        pos = self._head % self.capacity
+        skip = self.capacity - pos if pos + need > self.capacity else 0
+
+        end = self._head + skip + need
+        if end - self._seen_tail > self.capacity:
+            self._seen_tail = _COUNTER.unpack_from(self._buf, _TAIL)[0]
+            if end - self._seen_tail > self.capacity:
+                return False
+
+        if skip:
+            _RECORD.pack_into(self._buf, _DATA + pos, 0, _WRAP)
+            pos = 0
+
+        offset = _DATA + pos + _RECORD.size
+        _RECORD.pack_into(self._buf, offset - _RECORD.size, size, kind)
+        self._buf[offset : offset + size] = data
+        self._head = end
+        return True
+
+    def flush(self):
+        """Publishes the records written so far"""
+        _COUNTER.pack_into(self._buf, _HEAD, self._head)
+
+    def read(self, n):
+        """Returns up to n published (kind, payload) records, payloads are
+        views of the ring valid until commit
+        """
+        if self._tail == self._seen_head:
+            self._seen_head = _COUNTER.unpack_from(self._buf, _HEAD)[0]
+
+        records = []
+        buf, tail = self._buf, self._tail
+        while tail < self._seen_head and len(records) < n:
+            pos = tail % self.capacity
+            size, kind = _RECORD.unpack_from(buf, _DATA + pos)
+            if kind == _WRAP:
+                tail += self.capacity - pos
+                continue
+
+            offset = _DATA + pos + _RECORD.size
+            records.append((kind, buf[offset : offset + size]))
+            tail += _RECORD.size + ((size + 7) & ~7)
+
+        self._tail = tail
+        return records
+
+    def commit(self):
+        """Gives the room of the records read back to the writer"""
+        _COUNTER.pack_into(self._buf, _TAIL, self._tail)
+
+    def close(self):
+        """Marks the ring as having no writer"""
+        self.flush()
+        self._buf[_CLOSED] = 1
+
+    def drop(self):
+        """Marks the ring as having no reader"""
+        self._buf[_DROPPED] = 1
+
+    def unlink(self):
+        """Frees the ring along with the segments of records never read,
+        called by its creator once both sides are done
+        """
+        self._tail = _COUNTER.unpack_from(self._buf, _TAIL)[0]
+        self._seen_head = _COUNTER.unpack_from(self._buf, _HEAD)[0]
+        for kind, payload in self.read(sys.maxsize):
+            _discard(kind, payload)
+            payload.release()
+
+        self._buf.release()
+        self._shm.close()
+        self._shm.unlink()
+
+
+class ShmSink(Element):
+    """
+    Writes its input packets into a ShmRing read by a ShmSrc, usually in
+    another process. Closes the ring on EOF and finishes once the reader
+    drops it.
+    Parameters:
+    - ring: ShmRing to write to
+    - zero_copy: move bytes, bytearray and memoryview packets larger than
+      threshold in SharedBuffers, they arrive as SharedBuffers so only
+      enable it if the consumers accept those. Otherwise they arrive as
+      bytes
+    - threshold: see zero_copy, by default the largest record stored in the
+      ring. Below about a megabyte copying through the ring is faster than
+      setting up a segment
+    """
+
+    threaded = True
+    mutates_input = False
+
+    def __init__(self, ring=None, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        if not isinstance(ring, ShmRing):
+            raise ValueError("ring is not a ShmRing")
+
+        self.ring = ring
+        self.zero_copy = self.kwargs.get("zero_copy", False)
+        self.threshold = self.kwargs.get("threshold") or ring.max_record
+
+        # Called while waiting for room, raises if the reader process died
+        self.monitor = None
+
+    def run(self):
+        ring = self.ring
+        if ring.dropped:
+            self.finish()
+
+        packets = self.try_get_batch(_BATCH)
+        if packets is Empty:
+            return False
+        if packets is EOF:
+            self.finish()
+
+        delay = 0
+        for packet in packets:
+            kind, data = _encode(
+                packet, self.zero_copy, self.threshold, ring.max_record
+            )
+            while not ring.try_write(kind, data):
+                ring.flush()
+                if ring.dropped:
+                    _discard(kind, data)
+                    self.finish()
+
+                delay = _pause(delay, self.monitor)
+
+        ring.flush()
+        return True
+
+    def close(self):
+        self.ring.close()
+
+
+class ShmSrc(Element):
+    """
+    Emits the packets written into a ShmRing by a ShmSink, finishing once
+    the ring is closed and drained. Drops the ring if cancelled.
+    Parameters:
+    - ring: ShmRing to read from
+    """
+
+    threaded = True
+
+    def __init__(self, ring=None, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        if not isinstance(ring, ShmRing):
+            raise ValueError("ring is not a ShmRing")
+
+        self.ring = ring
+        self._eof = False
+
+        # Called while waiting for data, raises if the writer process died
+        self.monitor = None
+
+    def run(self):
+        ring = self.ring
+        delay, deadline = 0, time.monotonic() + _POLL
+        while True:
+            closed = ring.closed
+            records = ring.read(_BATCH)
+            if records:
+                break
+
+            if closed:
+                self._eof = True
+                self.finish()
+
+            if time.monotonic() > deadline:
+                return False
+
+            delay = _pause(delay, self.monitor)
+
+        put = self.write_queue().put
+        for kind, payload in records:
+            put(_decode(kind, payload))
+            payload.release()
+
+        ring.commit()
+        return True
+
+    def close(self):
+        if not self._eof:
+            self.ring.drop()
+
+
+def _build(pipe, spec, monitor=None, **kwargs):
+    """Connects a partition into pipe, boundary channels become ShmSinks and
+    ShmSrcs. Packets pending in the original channels are carried over
+    """
+    links, outgoing, incoming = spec
+
+    for src, output, sink, input, maxsize, packets in links:
+        pipe.connect(src, sink, output, input, maxsize)
+        for packet in packets:
+            pipe.put_packet(src, packet, output)
+
+    for src, output, ring, maxsize, packets in outgoing:
+        sink = ShmSink(ring, **kwargs)
+        sink.monitor = monitor
+        pipe.connect(src, sink, output, "default", maxsize)
+        for packet in packets:
+            pipe.put_packet(src, packet, output)
+
+    for ring, sink, input, maxsize in incoming:
+        src = ShmSrc(ring)
+        src.monitor = monitor
+        pipe.connect(src, sink, "default", input, maxsize)
+
+    return pipe
+
+
+def _run_partition(spec, options, sink_options, conn):
+    parent = os.getppid()
+
+    def monitor():
+        if os.getppid() != parent:
+            raise WorkerError("Parent process died")
+
+    try:
+        pipe = Pipeline(**options)
+        _build(pipe, spec, monitor=monitor, **sink_options).execute()
+
+    except BaseException:
+        conn.send(traceback.format_exc())
+        sys.exit(1)
+
+    conn.send(None)
+
+
+class ProcessPipeline(Pipeline):
+    """
+    Pipeline split into partitions running in their own processes, for
+    graphs with several CPU-bound stages. Elements are connected as usual and
+    boundary marks the channels to cut, otherwise partitions=N cuts the
+    topological order in N slices with about the same number of elements
+    having both inputs and outputs. Each part of the graph still connected
+    once the cuts are removed runs in a process, talking to the others
+    through ShmRings, the one holding the last element runs in the calling
+    process so sinks there keep their packets. Elements in other partitions
+    run on copies in the worker processes, pickled unless forked.
+    Parameters, besides Pipeline's:
+    - partitions: slices to cut the graph into if no boundary is marked
+    - ring_size: bytes of each ShmRing
+    - zero_copy, threshold: see ShmSink
+    - mp_context: multiprocessing context of the worker processes
+    """
+
+    def __init__(
+        self,
+        maxsize=0,
+        workers=None,
+        threaded=False,
+        profile=False,
+        partitions=1,
+        ring_size=1 << 22,
+        zero_copy=False,
+        threshold=None,
+        mp_context=None,
+    ):
+        super().__init__(
+            maxsize=maxsize, workers=workers, threaded=threaded, profile=profile
+        )
+
+        if partitions < 1:
+            raise ValueError("partitions must be greater than 0")
+
+        self.partitions = partitions
+        self.ring_size = ring_size
+        self.zero_copy = zero_copy
+        self.threshold = threshold
+        self.mp_context = mp_context
+
+        # Channels to cut, used as an ordered set of (src, output) tuples
+        self._boundaries = {}
+
+        self._processes = []
+        self._conns = []
+
+    def boundary(self, src, output="default"):
+        """Marks the channel from src's output as a partition boundary"""
+        if (src, output) not in self._rels:
+            raise WriteError(f"Queue '{output}' not defined for '{src}'")
+
+        self._boundaries[(src, output)] = None
+        return self
+
+    def _auto_boundaries(self):
+        # Sources and sinks are usually cheap, they don't weigh
+        n = self.partitions
+        weights = {
+            e for e in self._order if e in self._src_ports and e in self._sink_ports
+        } or set(self._order)
+
+        slices, part, acc = {}, 0, 0
+        for element in self._order:
+            slices[element] = part
+            acc += element in weights
+            if part < n - 1 and acc >= (part + 1) * len(weights) / n:
+                part += 1
+
+        return [
+            (src, output)
+            for (src, output), (sink, _) in self._rels.items()
+            if slices[src] != slices[sink]
+        ]
+
+    def _partitions(self):
+        """Returns the lists of elements running together, the last one in
+        this process, and the channels cut between them
+        """
+        if self._order is None:
+            self._prepare()
+
+        cuts = dict(self._boundaries)
+        if not cuts and self.partitions > 1:
+            cuts = dict.fromkeys(self._auto_boundaries())
+
+        neighbours = {e: [] for e in self._elements}
+        for (src, output), (sink, _) in self._rels.items():
+            if (src, output) not in cuts:
+                neighbours[src].append(sink)
+                neighbours[sink].append(src)
+
+        position = {e: idx for (idx, e) in enumerate(self._order)}
+        groups, seen = [], set()
+        for element in self._order:
+            if element in seen:
+                continue
+
+            seen.add(element)
+            group, pending = [], [element]
+            while pending:
+                e = pending.pop()
+                group.append(e)
+                for n in neighbours[e]:
+                    if n not in seen:
+                        seen.add(n)
+                        pending.append(n)
+
+            groups.append(sorted(group, key=position.get))
+
+        # Stable, keeps the rest in topological order
+        last = self._order[-1] if self._order else None
+        groups.sort(key=lambda g: last in g)
+
+        return groups, cuts
+
+    def _check_workers(self):
+        """Raises WorkerError if a worker process failed"""
+        for process, conn in zip(self._processes, self._conns):
+            if process.exitcode in (None, 0):
+                continue
+
+            error = conn.recv() if conn.poll() else None
+            raise WorkerError(
+                f"Partition process {process.pid} failed"
+                + (f":\n{error}" if error else f" with exit code {process.exitcode}")
+            )
+
+    def execute(self):
+        groups, cuts = self._partitions()
+        if len(groups) < 2:
+            return super().execute()
+
+        rings = {key: ShmRing(self.ring_size) for key in cuts}
+        group_of = {e: idx for (idx, group) in enumerate(groups) for e in group}
+
+        specs = [([], [], []) for _ in groups]
+        for (src, output), (sink, input) in self._rels.items():
+            q = self._queues[(src, output)]
+            packets = list(q)
+            if (src, output) in rings:
+                ring = rings[(src, output)]
+                specs[group_of[src]][1].append((src, output, ring, q.maxsize, packets))
+                specs[group_of[sink]][2].append((ring, sink, input, q.maxsize))
+            else:
+                specs[group_of[src]][0].append(
+                    (src, output, sink, input, q.maxsize, packets)
+                )
+
+        options = dict(
+            maxsize=self.maxsize, workers=self.workers, threaded=self.threaded
+        )
+        sink_options = dict(zero_copy=self.zero_copy, threshold=self.threshold)
+        ctx = self.mp_context or multiprocessing.get_context()
+
+        try:
+            # Workers are started before this process runs any thread
+            for spec in specs[:-1]:
+                reader, writer = ctx.Pipe(duplex=False)
+                process = ctx.Process(
+                    target=_run_partition,
+                    args=(spec, options, sink_options, writer),
+                    daemon=True,
+                )
+                process.start()
+                writer.close()
+
+                self._processes.append(process)
+                self._conns.append(reader)
+
+            local = Pipeline(profile=self.profiler is not None, **options)
+            self.profiler = local.profiler
+            _build(local, specs[-1], monitor=self._check_workers, **sink_options)
+            local.execute()
+
+            while any(p.is_alive() for p in self._processes):
+                self._check_workers()
+                multiprocessing.connection.wait(
+                    [p.sentinel for p in self._processes], timeout=_POLL
+                )
+
+            self._check_workers()
+
+        finally:
+            for process in self._processes:
+                if process.is_alive():
+                    process.terminate()
+                process.join()
+
+            for ring in rings.values():
+                ring.unlink()
@@ -0,0 +1,108 @@
+import os
+import pickle
+import tempfile
+import weakref
+
+
+def dump_packets(fh, packets):
+    """Appends packets to fh as a stream of pickles, one per packet"""
+    pickler = pickle.Pickler(fh, protocol=pickle.HIGHEST_PROTOCOL)
+    for packet in packets:
+        pickler.dump(packet)
+        # Packets are independent records, don't share memo entries
+        pickler.clear_memo()
+
+
+def load_packets(fh):
+    """Yields the packets of a stream written by dump_packets"""
+    # Each record has its own memo, a shared Unpickler would mix them up
+    load = pickle.load
+    while True:
+        try:
+            yield load(fh)
+        except EOFError:
+            return
+
+
+def _remove(fh, path):
+    fh.close()
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+class SpillBuffer:
+    """
+    Append only sequence of packets keeping at most max_packets of them in
+    memory, older packets are spilled to a temporary file as a pickle stream.
+    Iterating reads spilled packets back lazily, from a separate handle, so
+    the buffer can be iterated many times. The file is removed by close or
+    when the buffer is garbage collected.
+    Parameters:
+    - max_packets: packets kept in memory, 0 keeps everything in memory
+    - dir: directory for the temporary file, see tempfile
+    """
+
+    def __init__(self, max_packets=0, dir=None):
+        if max_packets < 0:
+            raise ValueError("max_packets must be 0 or greater")
+
+        self.max_packets = max_packets
+        self.dir = dir
+
+        self._memory = []
+        self._spilled = 0
+        self._fh = None
+        self._path = None
+        self._finalizer = None
+
+    def __len__(self):
+        return self._spilled + len(self._memory)
+
+    def __iter__(self):
+        # Snapshot, packets appended while iterating are not returned
+        spilled, memory = self._spilled, list(self._memory)
+
+        if spilled:
+            self._fh.flush()
+            with open(self._path, "rb") as fh:
+                for _, packet in zip(range(spilled), load_packets(fh)):
+                    yield packet
+
+        yield from memory
+
+    @property
+    def spilled(self):
+        """Number of packets stored on disk"""
+        return self._spilled
+
+    def append(self, packet):
+        self._memory.append(packet)
+        if self.max_packets and len(self._memory) > self.max_packets:
+            self._spill()
+
+    def extend(self, packets):
+        for packet in packets:
+            self.append(packet)
+
+    def _spill(self):
+        if self._fh is None:
+            fd, self._path = tempfile.mkstemp(prefix="pypes-", dir=self.dir)
+            self._fh = os.fdopen(fd, "wb")
+            self._finalizer = weakref.finalize(self, _remove, self._fh, self._path)
+
+        dump_packets(self._fh, self._memory)
+        self._spilled += len(self._memory)
+        self._memory = []
+
+    def close(self):
+        """Discards every packet and removes the temporary file"""
+        if self._finalizer is not None:
+            self._finalizer()
+
+        self._memory = []
+        self._spilled = 0
+        self._fh = None
+        self._path = None
+        self._finalizer = None
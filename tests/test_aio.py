@@ -0,0 +1,119 @@
+import asyncio
+import http.server
+import threading
+import unittest
+import urllib.error
+
+from pypes.aio import AsyncFetcherProcessor, AsyncHttpSrc, AsyncPipeline
+from pypes.core import Element, Transformer
+from pypes.elements import Adder, GeneratorSrc, Head, SampleSrc, StoreSink, Zip
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = self.path.encode("utf-8")
+        self.send_response(200 if self.path != "/missing" else 404)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class AsyncDoubler(Transformer):
+    async def transform(self, x):
+        # Later packets finish first
+        await asyncio.sleep(0.01 / (x + 1))
+        return x * 2
+
+
+class AsyncCounterSrc(Element):
+    def __init__(self, *args, n=0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.n = n
+        self.i = 0
+
+    async def run(self):
+        if self.i >= self.n:
+            self.finish()
+
+        await self.aput(self.i)
+        self.i += 1
+
+
+class TestAsyncPipeline(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        cls.base = "http://127.0.0.1:%d" % cls.server.server_address[1]
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def test_sync_elements(self):
+        src, adder, sink = SampleSrc(sample=[1, 2, 3]), Adder(amount=1), StoreSink()
+        AsyncPipeline().connect_many(src, adder, sink).execute()
+
+        self.assertEqual(sink.packets, [2, 3, 4])
+
+    def test_zip_uneven(self):
+        srcs = [GeneratorSrc(generator=iter(range(n))) for n in (1, 50, 7)]
+        zip, sink = Zip(n_inputs=3), StoreSink()
+
+        pipe = AsyncPipeline()
+        for idx, src in enumerate(srcs):
+            pipe.connect(src, zip, "default", "zip_%02d" % idx)
+        pipe.connect(zip, sink)
+        pipe.execute()
+
+        self.assertEqual(len(sink.packets), 58)
+        self.assertFalse(pipe._elements)
+
+    def test_async_run_and_transform(self):
+        src = AsyncCounterSrc(n=50)
+        trans = AsyncDoubler(concurrency=10)
+        sink = StoreSink()
+        AsyncPipeline(maxsize=4).connect_many(src, trans, sink).execute()
+
+        self.assertEqual(sink.packets, [x * 2 for x in range(50)])
+
+    def test_head_cancels_upstream(self):
+        src = AsyncCounterSrc(n=10**9)
+        doubler, head, sink = AsyncDoubler(concurrency=4), Head(n=5), StoreSink()
+
+        pipe = AsyncPipeline(maxsize=8).connect_many(src, doubler, head, sink)
+        pipe.execute()
+
+        self.assertEqual(sink.packets, [0, 2, 4, 6, 8])
+        self.assertLess(src.i, 100)
+        self.assertFalse(pipe._elements)
+
+    def test_fetcher(self):
+        urls = [f"{self.base}/{i}" for i in range(30)]
+        src, fetcher, sink = (
+            SampleSrc(sample=list(urls)),
+            AsyncFetcherProcessor(concurrency=8),
+            StoreSink(),
+        )
+        AsyncPipeline().connect_many(src, fetcher, sink).execute()
+
+        self.assertEqual(sink.packets, [f"/{i}".encode() for i in range(30)])
+
+    def test_http_src(self):
+        src, sink = AsyncHttpSrc(url=self.base + "/index"), StoreSink()
+        AsyncPipeline().connect(src, sink).execute()
+
+        self.assertEqual(sink.packets, [b"/index"])
+
+    def test_http_error(self):
+        src, sink = AsyncHttpSrc(url=self.base + "/missing"), StoreSink()
+        with self.assertRaises(urllib.error.HTTPError):
+            AsyncPipeline().connect(src, sink).execute()
+
+
+if __name__ == "__main__":
+    unittest.main()
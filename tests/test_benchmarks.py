@@ -0,0 +1,61 @@
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import tempfile
+import unittest
+
+from benchmarks import bench_bs4, bench_import, bench_mediaocd, bench_pipeline
+
+
+class TestBenchmarks(unittest.TestCase):
+    def test_smoke(self):
+        fd, path = tempfile.mkstemp(suffix=".json")
+        os.close(fd)
+        self.addCleanup(os.unlink, path)
+
+        argv = ["--scale", "0.001", "--repeat", "1", "--output", path]
+        with contextlib.redirect_stdout(io.StringIO()):
+            bench_pipeline.main(bench_pipeline.BENCHMARKS, argv)
+            doc = bench_pipeline.main(
+                bench_pipeline.BENCHMARKS, argv[:4] + ["--compare", path]
+            )
+
+        with open(path) as fh:
+            stored = json.load(fh)
+
+        self.assertEqual(set(stored["results"]), set(bench_pipeline.BENCHMARKS))
+        for result in doc["results"].values():
+            self.assertTrue(result["packets_per_sec"] > 0)
+            self.assertIn("peak_memory", result)
+
+    def test_mediaocd_smoke(self):
+        argv = ["--scale", "0.0001", "--repeat", "1", "--no-memory"]
+        with contextlib.redirect_stdout(io.StringIO()):
+            doc = bench_mediaocd.main(bench_mediaocd.BENCHMARKS, argv)
+
+        self.assertEqual(set(doc["results"]), set(bench_mediaocd.BENCHMARKS))
+
+    @unittest.skipIf(
+        importlib.util.find_spec("bs4") is None, "beautifulsoup4 not available"
+    )
+    def test_bs4_smoke(self):
+        argv = ["--scale", "0.01", "--repeat", "1", "--no-memory"]
+        with contextlib.redirect_stdout(io.StringIO()):
+            doc = bench_bs4.main(bench_bs4.BENCHMARKS, argv)
+
+        self.assertEqual(set(doc["results"]), set(bench_bs4.BENCHMARKS))
+
+    def test_import_smoke(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            doc = bench_import.main(bench_import.MODULES, ["--repeat", "1"])
+
+        self.assertEqual(set(doc["results"]), set(bench_import.MODULES))
+        self.assertEqual(doc["failed"], [])
+        for result in doc["results"].values():
+            self.assertTrue(result["import_us"] > 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
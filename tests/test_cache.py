@@ -0,0 +1,158 @@
+import os
+import pickle
+import tempfile
+import unittest
+
+from pypes import Pipeline, Transformer
+from pypes.cache import MISSING, DiskCache, LFUCache, LRUCache, TTLCache
+from pypes.elements import DictFixer, NullSink, SampleSrc, StoreSink
+
+
+class CountingTransformer(Transformer):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.calls = []
+
+    def transform(self, x):
+        self.calls.append(x)
+        return x * 2
+
+
+class CountingBatchTransformer(CountingTransformer):
+    def transform_batch(self, xs):
+        self.calls.append(list(xs))
+        return [x * 2 for x in xs]
+
+
+class DictTransformer(Transformer):
+    def transform(self, x):
+        return {"x": x}
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestCache(unittest.TestCase):
+    def test_lru(self):
+        cache = LRUCache(max_size=2)
+        cache.store("a", 1)
+        cache.store("b", 2)
+        cache.lookup("a")
+        cache.store("c", 3)
+
+        self.assertEqual(cache.lookup("a"), 1)
+        self.assertIs(cache.lookup("b"), MISSING)
+        self.assertEqual(
+            cache.stats(), {"hits": 2, "misses": 1, "evictions": 1, "size": 2}
+        )
+
+    def test_lfu(self):
+        cache = LFUCache(max_size=2)
+        cache.store("a", 1)
+        cache.store("b", 2)
+        for _ in range(3):
+            cache.lookup("a")
+        cache.lookup("b")
+
+        # b has fewer uses than a, c is the newest
+        cache.store("c", 3)
+        self.assertIs(cache.lookup("b"), MISSING)
+        cache.store("d", 4)
+        self.assertIs(cache.lookup("c"), MISSING)
+        self.assertEqual(cache.lookup("a"), 1)
+        self.assertEqual(cache.lookup("d"), 4)
+
+    def test_ttl(self):
+        clock = FakeClock()
+        cache = TTLCache(ttl=10, clock=clock)
+        cache.store("a", 1)
+
+        clock.now = 5
+        cache.store("b", 2)
+        self.assertEqual(cache.lookup("a"), 1)
+
+        clock.now = 12
+        self.assertIs(cache.lookup("a"), MISSING)
+        self.assertEqual(cache.lookup("b"), 2)
+
+        clock.now = 20
+        cache.store("c", 3)
+        self.assertEqual(len(cache), 1)
+
+    def test_disk(self):
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, "cache.db")
+            cache = DiskCache(path, max_size=2)
+            cache.store("a", {"x": 1})
+            cache.store(("b", 1), [2])
+            cache.store("c", 3)
+            cache.close()
+
+            # Survives reopening
+            cache = DiskCache(path)
+            self.assertIs(cache.lookup("a"), MISSING)
+            self.assertEqual(cache.lookup(("b", 1)), [2])
+            self.assertEqual(cache.lookup("c"), 3)
+            self.assertEqual(len(cache), 2)
+            cache.close()
+
+    def test_transformer(self):
+        t, sink = CountingTransformer(cache="lru"), StoreSink()
+        src = SampleSrc(sample=[1, 2, 1, 1, 3, 2])
+        Pipeline().connect_many(src, t, sink).execute()
+
+        self.assertEqual(sink.packets, [2, 4, 2, 2, 6, 4])
+        self.assertEqual(t.calls, [1, 2, 3])
+        self.assertEqual(t.cache.hits, 3)
+
+    def test_transformer_key(self):
+        t = CountingTransformer(cache=LRUCache(), cache_key=lambda x: x % 2)
+        sink = StoreSink()
+        Pipeline().connect_many(SampleSrc(sample=[1, 3, 2]), t, sink).execute()
+
+        self.assertEqual(sink.packets, [2, 2, 4])
+        self.assertEqual(t.calls, [1, 2])
+
+    def test_transformer_batch(self):
+        t = CountingBatchTransformer(cache="lfu", batch_size=8)
+        sink = StoreSink()
+        sample = [1, 2, 3, 1, 2, 4, 5, 1] * 3
+        Pipeline().connect_many(SampleSrc(sample=list(sample)), t, sink).execute()
+
+        self.assertEqual(sink.packets, [x * 2 for x in sample])
+        self.assertEqual(sorted(x for batch in t.calls for x in batch), [1, 2, 3, 4, 5])
+
+    def test_transformer_copies_results(self):
+        for batch_size in (1, 4):
+            t = DictTransformer(cache="lru", batch_size=batch_size)
+            fixer = DictFixer(values={"x": 99}, override=True)
+            sink = StoreSink()
+            src = SampleSrc(sample=[1, 1, 1])
+            Pipeline().connect_many(src, t, fixer, sink).execute()
+
+            self.assertEqual(sink.packets, [{"x": 99}] * 3)
+            self.assertEqual(len({id(p) for p in sink.packets}), 3)
+            self.assertEqual(t.cache.lookup(1), {"x": 1})
+
+    def test_transformer_shares_results(self):
+        t = DictTransformer(cache="lru")
+        Pipeline().connect_many(SampleSrc(sample=[1, 1]), t, NullSink()).execute()
+
+        self.assertIs(t.transform(1), t.cache.lookup(1))
+
+    def test_pickle(self):
+        t = pickle.loads(pickle.dumps(CountingTransformer(cache="lru")))
+        t.transform(1)
+        t.transform(1)
+
+        self.assertEqual(t.calls, [1])
+        self.assertEqual(t.cache.hits, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
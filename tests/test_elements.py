@@ -1,17 +1,31 @@
+import os
+import pickle
+import random
 import tempfile
+import time
 import unittest
 
 from pypes import Pipeline
 from pypes.bs4 import Soup
 from pypes.elements import (
+    Adder,
     CustomFilter,
+    CustomTransformer,
+    DictFilter,
+    DictFixer,
+    FetcherProcessor,
     Filter,
+    Head,
     HttpSrc,
+    Packer,
+    PickleSink,
+    PickleSrc,
     SampleSrc,
     StoreSink,
     Transformer,
 )
 from pypes.file import FileSink, FileSrc
+from pypes.spill import SpillBuffer, load_packets
 
 
 class TestTransformer(Transformer):
@@ -34,6 +48,12 @@ class TestFilter(Filter):
             return False
 
 
+class SleepyFetcher:
+    def fetch(self, url):
+        time.sleep(random.random() / 20)
+        return url.upper()
+
+
 class TestElements(unittest.TestCase):
     def test_transfomer(self):
         src, trans, sink = SampleSrc(sample=[1, "a", 2]), TestTransformer(), StoreSink()
@@ -60,6 +80,29 @@ class TestElements(unittest.TestCase):
         Pipeline().connect_many(src, soup, store).execute()
         self.assertTrue(len(store.packets) > 0)
 
+    def test_soup_split(self):
+        html = (
+            '<html><body><p>skip</p><div><a class="x">1</a><a>2</a></div>'
+            '<div><a class="x">3</a></div></body></html>'
+        )
+        for kwargs, expected in (
+            ({}, [["1", "3"]]),
+            ({"split": True, "output": "text"}, ["1", "3"]),
+            (
+                {"split": True, "output": "html", "parse_only": "div"},
+                ['<a class="x">1</a>', '<a class="x">3</a>'],
+            ),
+        ):
+            store = StoreSink()
+            Pipeline().connect_many(
+                SampleSrc(sample=[html]),
+                Soup(selector="div a.x", parser="html.parser", **kwargs),
+                store,
+            ).execute()
+            if not kwargs:
+                store.packets = [[a.get_text() for a in p] for p in store.packets]
+            self.assertEqual(store.packets, expected)
+
     def test_lambda(self):
         src, filt, store = (
             SampleSrc(sample=[1, 3, 5, 7, 11]),
@@ -84,6 +127,214 @@ class TestElements(unittest.TestCase):
         with open(t2.name) as fh:
             self.assertEqual(fh.read(), contents)
 
+    def test_batch(self):
+        src = SampleSrc(sample=[{"a": i, "b": i} for i in range(10)])
+        fixer = DictFixer(values={"a": -1, "c": 0}, batch_size=4)
+        filt = DictFilter(keys=("a", "c"), batch_size=3)
+        head = Head(5, batch_size=4)
+        extract = CustomTransformer(func=lambda x: x["a"], batch_size=2)
+        adder = Adder(amount=1, batch_size=8)
+        trans = TestTransformer(batch_size=3)
+        sink = StoreSink()
+
+        pipe = Pipeline()
+        pipe.connect_many(src, fixer, filt, head, extract, adder, trans, sink)
+        pipe.execute()
+
+        self.assertEqual(sink.packets, [2, 4, 6, 8, 10])
+
+    def test_batch_filter(self):
+        src, filt, sink = (
+            SampleSrc(sample=[1, "a", 3, "8", 53, 22]),
+            TestFilter(batch_size=4),
+            StoreSink(),
+        )
+        Pipeline().connect_many(src, filt, sink).execute()
+
+        self.assertEqual(sink.packets, ["8", 22])
+
+    def test_custom_batch_func(self):
+        calls = []
+
+        def double_all(xs):
+            calls.append(len(xs))
+            return [x * 2 for x in xs]
+
+        src, trans, sink = (
+            SampleSrc(sample=[1, 2, 3]),
+            CustomTransformer(
+                func=lambda x: x * 2, batch_func=double_all, batch_size=10
+            ),
+            StoreSink(),
+        )
+        Pipeline().connect_many(src, trans, sink).execute()
+
+        self.assertEqual(sink.packets, [2, 4, 6])
+        self.assertTrue(calls)
+
+    def test_fetcher_concurrency(self):
+        urls = [f"http://example.com/{i}" for i in range(20)]
+        src, fetcher, sink = (
+            SampleSrc(sample=list(urls)),
+            FetcherProcessor(fetcher=SleepyFetcher(), concurrency=10),
+            StoreSink(),
+        )
+
+        Pipeline().connect_many(src, fetcher, sink).execute()
+        self.assertEqual(sink.packets, [url.upper() for url in urls])
+
+    def _tempfile(self, contents):
+        t = tempfile.NamedTemporaryFile(delete=False)
+        t.file.write(contents)
+        t.file.close()
+        self.addCleanup(os.unlink, t.name)
+
+        return t.name
+
+    def test_file_mmap(self):
+        path = self._tempfile(b"0123456789")
+
+        sink = StoreSink()
+        Pipeline().connect(FileSrc(path=path, mmap=True, bytes=4), sink).execute()
+
+        self.assertTrue(all(isinstance(x, memoryview) for x in sink.packets))
+        self.assertEqual([bytes(x) for x in sink.packets], [b"0123", b"4567", b"89"])
+
+    def test_file_mmap_empty(self):
+        sink = StoreSink()
+        Pipeline().connect(FileSrc(path=self._tempfile(b""), mmap=True), sink).execute()
+
+        self.assertEqual(sink.packets, [])
+
+    def test_file_records(self):
+        contents = b"a\nbb\n\nccc\nlast"
+        expected = [b"a\n", b"bb\n", b"\n", b"ccc\n", b"last"]
+        path = self._tempfile(contents)
+
+        for kwargs in [dict(bytes=3), dict(mmap=True, bytes=2), dict(mmap=True)]:
+            sink = StoreSink()
+            src = FileSrc(path=path, separator=b"\n", **kwargs)
+            Pipeline().connect(src, sink).execute()
+
+            self.assertEqual([bytes(x) for x in sink.packets], expected)
+
+    def test_file_records_text(self):
+        path = self._tempfile(b"x;y;z")
+
+        sink = StoreSink()
+        Pipeline().connect(FileSrc(path=path, mode="r", separator=";"), sink).execute()
+
+        self.assertEqual(sink.packets, ["x;", "y;", "z"])
+
+    def test_file_sink_coalesced(self):
+        path = self._tempfile(b"")
+        packets = [b"abc", memoryview(b"defg"), bytearray(b"h")] * 100
+
+        src = SampleSrc(sample=list(packets))
+        sink = FileSink(path=path, buffer_size=64, fsync="close")
+        Pipeline().connect(src, sink).execute()
+
+        with open(path, "rb") as fh:
+            self.assertEqual(fh.read(), b"".join(packets))
+
+    def test_file_sink_bad_fsync(self):
+        with self.assertRaises(ValueError):
+            FileSink(path=self._tempfile(b""), fsync="sometimes")
+
+    def test_spill_buffer(self):
+        with tempfile.TemporaryDirectory() as dir:
+            buff = SpillBuffer(max_packets=3, dir=dir)
+            buff.extend([{"n": i} for i in range(10)])
+
+            self.assertEqual(len(buff), 10)
+            self.assertEqual(buff.spilled, 8)
+            self.assertEqual(list(buff), [{"n": i} for i in range(10)])
+            self.assertEqual(len(os.listdir(dir)), 1)
+
+            # Iterating again reads from the start
+            self.assertEqual(len(list(buff)), 10)
+
+            buff.close()
+            self.assertEqual(os.listdir(dir), [])
+
+    def test_store_sink_spill(self):
+        sink = StoreSink(max_packets=16)
+        Pipeline().connect(SampleSrc(sample=list(range(100))), sink).execute()
+
+        self.assertIsInstance(sink.packets, SpillBuffer)
+        self.assertEqual(list(sink.packets), list(range(100)))
+
+    def test_packer_spill(self):
+        sink = StoreSink()
+        pipe = Pipeline().connect_many(
+            SampleSrc(sample=list(range(100))), Packer(max_packets=16), sink
+        )
+        pipe.execute()
+
+        self.assertEqual(len(sink.packets), 1)
+        self.assertEqual(list(sink.packets[0]), list(range(100)))
+
+    def test_pickle_sink_stream(self):
+        path = self._tempfile(b"")
+        packets = [{"n": i, "tags": ["a", "b"]} for i in range(3000)]
+
+        sink = PickleSink(filename=path, stream=True)
+        Pipeline().connect(SampleSrc(sample=list(packets)), sink).execute()
+
+        with open(path, "rb") as fh:
+            self.assertEqual(list(load_packets(fh)), packets)
+
+    def test_pickle_src(self):
+        path = self._tempfile(pickle.dumps(list(range(10))))
+
+        sink = StoreSink()
+        Pipeline().connect(PickleSrc(path), sink).execute()
+
+        self.assertEqual(sink.packets, list(range(10)))
+
+    def test_pickle_src_stream(self):
+        path = self._tempfile(b"")
+        packets = [{"n": i} for i in range(100)]
+        Pipeline().connect(
+            SampleSrc(sample=list(packets)), PickleSink(filename=path, stream=True)
+        ).execute()
+
+        src, sink = PickleSrc(path, stream=True, read_ahead=256), StoreSink()
+        pipe = Pipeline().connect(src, sink)
+        while len(sink.packets) < 40:
+            pipe.run()
+
+        read = sink.packets + list(pipe.get_write_queue(src))
+        self.assertEqual(read, packets[: len(read)])
+
+        # Resume right after the packets read so far
+        sink = StoreSink()
+        offset = src.offset
+        Pipeline().connect(PickleSrc(path, stream=True, offset=offset), sink).execute()
+
+        self.assertEqual(read + sink.packets, packets)
+
+    def test_pickle_src_offset(self):
+        path = self._tempfile(b"")
+        with open(path, "wb") as fh:
+            pickle.dump([1, 2], fh)
+
+        src = PickleSrc(path)
+        self.assertIsNone(src.offset)
+
+        with self.assertRaises(ValueError):
+            PickleSrc(path, offset=1)
+
+        # Still reported once the stream is done and closed
+        path = self._tempfile(b"")
+        Pipeline().connect(
+            SampleSrc(sample=[1, 2]), PickleSink(filename=path, stream=True)
+        ).execute()
+
+        src = PickleSrc(path, stream=True)
+        Pipeline().connect(src, StoreSink()).execute()
+        self.assertEqual(src.offset, os.path.getsize(path))
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -1,8 +1,23 @@
 import unittest
 
 from pypes import Pipeline
-from pypes.elements import CustomTransformer, Debugger, SampleSrc, StoreSink
-from pypes.mediaocd import GuessItParser, NearestMatch, Normalizer
+from pypes.elements import (
+    CustomTransformer,
+    Debugger,
+    DictFixer,
+    GeneratorSrc,
+    Head,
+    SampleSrc,
+    StoreSink,
+)
+from pypes.mediaocd import (
+    GuessItParser,
+    MatchIndex,
+    NearestMatch,
+    Normalizer,
+    compile_chain,
+    normalize,
+)
 
 NORMALIZE_REGEXES = (
     (r"(HDTV|VTV|720px?|mkvpro|x264|HQ edition)", ""),
@@ -36,6 +51,34 @@ class TestMediaOCD(unittest.TestCase):
         Pipeline().connect_many(src, normalizer, sink).execute()
         self.assertEqual([o for (i, o) in inouts], sink.store)
 
+    def test_normalize_combine(self):
+        values = [
+            "dir/Show HDTV [Español castellano]101.avi",
+            "EMentalista720p522 [www.newpct.com].mkv",
+        ]
+        expected = [normalize(v, NORMALIZE_REGEXES) for v in values]
+
+        # The last regex uses groups and gets its own pass
+        self.assertEqual(len(compile_chain(NORMALIZE_REGEXES, combine=True)), 2)
+        self.assertEqual(expected[0], "dir/Show   s1e01.avi")
+
+        for kwargs in [{}, dict(combine=True), dict(combine=True, batch_size=8)]:
+            sink = StoreSink()
+            normalizer = Normalizer(regexes=NORMALIZE_REGEXES, **kwargs)
+            Pipeline().connect_many(
+                SampleSrc(sample=list(values)), normalizer, sink
+            ).execute()
+            self.assertEqual(sink.packets, expected)
+
+    def test_combine_conditional(self):
+        # Conditionals refer to groups by number, which combining shifts
+        regexes = ((r"(a)?(?(1)b|c)", "X"), (r"z", "Y"))
+        expected = normalize("ab c z", regexes)
+
+        self.assertEqual(expected, "X X Y")
+        self.assertEqual(len(compile_chain(regexes, combine=True)), 2)
+        self.assertEqual(normalize("ab c z", compile_chain(regexes, True)), expected)
+
     def test_nearest_match(self):
         inouts = (
             ("EMentalista s5e22.mkv", "El Mentalista"),
@@ -53,6 +96,79 @@ class TestMediaOCD(unittest.TestCase):
         Pipeline().connect_many(src, guessit, dictextract, nearest, sink).execute()
         self.assertEqual([o for (i, o) in inouts], sink.store)
 
+    def test_guessit_batch(self):
+        filenames = [
+            "El Mentalista 5x22.mkv",
+            "American Horror Story 7x01.avi",
+            "El Mentalista 5x22.mkv",
+        ]
+        expected = [dict(GuessItParser().transform(f)) for f in filenames]
+
+        for kwargs in [dict(batch_size=0), dict(batch_size=0, workers=2, cache="lru")]:
+            sink = StoreSink()
+            parser = GuessItParser(**kwargs)
+            Pipeline().connect_many(
+                SampleSrc(sample=list(filenames)), parser, sink
+            ).execute()
+
+            self.assertEqual([dict(p) for p in sink.packets], expected)
+
+    def test_guessit_copies_repeated(self):
+        filenames = ["El Mentalista 5x22.mkv"] * 4
+
+        for batch_size, cache in [(0, "lru"), (2, "lru"), (0, None)]:
+            sink = StoreSink()
+            parser = GuessItParser(batch_size=batch_size, cache=cache)
+            fixer = DictFixer(values={"title": "changed"}, override=True)
+            Pipeline().connect_many(
+                SampleSrc(sample=list(filenames)), parser, fixer, sink
+            ).execute()
+
+            self.assertEqual(len({id(p) for p in sink.packets}), len(filenames))
+            if parser.cache is not None:
+                key = parser._cache_key(filenames[0])
+                self.assertNotIn("changed", parser.cache.lookup(key).values())
+
+    def test_guessit_drain_endless(self):
+        def endless():
+            for i in range(100000):
+                yield f"Show 1x{i:02d}.mkv"
+
+            raise AssertionError("Parsed before the source finished")
+
+        src, parser, head, sink = (
+            GeneratorSrc(generator=endless()),
+            GuessItParser(batch_size=0),
+            Head(n=3),
+            StoreSink(),
+        )
+        Pipeline().connect_many(src, parser, head, sink).execute()
+
+        self.assertEqual(len(sink.packets), 3)
+        self.assertLess(src.i, 100)
+
+    def test_match_index(self):
+        index = MatchIndex(NEAREST_MATCH_LIST)
+
+        self.assertEqual(index.matches("El Mentalist")[0][0], "El Mentalista")
+        self.assertEqual(index.matches("El Mentalist", cutoff=0.99), [])
+        self.assertEqual(
+            [c for (c, _) in index.matches("Anatomia Horror", k=3, cutoff=0.5)],
+            ["American Horror Story", "Anatomía de grey"],
+        )
+
+        index.update(NEAREST_MATCH_LIST[1:] + ("El Mentiroso",))
+        self.assertNotIn("El Mentalista", index)
+        self.assertEqual(index.matches("El Mentalist")[0][0], "El Mentiroso")
+
+    def test_nearest_match_cutoff(self):
+        src = SampleSrc(sample=["El Mentalist", "Mentalist"])
+        nearest = NearestMatch(match_list=NEAREST_MATCH_LIST, cutoff=0.9)
+        sink = StoreSink()
+
+        Pipeline().connect_many(src, nearest, sink).execute()
+        self.assertEqual(sink.packets, ["El Mentalista", "Mentalist"])
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,160 @@
+import http.server
+import threading
+import time
+import unittest
+import urllib.error
+import urllib.parse
+
+from pypes import Pipeline
+from pypes.elements import Head, HttpSrc, SampleSrc, StoreSink
+from pypes.net import ConnectionPool, HttpFetcher, _host_key
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    lock = threading.Lock()
+    connections = 0
+    running = 0
+    max_running = 0
+
+    def setup(self):
+        super().setup()
+        with Handler.lock:
+            Handler.connections += 1
+
+    def do_GET(self):
+        with Handler.lock:
+            Handler.running += 1
+            Handler.max_running = max(Handler.max_running, Handler.running)
+
+        try:
+            if self.path.startswith("/slow"):
+                time.sleep(0.05)
+
+            if self.path.startswith("/big"):
+                body = bytes(range(256)) * 1024
+            else:
+                body = self.path.encode("utf-8")
+
+            self.send_response(200 if self.path != "/missing" else 404)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        finally:
+            with Handler.lock:
+                Handler.running -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(http.server.ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        # Cancelled fetches reset their connections
+        pass
+
+
+class TestNet(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = Server(("127.0.0.1", 0), Handler)
+        cls.base = "http://127.0.0.1:%d" % cls.server.server_address[1]
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        Handler.connections = 0
+        Handler.max_running = 0
+
+    def test_pool_keep_alive(self):
+        pool = ConnectionPool()
+        for idx in range(5):
+            self.assertEqual(pool.fetch(self.base + f"/{idx}"), f"/{idx}".encode())
+        pool.close()
+
+        self.assertEqual(pool.connections, 1)
+        self.assertEqual(Handler.connections, 1)
+
+    def test_pool_error(self):
+        pool = ConnectionPool(max_per_host=1)
+        with self.assertRaises(urllib.error.HTTPError):
+            pool.open(self.base + "/missing")
+
+        # The slot was given back
+        self.assertEqual(pool.fetch(self.base + "/ok"), b"/ok")
+        pool.close()
+
+    def test_fetcher(self):
+        urls = [self.base + f"/slow/{idx}" for idx in range(8)]
+        fetcher, sink = HttpFetcher(concurrency=8, max_per_host=3), StoreSink()
+        Pipeline().connect_many(SampleSrc(sample=list(urls)), fetcher, sink).execute()
+
+        self.assertEqual(sink.packets, [f"/slow/{idx}".encode() for idx in range(8)])
+        self.assertLessEqual(Handler.max_running, 3)
+        self.assertLessEqual(Handler.connections, 3)
+
+    def test_host_key(self):
+        def key(url):
+            return _host_key(urllib.parse.urlsplit(url))
+
+        self.assertEqual(key("http://Example.com/a"), key("http://example.com:80/b"))
+        self.assertEqual(key("https://example.com"), ("https", "example.com", 443))
+        self.assertNotEqual(key("http://example.com"), key("https://example.com"))
+
+    def test_fetcher_same_host(self):
+        # Spellings of the same host share its limit in the fetcher and pool
+        port = self.server.server_address[1]
+        urls = [
+            f"http://{host}:{port}/slow/{idx}"
+            for idx, host in enumerate(["localhost", "LOCALHOST"] * 3)
+        ]
+        fetcher, sink = HttpFetcher(concurrency=6, max_per_host=1), StoreSink()
+        Pipeline().connect_many(SampleSrc(sample=list(urls)), fetcher, sink).execute()
+
+        self.assertEqual(len(sink.packets), 6)
+        self.assertEqual(Handler.max_running, 1)
+        self.assertEqual(fetcher.pool.connections, 1)
+        self.assertEqual(list(fetcher._hosts.values()), [0])
+
+    def test_fetcher_chunks(self):
+        urls = [self.base + "/big", self.base + "/small"]
+        fetcher = HttpFetcher(chunk_size=10000, with_url=True, concurrency=2)
+        sink = StoreSink()
+        Pipeline(maxsize=4).connect_many(
+            SampleSrc(sample=list(urls)), fetcher, sink
+        ).execute()
+
+        self.assertTrue(all(len(chunk) <= 10000 for (_, chunk) in sink.packets))
+        self.assertEqual(
+            b"".join(c for (url, c) in sink.packets if url == urls[0]),
+            bytes(range(256)) * 1024,
+        )
+        self.assertEqual(sink.packets[-1], (urls[1], b"/small"))
+
+    def test_fetcher_cancel(self):
+        urls = [self.base + f"/{idx}" for idx in range(100)]
+        fetcher, sink = HttpFetcher(concurrency=4), StoreSink()
+        Pipeline().connect_many(
+            SampleSrc(sample=list(urls)), fetcher, Head(n=3), sink
+        ).execute()
+
+        self.assertEqual(sink.packets, [b"/0", b"/1", b"/2"])
+        self.assertLess(fetcher.pool.requests, 100)
+
+    def test_http_src_chunks(self):
+        sink = StoreSink()
+        src = HttpSrc(url=self.base + "/big", chunk_size=4096)
+        Pipeline().connect(src, sink).execute()
+
+        self.assertEqual(len(sink.packets), 64)
+        self.assertEqual(b"".join(sink.packets), bytes(range(256)) * 1024)
+
+
+if __name__ == "__main__":
+    unittest.main()
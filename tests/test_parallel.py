@@ -0,0 +1,71 @@
+import os
+import unittest
+
+from pypes import Pipeline, Transformer
+from pypes.elements import Adder, SampleSrc, StoreSink
+from pypes.parallel import ParallelTransformer, WorkerError
+
+
+class CrashingTransformer(Transformer):
+    def transform(self, x):
+        os._exit(1)
+
+
+class ClosingParallelTransformer(ParallelTransformer):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.closed_inputs = []
+
+    def input_closed(self, input):
+        self.closed_inputs.append(input)
+
+
+class TestParallel(unittest.TestCase):
+    def test_order(self):
+        src, trans, sink = (
+            SampleSrc(sample=list(range(200))),
+            ParallelTransformer(Adder(amount=1), workers=2, chunksize=7),
+            StoreSink(),
+        )
+        Pipeline().connect_many(src, trans, sink).execute()
+
+        self.assertEqual(sink.packets, list(range(1, 201)))
+
+    def test_empty(self):
+        src, trans, sink = (
+            SampleSrc(sample=[]),
+            ParallelTransformer(Adder(amount=1), workers=1),
+            StoreSink(),
+        )
+        Pipeline().connect_many(src, trans, sink).execute()
+
+        self.assertEqual(sink.packets, [])
+
+    def test_input_closed(self):
+        src, trans, sink = (
+            SampleSrc(sample=list(range(20))),
+            ClosingParallelTransformer(Adder(amount=1), workers=1, chunksize=3),
+            StoreSink(),
+        )
+        Pipeline().connect_many(src, trans, sink).execute()
+
+        self.assertEqual(sink.packets, list(range(1, 21)))
+        self.assertEqual(trans.closed_inputs, ["default"])
+
+    def test_worker_death(self):
+        src, trans, sink = (
+            SampleSrc(sample=[1, 2, 3]),
+            ParallelTransformer(CrashingTransformer(), workers=1),
+            StoreSink(),
+        )
+
+        with self.assertRaises(WorkerError):
+            Pipeline().connect_many(src, trans, sink).execute()
+
+    def test_not_a_transformer(self):
+        with self.assertRaises(ValueError):
+            ParallelTransformer(lambda x: x)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,8 +1,178 @@
+import itertools
+import time
 import unittest
 
-from pypes import Pipeline
-from pypes.core import WriteError
-from pypes.elements import Adder, NullSink, NullSrc, SampleSrc, StoreSink, Tee, Zip
+from pypes import Element, Pipeline
+from pypes.core import EOF, Channel, Empty, Filter, FusedStage, WriteError
+from pypes.elements import (
+    Adder,
+    CustomTransformer,
+    DictFilter,
+    DictFixer,
+    GeneratorSrc,
+    Head,
+    Merge,
+    NullSink,
+    NullSrc,
+    SampleSrc,
+    StoreSink,
+    Tee,
+    Zip,
+)
+
+
+class ClosingSink(StoreSink):
+    """StoreSink reading from every input and recording input_closed calls"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.closed = []
+
+    def input_closed(self, input):
+        self.closed.append(input)
+
+    def run(self):
+        for input in self.inputs():
+            packet = self.try_get(input)
+            if packet is not Empty and packet is not EOF:
+                self.packets.append(packet)
+
+        if len(self.closed) == len(self.inputs()):
+            self.finish()
+
+
+class LateSink(StoreSink):
+    """StoreSink finishing on the run after the one reading EOF"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.eof = self.finished = False
+
+    def run(self):
+        if self.eof:
+            self.finished = True
+            self.finish()
+
+        packet = self.try_get()
+        if packet is EOF:
+            self.eof = True
+        elif packet is not Empty:
+            self.packets.append(packet)
+
+
+class SlowSink(StoreSink):
+    """StoreSink that only reads on every third run"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ticks = 0
+
+    def run(self):
+        self.ticks += 1
+        if self.ticks % 3:
+            return False
+
+        return super().run()
+
+
+class CountingSink(StoreSink):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.runs = 0
+
+    def run(self):
+        self.runs += 1
+        return super().run()
+
+
+class StubbornSink(StoreSink):
+    """StoreSink that ignores EOF and never finishes"""
+
+    def run(self):
+        packet = self.try_get()
+        if packet is not Empty and packet is not EOF:
+            self.packets.append(packet)
+
+
+class SleepyTransformer(Adder):
+    threaded = True
+
+    def transform(self, x):
+        time.sleep(0.01)
+        return x + 1
+
+
+class FailingTransformer(Adder):
+    def transform(self, x):
+        raise ValueError(x)
+
+
+class BatchCounter(Adder):
+    """Adder recording the size of each batch it gets"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.sizes = []
+
+    def transform_batch(self, xs):
+        self.sizes.append(len(xs))
+        return super().transform_batch(xs)
+
+
+class IdleSrc(Element):
+    """Puts its sample at once and then idles for a while before finishing"""
+
+    def __init__(self, sample, idle, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.sample = sample
+        self.deadline = time.monotonic() + idle
+
+    def run(self):
+        for packet in self.sample:
+            self.put(packet)
+        self.sample = []
+
+        if time.monotonic() > self.deadline:
+            self.finish()
+
+        time.sleep(0.001)
+        return False
+
+
+class TimingSink(StoreSink):
+    """StoreSink recording when each packet arrives"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.times = []
+
+    def run(self):
+        r = super().run()
+        self.times.extend([time.monotonic()] * (len(self.packets) - len(self.times)))
+        return r
+
+
+class ClosingAdder(Adder):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class NappingAdder(Adder):
+    def transform(self, x):
+        time.sleep(0.002)
+        return x + 1
+
+    def transform_batch(self, xs):
+        return [self.transform(x) for x in xs]
+
+
+class EvenFilter(Filter):
+    def filter(self, x):
+        return x % 2 == 0
 
 
 class TestPipeline(unittest.TestCase):
@@ -114,6 +284,46 @@ class TestPipeline(unittest.TestCase):
             sorted(sink.packets), sorted(["a", "$", "1", "b", "%", "2", "c", "!", "3"])
         )
 
+    def test_zip_uneven(self):
+        srcs = [GeneratorSrc(generator=iter(range(n))) for n in (1, 50, 7)]
+        zip, sink = Zip(n_inputs=3), StoreSink()
+
+        pipe = Pipeline()
+        for idx, src in enumerate(srcs):
+            pipe.connect(src, zip, "default", "zip_%02d" % idx)
+        pipe.connect(zip, sink)
+        pipe.execute()
+
+        self.assertEqual(len(sink.packets), 58)
+        self.assertFalse(pipe._elements)
+
+    def test_merge(self):
+        srcs = [GeneratorSrc(generator=iter(range(n))) for n in (3, 40, 0)]
+        merge, sink = Merge(), StoreSink()
+
+        pipe = Pipeline(maxsize=4)
+        for idx, src in enumerate(srcs):
+            pipe.connect(src, merge, "default", f"in{idx}")
+        pipe.connect(merge, sink)
+        pipe.execute()
+
+        self.assertEqual(sorted(sink.packets), sorted(list(range(3)) + list(range(40))))
+        self.assertEqual([p for p in sink.packets if p >= 3], list(range(3, 40)))
+        self.assertFalse(pipe._elements)
+
+    def test_input_closed(self):
+        src1, src2 = SampleSrc(sample=[1]), SampleSrc(sample=[2, 3])
+        sink = ClosingSink()
+
+        pipe = Pipeline()
+        pipe.connect(src1, sink, "default", "a")
+        pipe.connect(src2, sink, "default", "b")
+        pipe.execute()
+
+        self.assertEqual(sorted(sink.packets), [1, 2, 3])
+        self.assertEqual(sorted(sink.closed), ["a", "b"])
+        self.assertFalse(pipe._elements)
+
     def test_name(self):
         src, sink = NullSrc(name="src"), NullSink(name="sink")
         pipe = Pipeline().connect(src, sink)
@@ -130,6 +340,439 @@ class TestPipeline(unittest.TestCase):
 
         self.assertEqual(sink, pipe.get("null-1"))
 
+    def test_name_reinsert(self):
+        src, adder, sink = SampleSrc(name="x"), Adder(name="x"), StoreSink(name="x")
+        pipe = Pipeline().connect_many(src, adder, sink)
+
+        # Elements connected twice keep a single name
+        self.assertEqual(sorted(pipe._table), ["x", "x-1", "x-2"])
+        self.assertEqual(pipe.name_of(adder), "x-1")
+
+        pipe.connect(SampleSrc(name="x-3"), NullSink(name="x"))
+        self.assertEqual(sorted(pipe._table), ["x", "x-1", "x-2", "x-3", "x-4"])
+
+    def test_connect_again(self):
+        src, sink = SampleSrc(sample=[1, 2]), StoreSink()
+        pipe = Pipeline().connect(src, sink)
+        first = sink.read_queue()
+
+        # Connecting a port again replaces the channel elements resolved
+        pipe.connect(src, sink)
+        self.assertIsNot(sink.read_queue(), first)
+        self.assertIs(src.write_queue(), sink.read_queue())
+
+    def test_disconnect(self):
+        src, tee, sink1, sink2 = SampleSrc(), Tee(n_outputs=2), StoreSink(), StoreSink()
+        pipe = Pipeline()
+        pipe.connect(src, tee)
+        pipe.connect(tee, sink1, "tee_00")
+        pipe.connect(tee, sink2, "tee_01")
+
+        q_out = pipe.get_write_queue(tee, "tee_00")
+        q_in = pipe.get_read_queue(tee)
+        pipe.disconnect(tee)
+
+        self.assertTrue(q_out.closed)
+        self.assertTrue(q_in.dropped)
+        self.assertFalse(pipe.is_src(tee, "tee_00"))
+        self.assertFalse(pipe.is_sink(tee))
+        self.assertTrue(pipe.is_sink(sink2))
+        self.assertNotIn(tee, pipe._elements)
+        self.assertIs(pipe.get("Tee"), tee)
+
+        # Nobody reads from src anymore
+        self.assertNotIn(src, pipe._elements)
+        self.assertFalse(pipe.is_src(src))
+
+    def test_channel(self):
+        q = Channel(maxsize=2)
+        with self.assertRaises(Empty):
+            q.get()
+
+        q.put(1)
+        self.assertFalse(q.full())
+        q.put(2)
+        self.assertTrue(q.full())
+        self.assertEqual(q.get(), 1)
+        self.assertFalse(q.full())
+
+        q.close()
+        self.assertEqual(q.get(), 2)
+        with self.assertRaises(EOF):
+            q.get()
+
+        self.assertEqual(q.empty_count, 1)
+
+    def test_backpressure(self):
+        depths = []
+
+        pipe = Pipeline(maxsize=4)
+        src = GeneratorSrc(generator=iter(range(100)))
+        trans = CustomTransformer(
+            func=lambda x: depths.append(len(pipe.get_read_queue(trans))) or x
+        )
+        sink = SlowSink()
+        pipe.connect_many(src, trans, sink).execute()
+
+        self.assertEqual(sink.packets, list(range(100)))
+        self.assertTrue(max(depths) < 4)
+        self.assertTrue(max(s["full"] for s in pipe.queue_stats()) > 0)
+
+    def test_connect_maxsize(self):
+        src, sink = SampleSrc(sample=[1, 2]), StoreSink()
+        pipe = Pipeline(maxsize=10).connect(src, sink, maxsize=1)
+
+        self.assertEqual(pipe.get_write_queue(src).maxsize, 1)
+
+    def test_scheduler_wakes_on_data(self):
+        src, adder, sink = SampleSrc(sample=list(range(10))), Adder(), CountingSink()
+        Pipeline().connect_many(src, adder, sink).execute()
+
+        self.assertEqual(sink.packets, list(range(10)))
+        # One run per packet plus the EOF one
+        self.assertEqual(sink.runs, 11)
+
+    def test_batches_form(self):
+        for maxsize in (0, 16, 100):
+            src = GeneratorSrc(generator=iter(range(1000)))
+            first, second = BatchCounter(batch_size=64), BatchCounter(batch_size=64)
+            sink = StoreSink()
+            pipe = Pipeline(maxsize=maxsize).connect_many(src, first, second, sink)
+            pipe.execute()
+
+            self.assertEqual(sink.packets, list(range(1000)))
+            for adder in (first, second):
+                self.assertEqual(sum(adder.sizes), 1000)
+                # Full batches, or the channel when smaller, and the remainder
+                batch = min(64, maxsize or 64)
+                self.assertTrue(all(n >= batch for n in adder.sizes[:-1]))
+
+    def test_batch_behind_idle_src(self):
+        for threaded in (False, True):
+            src = IdleSrc(list(range(10)), idle=0.5, threaded=threaded)
+            adder, sink = BatchCounter(batch_size=256), TimingSink()
+            start = time.monotonic()
+            Pipeline().connect_many(src, adder, sink).execute()
+
+            self.assertEqual(sink.packets, list(range(10)))
+            self.assertEqual(adder.sizes, [10])
+            self.assertLess(sink.times[0] - start, 0.25)
+
+    def test_topological_order(self):
+        pipe = Pipeline()
+        src, adder, sink = SampleSrc(), Adder(), StoreSink()
+
+        # Connect in reverse order
+        pipe.connect(adder, sink)
+        pipe.connect(src, adder)
+        pipe._prepare()
+
+        self.assertEqual(pipe._order, [src, adder, sink])
+
+    def _endless(self, closed):
+        def gen():
+            try:
+                yield from itertools.count()
+            finally:
+                closed.append(True)
+
+        return gen()
+
+    def test_head_cancels_upstream(self):
+        for kwargs in [{}, dict(threaded=True), dict(maxsize=4)]:
+            closed = []
+            src = GeneratorSrc(generator=self._endless(closed))
+            adder, head, sink = Adder(amount=1), Head(n=5), StoreSink()
+
+            pipe = Pipeline(**kwargs).connect_many(src, adder, head, sink)
+            pipe.execute()
+
+            self.assertEqual(sink.packets, [1, 2, 3, 4, 5])
+            self.assertEqual(closed, [True])
+            self.assertFalse(pipe._elements)
+
+    def _teardown_time(self, n, src, head):
+        adders = [Adder(amount=1) for _ in range(n)]
+        pipe = Pipeline().connect_many(src, *adders, Head(n=head), StoreSink())
+
+        start = time.perf_counter()
+        pipe.execute()
+        return time.perf_counter() - start
+
+    def test_teardown_scales_linearly(self):
+        # EOF flows down and cancellation up a whole chain in one pass, a
+        # chain 8 times longer must not take anywhere near 64 times longer
+        for make_src, head in (
+            (lambda: SampleSrc(sample=[1]), -1),
+            (lambda: GeneratorSrc(generator=itertools.count()), 1),
+        ):
+            times = [
+                min(self._teardown_time(n, make_src(), head) for _ in range(3))
+                for n in (500, 4000)
+            ]
+            self.assertLess(times[1], 20 * times[0])
+
+    def test_cancel_keeps_other_readers(self):
+        src, tee = SampleSrc(sample=list(range(10))), Tee(n_outputs=2)
+        head, sink1, sink2 = Head(n=2), StoreSink(), StoreSink()
+
+        pipe = Pipeline()
+        pipe.connect(src, tee)
+        pipe.connect(tee, head, "tee_00")
+        pipe.connect(head, sink1)
+        pipe.connect(tee, sink2, "tee_01")
+        pipe.execute()
+
+        self.assertEqual(sink1.packets, [0, 1])
+        self.assertEqual(sink2.packets, list(range(10)))
+
+    def test_stall(self):
+        src, sink = SampleSrc(sample=[1, 2]), StubbornSink()
+        pipe = Pipeline().connect(src, sink)
+        pipe.execute()
+
+        self.assertEqual(sink.packets, [1, 2])
+        self.assertFalse(pipe.run())
+
+    def test_late_finish(self):
+        # Elements get one more run after reading EOF from every input
+        for kwargs in [{}, dict(threaded=True)]:
+            src, sink = SampleSrc(sample=[1, 2]), LateSink()
+            pipe = Pipeline(**kwargs).connect(src, sink)
+            pipe.execute()
+
+            self.assertEqual(sink.packets, [1, 2])
+            self.assertTrue(sink.finished)
+
+    def test_try_get(self):
+        src, sink = SampleSrc(), StoreSink()
+        pipe = Pipeline().connect(src, sink)
+
+        q = pipe.get_write_queue(src)
+        self.assertIs(sink.read_queue(), q)
+        self.assertIs(sink.try_get(), Empty)
+        with self.assertRaises(Empty):
+            sink.get()
+
+        src.put(1)
+        self.assertEqual(sink.try_get(), 1)
+
+        q.close()
+        self.assertIs(sink.try_get(), EOF)
+        with self.assertRaises(EOF):
+            sink.get()
+
+    def test_threaded_pipeline(self):
+        src, adder, sink = SampleSrc(sample=list(range(100))), Adder(), StoreSink()
+        pipe = Pipeline(threaded=True, workers=2, maxsize=3)
+        pipe.connect_many(src, adder, sink).execute()
+
+        self.assertEqual(sink.packets, list(range(100)))
+
+    def test_threaded_element(self):
+        slow_src, slow, slow_sink = (
+            SampleSrc(sample=[1, 2, 3]),
+            SleepyTransformer(),
+            StoreSink(),
+        )
+        fast_src, fast_sink = GeneratorSrc(generator=iter(range(100))), StoreSink()
+
+        # Progress of the slow branch seen by the fast one
+        seen = []
+        spy = CustomTransformer(func=lambda x: seen.append(len(slow_sink.packets)) or x)
+
+        pipe = Pipeline()
+        pipe.connect_many(slow_src, slow, slow_sink)
+        pipe.connect_many(fast_src, spy, fast_sink)
+        pipe.execute()
+
+        self.assertEqual(slow_sink.packets, [2, 3, 4])
+        self.assertEqual(fast_sink.packets, list(range(100)))
+        self.assertTrue(seen[-1] < 3)
+
+    def test_threaded_error(self):
+        src, trans, sink = (
+            SampleSrc(sample=[1]),
+            FailingTransformer(threaded=True),
+            StoreSink(),
+        )
+        with self.assertRaises(ValueError):
+            Pipeline().connect_many(src, trans, sink).execute()
+
+    def _tee(self, packet, *sinks, **kwargs):
+        pipe = Pipeline()
+        tee = Tee(n_outputs=len(sinks), **kwargs)
+        pipe.connect(SampleSrc(sample=[packet]), tee)
+        for idx, sink in enumerate(sinks):
+            pipe.connect(tee, sink, "tee_%02d" % idx)
+        pipe.execute()
+
+        return [sink.packets[0] for sink in sinks]
+
+    def test_tee_shares_with_non_mutating(self):
+        packet = {"a": 1}
+        a, b = self._tee(packet, StoreSink(), StoreSink())
+
+        self.assertIs(a, packet)
+        self.assertIs(b, packet)
+
+    def test_tee_copies_for_mutating(self):
+        packet = {"a": 1}
+        mutator = CustomTransformer(func=lambda x: x)
+        store, fwd_sink = StoreSink(), StoreSink()
+
+        pipe = Pipeline()
+        tee = Tee(n_outputs=2, copy="copy")
+        pipe.connect(SampleSrc(sample=[packet]), tee)
+        pipe.connect(tee, store, "tee_00")
+        pipe.connect(tee, mutator, "tee_01")
+        pipe.connect(mutator, fwd_sink)
+        pipe.execute()
+
+        self.assertIs(store.packets[0], packet)
+        self.assertIsNot(fwd_sink.packets[0], packet)
+        self.assertEqual(fwd_sink.packets[0], packet)
+
+    def test_tee_mutation_through_filter(self):
+        class Mutator(StoreSink):
+            mutates_input = True
+
+        packet = {"a": 1}
+        head = Head(1)
+        sink = Mutator()
+
+        pipe = Pipeline()
+        tee = Tee(n_outputs=2, copy=lambda x: dict(x, copied=True))
+        pipe.connect(SampleSrc(sample=[packet]), tee)
+        pipe.connect(tee, StoreSink(), "tee_00")
+        pipe.connect(tee, head, "tee_01")
+        pipe.connect(head, sink)
+        pipe.execute()
+
+        self.assertEqual(sink.packets, [{"a": 1, "copied": True}])
+
+    def test_tee_mutation_through_dict_filter(self):
+        packet = {"a": 1}
+        dict_filter, fixer = DictFilter(), DictFixer(values={"a": 99}, override=True)
+        store, sink = StoreSink(), StoreSink()
+
+        pipe = Pipeline()
+        tee = Tee(n_outputs=2)
+        pipe.connect(SampleSrc(sample=[packet]), tee)
+        pipe.connect(tee, store, "tee_00")
+        pipe.connect(tee, dict_filter, "tee_01")
+        pipe.connect_many(dict_filter, fixer, sink)
+        pipe.execute()
+
+        self.assertEqual(store.packets, [{"a": 1}])
+        self.assertEqual(sink.packets, [{"a": 99}])
+
+    def test_tee_memoryview(self):
+        buff = bytearray(b"data")
+        sinks = StoreSink(mutates_input=True), StoreSink(mutates_input=True)
+        a, b = self._tee(memoryview(buff), *sinks)
+
+        self.assertTrue(a.readonly and b.readonly)
+        self.assertIs(a.obj, buff)
+        self.assertIs(b.obj, buff)
+
+    def test_tee_bad_strategy(self):
+        with self.assertRaises(ValueError):
+            Tee(n_outputs=2, copy="magic")
+
+    def _fusible_chain(self, **kwargs):
+        src = SampleSrc(sample=list(range(10)), name="src")
+        stages = [
+            Adder(amount=1, name="a1", **kwargs),
+            EvenFilter(name="even", **kwargs),
+            Adder(amount=2, name="a2", **kwargs),
+        ]
+        sink = StoreSink(name="sink")
+
+        return src, stages, sink
+
+    def test_compile(self):
+        src, stages, sink = self._fusible_chain()
+        pipe = Pipeline(profile=True).connect_many(src, *stages, sink).compile()
+
+        fused = [e for e in pipe._elements if isinstance(e, FusedStage)]
+        self.assertEqual(len(fused), 1)
+        self.assertEqual(fused[0].stages, stages)
+        self.assertEqual(len(pipe.queue_stats()), 2)
+
+        pipe.execute()
+        self.assertEqual(sink.packets, [4, 6, 8, 10, 12])
+
+        # Original elements are still visible
+        self.assertIs(pipe.get("a1"), stages[0])
+        stats = {s.name: s for s in pipe.profiler.elements.values()}
+        self.assertEqual(stats["a1"].packets_in, 10)
+        self.assertEqual(stats["even"].packets_out, 5)
+        self.assertEqual(stats["a2"].packets_in, 5)
+
+    def test_compile_profile(self):
+        for batch_size in (1, 4):
+            stages = [
+                NappingAdder(name="n1", batch_size=batch_size),
+                EvenFilter(name="even", batch_size=batch_size),
+                NappingAdder(name="n2", batch_size=batch_size),
+            ]
+            pipe = Pipeline(profile=True).connect_many(
+                SampleSrc(sample=list(range(10))), *stages, StoreSink()
+            )
+            pipe.compile()
+
+            start = time.perf_counter()
+            pipe.execute()
+            total = time.perf_counter() - start
+
+            # Stages are reported instead of the fused element, and their
+            # 15 naps are accounted once
+            stats = {s.name: s for s in pipe.profiler.elements.values()}
+            self.assertNotIn("n1+even+n2", stats)
+            self.assertEqual(stats["n1"].packets_in, 10)
+            self.assertEqual(stats["even"].packets_out, 5)
+            self.assertEqual(stats["n2"].packets_in, 5)
+
+            wall = sum(stats[s.name].wall for s in stages)
+            self.assertGreater(wall, 0.03)
+            self.assertGreater(wall, 0.5 * total)
+            self.assertLessEqual(sum(s.wall for s in stats.values()), total)
+
+    def test_compile_batch(self):
+        src, stages, sink = self._fusible_chain(batch_size=4)
+        Pipeline().connect_many(src, *stages, sink).compile().execute()
+
+        self.assertEqual(sink.packets, [4, 6, 8, 10, 12])
+
+    def test_compile_closes_stages(self):
+        stages = [ClosingAdder(amount=1), ClosingAdder(amount=2)]
+        pipe = Pipeline().connect_many(SampleSrc(sample=[1]), *stages, StoreSink())
+        pipe.compile().execute()
+
+        self.assertTrue(all(s.closed for s in stages))
+
+    def test_compile_stops_at_fanout(self):
+        src, tee, adder, sink1, sink2 = (
+            SampleSrc(sample=[1, 2]),
+            Tee(n_outputs=2),
+            Adder(amount=1),
+            StoreSink(),
+            StoreSink(),
+        )
+        pipe = Pipeline()
+        pipe.connect(src, tee)
+        pipe.connect(tee, adder, "tee_00")
+        pipe.connect(adder, sink1)
+        pipe.connect(tee, sink2, "tee_01")
+        pipe.compile()
+
+        self.assertFalse(any(isinstance(e, FusedStage) for e in pipe._elements))
+
+        pipe.execute()
+        self.assertEqual(sink1.packets, [2, 3])
+        self.assertEqual(sink2.packets, [1, 2])
+
 
 if __name__ == "__main__":
     unittest.main()
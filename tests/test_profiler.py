@@ -0,0 +1,73 @@
+import json
+import unittest
+
+from pypes import Pipeline
+from pypes.elements import Adder, Head, SampleSrc, StoreSink
+
+
+class TestProfiler(unittest.TestCase):
+    def test_disabled(self):
+        pipe = Pipeline()
+        self.assertIsNone(pipe.profiler)
+
+    def test_stats(self):
+        src, adder, head, sink = (
+            SampleSrc(sample=list(range(10)), name="src"),
+            Adder(amount=1, name="adder"),
+            Head(5, name="head"),
+            StoreSink(name="sink"),
+        )
+        pipe = Pipeline(profile=True, maxsize=2)
+        pipe.connect_many(src, adder, head, sink).execute()
+
+        self.assertEqual(sink.packets, [1, 2, 3, 4, 5])
+
+        stats = {s["name"]: s for s in pipe.profiler.to_dict()["elements"]}
+        # Head cancels src and adder once it has its 5 packets
+        self.assertEqual(stats["src"]["packets_out"], 5)
+        self.assertEqual(stats["adder"]["packets_in"], 5)
+        self.assertEqual(stats["adder"]["packets_out"], 5)
+        self.assertEqual(stats["head"]["packets_out"], 5)
+        self.assertEqual(stats["sink"]["packets_in"], 5)
+        self.assertTrue(all(s["runs"] > 0 for s in stats.values()))
+
+        channels = pipe.profiler.to_dict()["channels"]
+        self.assertEqual(len(channels), 3)
+        self.assertTrue(all(0 < c["high_water"] <= 2 for c in channels))
+
+    def test_reports(self):
+        src, sink = SampleSrc(sample=[1, 2], name="src"), StoreSink(name="sink")
+        pipe = Pipeline(profile=True)
+        pipe.connect(src, sink).execute()
+
+        report = pipe.profiler.report()
+        self.assertIn("src", report)
+        self.assertIn("src:default -> sink:default", report)
+
+        data = json.loads(pipe.profiler.to_json())
+        self.assertEqual(set(data), {"elements", "channels"})
+
+    def test_duplicate_names(self):
+        src, adder, sink = SampleSrc(sample=[1], name="x"), Adder(name="x"), StoreSink()
+        pipe = Pipeline(profile=True)
+        pipe.connect_many(src, adder, sink).execute()
+
+        data = pipe.profiler.to_dict()
+        names = {s["name"] for s in data["elements"]}
+        for channel in data["channels"] + pipe.queue_stats():
+            self.assertIn(channel["src"], names)
+            self.assertIn(channel["sink"], names)
+
+        self.assertEqual(data["channels"][0]["sink"], "x-1")
+
+    def test_threaded(self):
+        src, adder, sink = SampleSrc(sample=[1, 2, 3]), Adder(name="adder"), StoreSink()
+        pipe = Pipeline(profile=True, threaded=True)
+        pipe.connect_many(src, adder, sink).execute()
+
+        stats = {s.name: s for s in pipe.profiler.elements.values()}
+        self.assertEqual(stats["adder"].packets_out, 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
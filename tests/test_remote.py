@@ -0,0 +1,140 @@
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from pypes import Element, Pipeline
+from pypes.elements import GeneratorSrc, Head, SampleSrc, StoreSink
+from pypes.remote import RemoteSink, RemoteSrc
+
+
+def endless():
+    n = 0
+    while True:
+        yield n
+        n += 1
+
+
+def send(address, sample):
+    Pipeline(maxsize=64).connect(
+        SampleSrc(sample=sample), RemoteSink(address, batch_size=64)
+    ).execute()
+
+
+def send_endless(address):
+    Pipeline(maxsize=64).connect(
+        GeneratorSrc(generator=endless()), RemoteSink(address)
+    ).execute()
+
+
+def send_and_die(address):
+    class Dying(Element):
+        sent = False
+
+        def run(self):
+            if self.sent:
+                # Leaves RemoteSink time to connect and send
+                time.sleep(0.3)
+                os._exit(0)
+
+            self.put(1)
+            self.sent = True
+
+    Pipeline().connect(Dying(), RemoteSink(address)).execute()
+
+
+class Stalled(Element):
+    # Never reads its input
+    def run(self):
+        return False
+
+
+class TestRemote(unittest.TestCase):
+    def start(self, target, *args):
+        process = multiprocessing.Process(target=target, args=args, daemon=True)
+        process.start()
+        self.addCleanup(process.join, 5)
+        return process
+
+    def assertClosed(self, src, sink=None):
+        links = src._links + ([sink._link] if sink is not None else [])
+        for sock in [src._listener] + links:
+            self.assertEqual(sock.fileno(), -1)
+
+    def test_tcp_senders(self):
+        src, sink = RemoteSrc(("127.0.0.1", 0), senders=3, window=32), StoreSink()
+        for idx in range(3):
+            self.start(send, src.address, list(range(idx * 1000, (idx + 1) * 1000)))
+
+        Pipeline(maxsize=16).connect(src, sink).execute()
+
+        self.assertEqual(sorted(sink.packets), list(range(3000)))
+        for idx in range(3):
+            part = [x for x in sink.packets if x // 1000 == idx]
+            self.assertEqual(part, sorted(part))
+
+    def test_unix(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "link.sock")
+            src, sink = RemoteSrc(path), StoreSink()
+            sample = [{"id": i, "body": b"x" * i} for i in range(500)]
+            self.start(send, path, sample)
+
+            Pipeline().connect(src, sink).execute()
+
+            self.assertEqual(sink.packets, sample)
+            self.assertFalse(os.path.exists(path))
+
+    def test_empty(self):
+        src, sink = RemoteSrc(("127.0.0.1", 0)), StoreSink()
+        self.start(send, src.address, [])
+        Pipeline().connect(src, sink).execute()
+
+        self.assertEqual(sink.packets, [])
+
+    def test_backpressure(self):
+        src = RemoteSrc(("127.0.0.1", 0), window=16)
+        remote = RemoteSink(src.address, batch_size=4)
+        sender = Pipeline(maxsize=8).connect(GeneratorSrc(generator=endless()), remote)
+        thread = threading.Thread(target=sender.execute)
+        thread.start()
+
+        receiver = Pipeline(maxsize=1).connect(src, Stalled())
+        deadline = time.monotonic() + 0.5
+        while time.monotonic() < deadline:
+            receiver.run()
+
+        # The sender stops once its window is used up
+        self.assertGreater(remote.sent, 0)
+        self.assertLess(src.received, 32)
+        self.assertLessEqual(remote.sent, src.received + 16)
+
+        # Cancelling the receiver stops the sender
+        src.close()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertClosed(src, remote)
+
+    def test_cancel(self):
+        src, head, sink = RemoteSrc(("127.0.0.1", 0)), Head(n=50), StoreSink()
+        process = self.start(send_endless, src.address)
+        Pipeline().connect_many(src, head, sink).execute()
+
+        self.assertEqual(sink.packets, list(range(50)))
+        process.join(5)
+        self.assertEqual(process.exitcode, 0)
+
+    def test_sender_lost(self):
+        src = RemoteSrc(("127.0.0.1", 0))
+        self.start(send_and_die, src.address)
+
+        with self.assertRaises(ConnectionError):
+            Pipeline().connect(src, StoreSink()).execute()
+
+        self.assertClosed(src)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,172 @@
+import os
+import tempfile
+import unittest
+
+from pypes import Element, Pipeline, Transformer
+from pypes.elements import (
+    Adder,
+    CustomTransformer,
+    GeneratorSrc,
+    Head,
+    SampleSrc,
+    StoreSink,
+)
+from pypes.file import FileSink
+from pypes.parallel import WorkerError
+from pypes.shm import ProcessPipeline, SharedBuffer, ShmRing, ShmSink, ShmSrc
+
+
+class PidTagger(Transformer):
+    def transform(self, x):
+        return (x, os.getpid())
+
+
+class Crasher(Transformer):
+    def transform(self, x):
+        raise RuntimeError("boom")
+
+
+class BufferSrc(Element):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.n = 0
+
+    def run(self):
+        if self.n == 3:
+            self.finish()
+
+        buffer = SharedBuffer(1 << 20)
+        buffer.buf[:] = bytes([self.n]) * (1 << 20)
+        self.put(buffer)
+        self.n += 1
+
+
+def endless():
+    n = 0
+    while True:
+        yield n
+        n += 1
+
+
+class TestShm(unittest.TestCase):
+    def test_ring(self):
+        # Small ring to wrap around and exercise oversized records
+        ring = ShmRing(1024)
+        self.addCleanup(ring.unlink)
+
+        sample = [b"x" * (i % 300) for i in range(200)]
+        sample += [{"a": 1}, {"b": "z" * 1000}, b"y" * 5000]
+        src, sink = SampleSrc(sample=list(sample)), StoreSink()
+        Pipeline().connect(src, ShmSink(ring, zero_copy=True, threshold=4096)).connect(
+            ShmSrc(ring), sink
+        ).execute()
+
+        received = sink.packets[:-1] + [bytes(sink.packets[-1])]
+        self.assertEqual(received, sample)
+        self.assertIsInstance(sink.packets[-1], SharedBuffer)
+
+    def test_boundary(self):
+        src, adder, tagger, sink = (
+            SampleSrc(sample=list(range(5000))),
+            Adder(amount=1),
+            PidTagger(),
+            StoreSink(),
+        )
+        pipe = ProcessPipeline(maxsize=64)
+        pipe.connect_many(src, adder, tagger, sink).boundary(adder)
+        pipe.execute()
+
+        self.assertEqual([x for (x, _) in sink.packets], list(range(1, 5001)))
+        self.assertEqual({pid for (_, pid) in sink.packets}, {os.getpid()})
+
+    def test_auto_partitions(self):
+        elements = [SampleSrc(sample=list(range(100)))]
+        elements += [PidTagger() for _ in range(3)]
+        elements += [StoreSink()]
+
+        pipe = ProcessPipeline(partitions=3).connect_many(*elements)
+        groups, cuts = pipe._partitions()
+        self.assertEqual(len(groups), 3)
+        self.assertEqual(len(cuts), 2)
+
+        pipe.execute()
+
+        packets = elements[-1].packets
+        self.assertEqual([p[0][0][0] for p in packets], list(range(100)))
+
+        # Each stage ran in its own process, the last one in this one
+        pids = (packets[0][0][0][1], packets[0][0][1], packets[0][1])
+        self.assertEqual(len(set(pids)), 3)
+        self.assertEqual(pids[-1], os.getpid())
+
+    def test_zero_copy(self):
+        payload = bytes(range(256)) * 8192
+        pipe = ProcessPipeline(partitions=2, zero_copy=True).connect_many(
+            SampleSrc(sample=[payload, b"small"]),
+            CustomTransformer(func=lambda x: x),
+            StoreSink(),
+        )
+        sink = pipe.get("StoreSink")
+        pipe.execute()
+
+        self.assertIsInstance(sink.packets[0], SharedBuffer)
+        self.assertEqual(bytes(sink.packets[0]), payload)
+        self.assertEqual(sink.packets[1], b"small")
+
+    def test_large_payload(self):
+        # Larger than a ring record, still arrives as bytes by default
+        payload = bytes(range(256)) * 8192
+        t = tempfile.NamedTemporaryFile(delete=False)
+        t.file.close()
+        self.addCleanup(os.unlink, t.name)
+
+        pipe = ProcessPipeline(partitions=2, ring_size=1 << 16).connect_many(
+            SampleSrc(sample=[payload, b"small"]),
+            CustomTransformer(func=lambda x: x),
+            FileSink(path=t.name),
+        )
+        pipe.execute()
+
+        with open(t.name, "rb") as fh:
+            self.assertEqual(fh.read(), payload + b"small")
+
+    def test_shared_buffers(self):
+        src, sink = BufferSrc(), StoreSink()
+        pipe = ProcessPipeline().connect(src, sink).boundary(src)
+        pipe.execute()
+
+        self.assertEqual([b.buf[0] for b in sink.packets], [0, 1, 2])
+        self.assertTrue(all(len(b) == 1 << 20 for b in sink.packets))
+
+    def test_cancel(self):
+        src, adder, head, sink = (
+            GeneratorSrc(generator=endless()),
+            Adder(amount=1),
+            Head(n=10),
+            StoreSink(),
+        )
+        pipe = ProcessPipeline(maxsize=16, ring_size=4096)
+        pipe.connect_many(src, adder, head, sink).boundary(adder)
+        pipe.execute()
+
+        self.assertEqual(sink.packets, list(range(1, 11)))
+        self.assertFalse(any(p.is_alive() for p in pipe._processes))
+
+    def test_worker_error(self):
+        src, crasher, sink = SampleSrc(sample=[1, 2, 3]), Crasher(), StoreSink()
+        pipe = ProcessPipeline().connect_many(src, crasher, sink).boundary(crasher)
+
+        with self.assertRaises(WorkerError) as cm:
+            pipe.execute()
+
+        self.assertIn("boom", str(cm.exception))
+
+    def test_single_partition(self):
+        src, sink = SampleSrc(sample=[1, 2]), StoreSink()
+        ProcessPipeline().connect(src, sink).execute()
+
+        self.assertEqual(sink.packets, [1, 2])
+
+
+if __name__ == "__main__":
+    unittest.main()